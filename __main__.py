@@ -1 +1,18 @@
-import main
+import sys
+
+# Guarded, as worker processes re-run this script, with the parent's
+# arguments, to rebuild __main__
+if __name__ == '__main__':
+    # The headless commands don't import Kivy, so they run on machines
+    # without a display
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        import indexer
+        sys.exit(indexer.main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'import':
+        from importers import aperture
+        sys.exit(aperture.main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        from importers import watch
+        sys.exit(watch.main(sys.argv[2:]))
+
+    import main
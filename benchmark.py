@@ -0,0 +1,384 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+import dao
+import decoding
+import exifparse
+import instrumentation
+import thumbnails
+from importers import aperture
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILES = 500
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 4
+DEFAULT_IMAGE_SIZE = (1600, 1200)
+DEFAULT_SEED = 1
+# Photographs in the catalog that the ingest and query benchmarks build
+DEFAULT_CATALOG_SIZE = 20000
+# Fractional worsening of a result beyond which compare flags a regression
+DEFAULT_TOLERANCE = 0.2
+# Name of the file recording the parameters a corpus was generated with
+CORPUS_MARKER = '.picman-benchmark-corpus.json'
+
+_Makes = (('FUJIFILM', 'X-T2'), ('FUJIFILM', 'X100F'), ('Canon', 'EOS 5D Mark IV'), ('NIKON CORPORATION', 'NIKON D850'))
+_Lenses = ('XF23mmF1.4 R', 'XF56mmF1.2 R', 'EF24-70mm f/2.8L II USM', 'AF-S NIKKOR 50mm f/1.8G')
+_Isos = (100, 200, 400, 800, 1600, 3200, 6400, 12800)
+_F_Numbers = (1.4, 2.0, 2.8, 4.0, 5.6, 8.0, 11.0)
+
+
+def _corpus_directories(top, depth, fanout):
+    directories = [top]
+    for level in range(depth):
+        directories = [os.path.join(directory, 'd{}_{}'.format(level, index))
+                       for directory in directories for index in range(fanout)]
+    return directories
+
+
+def _synthetic_exif(rng, index, size):
+    (make, model) = rng.choice(_Makes)
+    taken = datetime(2015, 1, 1) + timedelta(seconds=rng.randrange(8 * 365 * 24 * 60 * 60))
+    exif = Image.Exif()
+    exif[0x010F] = make
+    exif[0x0110] = model
+    exif[0x0131] = 'picman benchmark'
+    exif[0x8769] = {
+        0x829A: 1 / rng.choice((30, 60, 125, 250, 500, 1000)),
+        0x829D: rng.choice(_F_Numbers),
+        0x8822: rng.randrange(1, 5),
+        0x8827: rng.choice(_Isos),
+        0x9003: taken.strftime('%Y:%m:%d %H:%M:%S'),
+        0x9204: rng.choice((-1.0, -0.3, 0.0, 0.3, 1.0)),
+        0x9207: 5,
+        0x9209: 16,
+        0x920A: float(rng.choice((23, 35, 56, 50, 70))),
+        0xA002: size[0],
+        0xA003: size[1],
+        0xA434: rng.choice(_Lenses),
+        0xA435: '{:08d}'.format(index),
+    }
+    return exif
+
+
+def generate_corpus(top, files=DEFAULT_FILES, depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT,
+                    image_size=DEFAULT_IMAGE_SIZE, seed=DEFAULT_SEED):
+    """
+    Fill top with files JPEGs carrying EXIF blocks as a camera would write,
+    spread round robin over a tree depth directories deep with fanout
+    subdirectories each. The same parameters always produce the same
+    corpus, so a corpus already generated with them is reused.
+    Returns the paths of the files.
+    """
+    parameters = {'files': files, 'depth': depth, 'fanout': fanout, 'image_size': list(image_size), 'seed': seed}
+    directories = _corpus_directories(top, depth, fanout)
+    filepaths = [os.path.join(directories[index % len(directories)], 'DSCF{:05d}.JPG'.format(index))
+                 for index in range(files)]
+
+    marker = os.path.join(top, CORPUS_MARKER)
+    try:
+        with open(marker) as marker_file:
+            if json.load(marker_file) == parameters:
+                return filepaths
+    except FileNotFoundError:
+        # Only a directory the harness generated is ever deleted, never
+        # one that happens to be named by --corpus
+        if os.path.isdir(top) and os.listdir(top):
+            raise ValueError('[{}] is not empty and not a benchmark corpus; '
+                             'name a new or empty directory'.format(top))
+    except (OSError, ValueError):
+        pass
+
+    logger.info('Generating %d files in [%s]', files, top)
+    if os.path.exists(marker):
+        shutil.rmtree(top)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    rng = random.Random(seed)
+    (width, height) = image_size
+    for index, filepath in enumerate(filepaths):
+        # A gradient with a little noise compresses like a photograph rather
+        # than a flat colour
+        base = Image.linear_gradient('L').resize((width, height))
+        noise = Image.effect_noise((width, height), rng.randrange(8, 32))
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.merge('RGB', (base, noise, Image.new('L', (width, height), colour[index % 3])))
+        image.save(filepath, format='JPEG', quality=90, exif=_synthetic_exif(rng, index, image_size))
+
+    with open(marker, 'w') as marker_file:
+        json.dump(parameters, marker_file)
+    return filepaths
+
+
+class BenchmarkResult(object):
+    """
+    Outcome of one benchmark: items processed in seconds, the latency of
+    each item or repetition, and the peak RSS of the process running it
+    """
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.seconds = 0.0
+        self.latencies = instrumentation.Measure()
+        self.peak_rss_bytes = None
+
+    def time(self, items=1):
+        """Context manager timing a block that processes items"""
+        return _Timed(self, items)
+
+    def summary(self):
+        latency = self.latencies.summary()
+        return {
+            'unit': self.unit,
+            'items': self.items,
+            'seconds': self.seconds,
+            'throughput': self.items / self.seconds if self.seconds else None,
+            'p50': latency['p50'],
+            'p99': latency['p99'],
+            'peak_rss_bytes': self.peak_rss_bytes,
+        }
+
+
+class _Timed(object):
+    __slots__ = ('result', 'items', 'started')
+
+    def __init__(self, result, items):
+        self.result = result
+        self.items = items
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        elapsed = time.perf_counter() - self.started
+        if exc_type is None:
+            self.result.items += self.items
+            self.result.seconds += elapsed
+            self.result.latencies.add(elapsed)
+        return False
+
+
+def bench_walk(corpus, filepaths, workdir, repeat):
+    result = BenchmarkResult('walk', 'files')
+    for _ in range(repeat):
+        with result.time(len(filepaths)):
+            aperture.walk_path(corpus, lambda *record: None, aperture.category_req_fixed(aperture.Categories[0]))
+    return result
+
+
+def bench_import(corpus, filepaths, workdir, repeat):
+    result = BenchmarkResult('import', 'files')
+    for repetition in range(repeat):
+        destination = os.path.join(workdir, 'import{}'.format(repetition))
+        with result.time(len(filepaths)):
+            aperture.import_files(corpus, destination, os.path.join('%(category)s', '%(year)d', '%(month)d'),
+                                  category_req=aperture.category_req_fixed(aperture.Categories[0]),
+                                  incremental=False)
+        shutil.rmtree(destination)
+    return result
+
+
+def bench_exif(corpus, filepaths, workdir, repeat):
+    result = BenchmarkResult('exif', 'files')
+    for _ in range(repeat):
+        for filepath in filepaths:
+            with result.time():
+                exifparse.CategorisedExifData(filepath).categorised
+    return result
+
+
+def bench_thumbnail(corpus, filepaths, workdir, repeat):
+    result = BenchmarkResult('thumbnail', 'files')
+    for repetition in range(repeat):
+        cache = thumbnails.ThumbnailCache(os.path.join(workdir, 'thumbnails{}'.format(repetition)))
+        for filepath in filepaths:
+            with result.time():
+                cache.generate(filepath)
+    return result
+
+
+def bench_decode(corpus, filepaths, workdir, repeat):
+    result = BenchmarkResult('decode', 'files')
+    for _ in range(repeat):
+        for filepath in filepaths:
+            with result.time():
+                decoding.to_pixels(decoding.decode_image(filepath, thumbnails.Thumbnail_Sizes[-1]))
+    return result
+
+
+def _catalog_photographs(filepaths, count):
+    """count Photographs, cycling through the metadata of filepaths"""
+    templates = [dao.Photograph.from_categorised(filepath, exifparse.CategorisedExifData(filepath).categorised)
+                 for filepath in filepaths]
+    for index in range(count):
+        template = templates[index % len(templates)]
+        yield dao.Photograph('{}#{}'.format(template.filepath, index), template.filetype, 1,
+                             make=template.make, model=template.model, lens_model=template.lens_model,
+                             captured=template.captured, iso=template.iso, focal_length=template.focal_length)
+
+
+def bench_ingest(corpus, filepaths, workdir, repeat, catalog_size=DEFAULT_CATALOG_SIZE):
+    result = BenchmarkResult('ingest', 'photographs')
+    for repetition in range(repeat):
+        with dao.ZODBDAO(os.path.join(workdir, 'ingest{}.fs'.format(repetition))) as library:
+            with library.bulk_ingest() as ingest:
+                chunk = []
+                for photograph in _catalog_photographs(filepaths, catalog_size):
+                    chunk.append(photograph)
+                    if len(chunk) == ingest.chunk_size:
+                        with result.time(len(chunk)):
+                            ingest.add_many(chunk)
+                        chunk = []
+                with result.time(len(chunk)):
+                    ingest.add_many(chunk)
+                    ingest.commit()
+    return result
+
+
+_Queries = (
+    {'make': 'fujifilm'},
+    {'make': 'fujifilm', 'captured': dao.Range(datetime(2019, 1, 1), datetime(2020, 1, 1), exclude_high=True),
+     'iso': dao.Range(3200, exclude_low=True)},
+    {'model': ['x-t2', 'x100f'], 'focal_length': dao.Range(23.0, 35.0)},
+    {'lens_model': 'xf56mmf1.2 r', 'iso': 800},
+)
+
+
+def bench_query(corpus, filepaths, workdir, repeat, catalog_size=DEFAULT_CATALOG_SIZE):
+    result = BenchmarkResult('query', 'queries')
+    with dao.ZODBDAO(os.path.join(workdir, 'query.fs')) as library:
+        with library.bulk_ingest() as ingest:
+            ingest.add_many(_catalog_photographs(filepaths, catalog_size))
+        catalog = ingest.catalog
+        for _ in range(repeat * 10):
+            for criteria in _Queries:
+                with result.time():
+                    for photograph in catalog.query(**criteria):
+                        pass
+    return result
+
+
+Benchmarks = {
+    'walk': bench_walk,
+    'import': bench_import,
+    'exif': bench_exif,
+    'thumbnail': bench_thumbnail,
+    'decode': bench_decode,
+    'ingest': bench_ingest,
+    'query': bench_query,
+}
+
+
+def _run_isolated(name, corpus, filepaths, repeat):
+    # Runs in a process of its own, so its peak RSS is its own
+    workdir = tempfile.mkdtemp(prefix='picman-benchmark-')
+    try:
+        result = Benchmarks[name](corpus, filepaths, workdir, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result.peak_rss_bytes = dao._peak_rss_bytes()
+    return result.summary()
+
+
+def run_benchmarks(corpus, filepaths, names=None, repeat=3):
+    """
+    Run the named benchmarks, by default all of them, each in a fresh
+    process, returning their summaries by name
+    """
+    results = {}
+    for name in names or Benchmarks:
+        logger.info('Running [%s]', name)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(_run_isolated, name, corpus, filepaths, repeat).result()
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Regressions of results against baseline, as (benchmark, measure,
+    baseline value, result value) for each measure worse by more than
+    tolerance: lower throughput, or higher latency or peak memory
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for measure, higher_is_better in (('throughput', True), ('p50', False), ('p99', False),
+                                          ('peak_rss_bytes', False)):
+            (before, after) = (base.get(measure), result.get(measure))
+            if not before or after is None:
+                continue
+            change = (before - after) / before if higher_is_better else (after - before) / before
+            if change > tolerance:
+                regressions.append((name, measure, before, after))
+    return regressions
+
+
+def format_results(results):
+    lines = ['{:<10} {:>10} {:>14} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'items', 'throughput', 'p50 ms', 'p99 ms', 'peak MB')]
+    for name, result in results.items():
+        lines.append('{:<10} {:>10} {:>14} {:>10.3f} {:>10.3f} {:>10.1f}'.format(
+            name, result['items'], '{:.1f} {}/s'.format(result['throughput'] or 0, result['unit'][:5]),
+            result['p50'] * 1000, result['p99'] * 1000, result['peak_rss_bytes'] / 2 ** 20))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark picman against a synthetic photo corpus.')
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'picman-benchmark-corpus'),
+                        help='directory of the corpus, generated if missing or made with other parameters')
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES, help='JPEGs in the corpus')
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help='levels of directories in the corpus')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT, help='subdirectories per directory')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='seed of the corpus contents')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of each benchmark')
+    parser.add_argument('--only', nargs='+', choices=list(Benchmarks), help='benchmarks to run, by default all')
+    parser.add_argument('--output', help='write the results as JSON to this path')
+    parser.add_argument('--save-baseline', metavar='PATH', help='write the results as the baseline at PATH')
+    parser.add_argument('--compare', metavar='PATH', help='flag regressions against the baseline at PATH')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fractional worsening flagged as a regression')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    try:
+        filepaths = generate_corpus(args.corpus, args.files, args.depth, args.fanout, seed=args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    results = run_benchmarks(args.corpus, filepaths, args.only, args.repeat)
+    print(format_results(results))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as output_file:
+                json.dump(results, output_file, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for name, measure, before, after in regressions:
+            print('REGRESSION {} {}: {:.6g} -> {:.6g}'.format(name, measure, before, after))
+        if regressions:
+            return 1
+        print('No regressions beyond {:.0%}'.format(args.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
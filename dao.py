@@ -1,34 +1,172 @@
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import math
+import os
+import resource
+import sys
+import threading
+import time
+
 import ZODB
 import ZODB.FileStorage
 import transaction
+from BTrees.IIBTree import IISet, IITreeSet, intersection, multiunion
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from BTrees.OOBTree import OOBTree
 from persistent import Persistent
 
+import exifparse
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEY = 'metadata'
+PHOTOGRAPHS_KEY = 'photographs'
+PHOTOGRAPH_IDS_KEY = 'photograph_ids'
+INDEXES_KEY = 'indexes'
+# Connections kept open for reuse by a ZODBDAO once checked in
+DEFAULT_POOL_SIZE = 8
+# Objects kept in the cache of each connection
+DEFAULT_CONNECTION_CACHE_SIZE = 10000
+# Days of history kept by packing, so recent changes can still be undone
+DEFAULT_PACK_RETENTION_DAYS = 7
+# Seconds without activity before MaintenanceScheduler considers packing
+DEFAULT_IDLE_SECONDS = 60
+# Minimum seconds between packs by MaintenanceScheduler
+DEFAULT_PACK_INTERVAL = 24 * 60 * 60
+# Growth of the storage, in bytes, since the last pack below which
+# MaintenanceScheduler doesn't pack
+DEFAULT_PACK_MIN_GROWTH = 16 * 2 ** 20
+# Photographs committed at a time by BulkIngest
+DEFAULT_INGEST_CHUNK_SIZE = 2000
+# Photographs between savepoints within a BulkIngest chunk
+DEFAULT_INGEST_SAVEPOINT_SIZE = 500
+# Number of files whose metadata MetadataCache keeps in memory
+DEFAULT_METADATA_CACHE_SIZE = 4096
+
+
+def _single(value):
+    """The first of a multi-valued EXIF value, or the value itself"""
+    while isinstance(value, (tuple, list)):
+        value = value[0] if value else None
+    return value
+
+
+def _text(value):
+    """value as stripped text, or None if it isn't text or is empty"""
+    value = _single(value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if not isinstance(value, str):
+        return None
+    return value.strip() or None
+
+
+def _number(value):
+    """value as a finite int or float, or None if it isn't one"""
+    value = _single(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    return value
+
+
+# Normalisers of indexed values, which return None for values of the wrong
+# type, so that every key of an index is comparable with the others
+def _normalise_text(value):
+    value = _text(value)
+    return value.casefold() if value is not None else None
+
+
+def _normalise_number(value):
+    return _number(value)
+
+
+def _normalise_datetime(value):
+    return value if isinstance(value, datetime) else None
+
 
 class Photograph(Persistent):
     filepath = None
     filetype = None
     version = None
+    make = None
+    model = None
+    lens_model = None
+    captured = None
+    iso = None
+    focal_length = None
 
-    def __init__(self, filepath, filetype, version):
+    def __init__(self, filepath, filetype, version, make=None, model=None, lens_model=None,
+                 captured=None, iso=None, focal_length=None):
         self.filepath = filepath
         self.filetype = filetype
         self.version = version
+        self.make = make
+        self.model = model
+        self.lens_model = lens_model
+        self.captured = captured
+        self.iso = iso
+        self.focal_length = focal_length
+
+    @classmethod
+    def from_categorised(cls, filepath, categorised, version=1):
+        """
+        Photograph of filepath with the fields a Catalog indexes taken from
+        the raw values of its categorised EXIF metadata
+        """
+        raw = {(category, item.name): item.raw for category, items in categorised.items() for item in items}
+        captured = _text(raw.get(('File', 'Date')))
+        if captured is not None:
+            try:
+                captured = datetime.strptime(captured, '%Y:%m:%d %H:%M:%S')
+            except ValueError:
+                captured = None
+        return cls(filepath, os.path.splitext(filepath)[1].lstrip('.').upper() or None, version,
+                   make=_text(raw.get(('Camera', 'Make'))),
+                   model=_text(raw.get(('Camera', 'Model'))),
+                   lens_model=_text(raw.get(('Lens', 'Model'))),
+                   captured=captured,
+                   iso=_number(raw.get(('Photo', 'ISO'))),
+                   focal_length=_number(raw.get(('Photo', 'Focal Length'))))
 
     def __str__(self):
         return f"Photograph(filepath=[{self.filepath}], filetype=[{self.filetype}], version=[{self.version}])"
 
 
 class ZODBDAO(object):
+    """
+    Access to the library in the FileStorage at filepath.
+
+    The DAO's own connection, behind root, is for the thread that opened
+    it. Other threads check out connections of their own from the pool,
+    each with its own transaction manager, so they neither share a
+    connection nor serialise on one, and check them back in when done.
+    pool_size connections are kept open for reuse, each caching up to
+    cache_size objects.
+
+    With read_only, the storage is opened without taking its lock, so
+    that worker processes can read a library that another process is
+    writing. They see the library as it was when opened, and writing
+    raises ZODB.POSException.ReadOnlyError.
+    """
     _storage = None
     _db = None
     _connection = None
     _root = None
 
-    def __init__(self, filepath):
-        self._storage = ZODB.FileStorage.FileStorage(filepath)
-        self._db = ZODB.DB(storage)
-        self._connection = db.open()
-        self._root = connection.root()
+    def __init__(self, filepath, read_only=False, pool_size=DEFAULT_POOL_SIZE,
+                 cache_size=DEFAULT_CONNECTION_CACHE_SIZE):
+        self.filepath = filepath
+        self.read_only = read_only
+        self.cache_size = cache_size
+        # Packing replaces the file rather than keeping the old one beside it
+        self._storage = ZODB.FileStorage.FileStorage(filepath, read_only=read_only, pack_keep_old=False)
+        self._db = ZODB.DB(self._storage, pool_size=pool_size, cache_size=cache_size)
+        self._connection = self._db.open(transaction_manager=transaction.TransactionManager())
+        self._root = self._connection.root()
 
     def __enter__(self):
         return self
@@ -38,27 +176,697 @@ class ZODBDAO(object):
 
     def close(self):
         self._root = None
+        self._connection.transaction_manager.abort()
         self._connection.close()
         self._db.close()
         self._storage.close()
 
+    def commit(self):
+        """Commit the changes made through root"""
+        self._connection.transaction_manager.commit()
+
+    def abort(self):
+        self._connection.transaction_manager.abort()
+
+    def checkout(self):
+        """
+        A connection from the pool for the calling thread, with its own
+        transaction manager, to be passed to checkin when done
+        """
+        return self._db.open(transaction_manager=transaction.TransactionManager())
+
+    def checkin(self, connection):
+        """Return a connection to the pool, aborting any uncommitted changes"""
+        connection.transaction_manager.abort()
+        connection.close()
+
+    @contextmanager
+    def checked_out(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    @property
+    def storage_size(self):
+        return os.path.getsize(self.filepath)
+
+    def pack(self, retention_days=DEFAULT_PACK_RETENTION_DAYS):
+        """
+        Remove object revisions and unreachable objects older than
+        retention_days from the storage, returning PackStats. Packing runs
+        alongside other connections' reads and commits.
+        """
+        stats = PackStats(self.storage_size)
+        with instrumentation.span('library.pack'):
+            self._db.pack(days=retention_days)
+        stats.finish(self.storage_size)
+        logger.info('Packed [%s]: %s', self.filepath, stats)
+        return stats
+
+    def prewarm(self, keys=(METADATA_KEY, PHOTOGRAPH_IDS_KEY, INDEXES_KEY), connection=None):
+        """
+        Load the BTree buckets of the root's keys, and of the catalog's
+        indexes, into the cache of connection, up to the cache size. Without
+        a connection, a pooled one is warmed and checked back in, so that the
+        next checkout reuses it. Returns the seconds taken.
+        """
+        started = time.monotonic()
+        if connection is None:
+            with self.checked_out() as connection:
+                self._prewarm(connection, keys)
+        else:
+            self._prewarm(connection, keys)
+        elapsed = time.monotonic() - started
+        logger.info('Pre-warmed [%s] in %.3fs', self.filepath, elapsed)
+        return elapsed
+
+    def _prewarm(self, connection, keys):
+        root = connection.root()
+        trees = []
+        for key in keys:
+            tree = root.get(key)
+            if tree is None:
+                continue
+            if key == INDEXES_KEY:
+                for index in tree.values():
+                    trees.extend(index.trees)
+            else:
+                trees.append(tree)
+
+        for tree in trees:
+            if connection._cache.cache_non_ghost_count >= self.cache_size:
+                break
+            for _ in tree.keys():
+                pass
+
+    @property
+    def pool_statistics(self):
+        """(connections checked out, connections available, cached objects)"""
+        pool = self._db.pool
+        return (len(pool.all) - len(pool.available), len(pool.available), self._db.cacheSize())
+
     @property
     def root(self):
         return self._root
 
+    @property
+    def connection(self):
+        return self._connection
+
+    def bulk_ingest(self, chunk_size=DEFAULT_INGEST_CHUNK_SIZE, savepoint_size=DEFAULT_INGEST_SAVEPOINT_SIZE,
+                    connection=None, on_commit=None):
+        """
+        BulkIngest into the Catalog through connection, by default the
+        DAO's own
+        """
+        if connection is None:
+            connection = self._connection
+        return BulkIngest(connection, Catalog(connection.root()), chunk_size, savepoint_size, on_commit)
 
 
-if __name__ == '__main__':
-    PHOTOGRAPHS_KEY = 'photographs'
+def _is_read_only(root):
+    connection = root._p_jar
+    return connection is not None and connection.isReadOnly()
+
+
+def _commit(root):
+    root._p_jar.transaction_manager.commit()
+
+
+class MetadataCache(object):
+    """
+    Parsed EXIF metadata, keyed by file path and checked against the file's
+    size and modification time, so a file is only parsed again once changed.
+
+    The most recently used entries are kept in memory, up to capacity, and
+    every entry is stored in the library as packed tuples, mapped by path
+    to (size, mtime_ns, packed). Changes are written by flush, unless the
+    DAO is read only. The cache checks out a connection of its own, used
+    by whichever thread calls it under a lock, until closed.
+    """
+    def __init__(self, dao, capacity=DEFAULT_METADATA_CACHE_SIZE):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._dao = dao
+        self._connection = dao.checkout()
+        root = self._connection.root()
+        if METADATA_KEY in root:
+            self._store = root[METADATA_KEY]
+        elif dao.read_only:
+            self._store = OOBTree()
+        else:
+            self._store = root[METADATA_KEY] = OOBTree()
+            _commit(root)
+
+    @staticmethod
+    def identity(filepath):
+        stat = os.stat(filepath)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def get(self, filepath, identity=None):
+        """Return the cached metadata for filepath, or None if not current"""
+        if identity is None:
+            identity = self.identity(filepath)
+
+        with self._lock:
+            entry = self._memory.get(filepath)
+            if entry is not None and entry[0] == identity:
+                self._memory.move_to_end(filepath)
+                self.hits += 1
+                return entry[1]
+
+            stored = self._store.get(filepath)
+            if stored is not None and stored[:2] == identity:
+                categorised = exifparse.unpack_categorised(stored[2])
+                self._remember(filepath, identity, categorised)
+                self.hits += 1
+                return categorised
+
+            self.misses += 1
+            return None
+
+    def put(self, filepath, categorised, identity=None):
+        if identity is None:
+            identity = self.identity(filepath)
+
+        with self._lock:
+            self._store[filepath] = identity + (exifparse.pack_categorised(categorised),)
+            self._remember(filepath, identity, categorised)
+
+    def load(self, filepath):
+        """Return the metadata for filepath, parsing and caching it on a miss"""
+        identity = self.identity(filepath)
+        categorised = self.get(filepath, identity)
+        if categorised is None:
+            categorised = exifparse.CategorisedExifData(filepath).categorised
+            self.put(filepath, categorised, identity)
+        return categorised
+
+    def load_many(self, filenames, processes=None):
+        """
+        Yield (filename, categorised) pairs for filenames, cached ones first
+        and then the rest as exifparse.parse_files completes them
+        """
+        missing = []
+        for filename in filenames:
+            try:
+                identity = self.identity(filename)
+            except OSError:
+                continue
+            categorised = self.get(filename, identity)
+            if categorised is None:
+                missing.append((filename, identity))
+            else:
+                yield (filename, categorised)
+
+        if missing:
+            identities = dict(missing)
+            for filename, categorised in exifparse.parse_files(identities, processes):
+                self.put(filename, categorised, identities[filename])
+                yield (filename, categorised)
+            self.flush()
+
+    def prewarm(self):
+        """Load the stored metadata's index into the cache's connection"""
+        with self._lock:
+            return self._dao.prewarm((METADATA_KEY,), self._connection)
+
+    def flush(self):
+        if self._dao.read_only:
+            return
+        with self._lock, instrumentation.span('metadata.commit'):
+            self._connection.transaction_manager.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self.flush()
+                self._dao.checkin(self._connection)
+                self._connection = None
+
+    def _remember(self, filepath, identity, categorised):
+        self._memory[filepath] = (identity, categorised)
+        self._memory.move_to_end(filepath)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+
+Range = namedtuple('Range', ('low', 'high', 'exclude_low', 'exclude_high'))
+Range.__new__.__defaults__ = (None, None, False, False)
+Range.__doc__ = """
+Catalog query criterion matching values from low to high, either of which
+may be None for no bound, and each included unless excluded
+"""
+
+
+class FieldIndex(Persistent):
+    """
+    Index of the photograph ids having each value of a field, ordered by
+    value so that equality and range lookups read only the matching ids.
+    Values are keyed as given, so must already be comparable with each
+    other; Catalog normalises them first.
+    """
+    def __init__(self):
+        # Value to the ids of the photographs with it
+        self._forward = OOBTree()
+        # Id to the value it's indexed under, for unindexing
+        self._reverse = IOBTree()
+
+    def __len__(self):
+        return len(self._reverse)
+
+    @property
+    def trees(self):
+        return (self._forward, self._reverse)
+
+    def index(self, photograph_id, value):
+        if self._reverse.get(photograph_id) == value and value is not None:
+            return
+        self.unindex(photograph_id)
+        if value is None:
+            return
+        ids = self._forward.get(value)
+        if ids is None:
+            ids = self._forward[value] = IITreeSet()
+        ids.insert(photograph_id)
+        self._reverse[photograph_id] = value
+
+    def unindex(self, photograph_id):
+        value = self._reverse.pop(photograph_id, None)
+        if value is None:
+            return
+        ids = self._forward[value]
+        ids.remove(photograph_id)
+        if not ids:
+            del self._forward[value]
+
+    def values(self):
+        return self._forward.keys()
+
+    def equals(self, value):
+        ids = self._forward.get(value)
+        return ids if ids is not None else IISet()
+
+    def any_of(self, values):
+        return multiunion([self.equals(value) for value in values])
 
-    def list_photographs(root):
-        pass
+    def range(self, criterion):
+        return multiunion(list(self._forward.values(
+            criterion.low, criterion.high, excludemin=criterion.exclude_low, excludemax=criterion.exclude_high)))
 
-    def add_photograph(root, photograph):
-        pass
+    def lookup(self, criterion):
+        """
+        Ids matching criterion: a Range, a list, set or frozenset of values
+        any of which match, or a single value to match
+        """
+        if isinstance(criterion, Range):
+            return self.range(criterion)
+        if isinstance(criterion, (list, set, frozenset)):
+            return self.any_of(criterion)
+        return self.equals(criterion)
+
+
+class QueryResult(object):
+    """
+    Photographs matching a Catalog query. The matching ids are found up
+    front from the indexes, but each photograph is loaded only as iterated.
+    """
+    def __init__(self, photographs, ids):
+        self._photographs = photographs
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for photograph_id in self._ids:
+            yield self._photographs[photograph_id]
+
+    @property
+    def ids(self):
+        return self._ids
+
+
+class Catalog(object):
+    """
+    Photographs of the library kept in the DAO's root, by id in an IOBTree
+    and by file path in an OIBTree, with a FieldIndex per Indexed_Fields
+    attribute.
+
+    query combines criteria on indexed fields by intersecting the ids each
+    matches, smallest first, so that no query scans the photographs. Values
+    are indexed and matched as the field's normaliser in Indexed_Fields
+    keys them, so text fields match regardless of case and surrounding
+    whitespace, and a value it can't key isn't indexed.
+    Changes, including those to a photograph's indexed attributes, which
+    must be followed by another add, are stored once the transaction is
+    committed.
+    """
+    Indexed_Fields = OrderedDict([
+        ('filetype', _normalise_text),
+        ('make', _normalise_text),
+        ('model', _normalise_text),
+        ('lens_model', _normalise_text),
+        ('captured', _normalise_datetime),
+        ('iso', _normalise_number),
+        ('focal_length', _normalise_number),
+    ])
+
+    def __init__(self, root):
+        # A read only root can't be added to, so anything missing from it
+        # is kept in memory instead, as an empty catalog
+        store = dict(root) if _is_read_only(root) else root
+        created = False
+        if PHOTOGRAPHS_KEY not in store or not isinstance(store[PHOTOGRAPHS_KEY], IOBTree):
+            store[PHOTOGRAPHS_KEY] = IOBTree()
+            store[PHOTOGRAPH_IDS_KEY] = OIBTree()
+            store[INDEXES_KEY] = OOBTree()
+            created = True
+        indexes = store[INDEXES_KEY]
+        for field in self.Indexed_Fields:
+            if field not in indexes:
+                indexes[field] = FieldIndex()
+                created = True
+        if created and store is root:
+            _commit(root)
+
+        self._photographs = store[PHOTOGRAPHS_KEY]
+        self._ids = store[PHOTOGRAPH_IDS_KEY]
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, filepath):
+        return filepath in self._ids
+
+    def get(self, filepath):
+        photograph_id = self._ids.get(filepath)
+        return self._photographs[photograph_id] if photograph_id is not None else None
+
+    def add(self, photograph):
+        """
+        Add photograph, replacing any with the same file path, or re-index
+        it after a change. Returns its id.
+        """
+        photograph_id = self._ids.get(photograph.filepath)
+        if photograph_id is None:
+            photograph_id = self._photographs.maxKey() + 1 if self._photographs else 1
+            self._ids[photograph.filepath] = photograph_id
+        self._photographs[photograph_id] = photograph
+        for field, normalise in self.Indexed_Fields.items():
+            self._indexes[field].index(photograph_id, normalise(getattr(photograph, field, None)))
+        return photograph_id
+
+    def add_file(self, filepath, categorised=None):
+        """Add the photograph at filepath, parsing its metadata if not given"""
+        if categorised is None:
+            categorised = exifparse.CategorisedExifData(filepath).categorised
+        return self.add(Photograph.from_categorised(filepath, categorised))
+
+    def remove(self, filepath):
+        photograph_id = self._ids.pop(filepath, None)
+        if photograph_id is None:
+            return False
+        for index in self._indexes.values():
+            index.unindex(photograph_id)
+        del self._photographs[photograph_id]
+        return True
+
+    def query(self, **criteria):
+        """
+        Photographs whose indexed fields match every criterion, given by
+        field name as for FieldIndex.lookup, e.g.
+        query(make='fujifilm', captured=Range(datetime(2019, 1, 1), datetime(2020, 1, 1), exclude_high=True),
+              iso=Range(3200, exclude_low=True))
+
+        Raises TypeError for a tuple given as a value, and ValueError for a
+        value or Range bound the field's normaliser can't key, such as text
+        for a number, rather than matching nothing or, as a bound,
+        everything.
+        """
+        unknown = set(criteria) - set(self.Indexed_Fields)
+        if unknown:
+            raise ValueError('Not indexed: {}'.format(', '.join(sorted(unknown))))
+        if not criteria:
+            return QueryResult(self._photographs, self._photographs.keys())
+
+        matches = sorted((self._indexes[field].lookup(self._criterion(field, criterion))
+                          for field, criterion in criteria.items()), key=len)
+        ids = matches[0]
+        for other in matches[1:]:
+            if not ids:
+                break
+            ids = intersection(ids, other)
+        return QueryResult(self._photographs, ids)
+
+    def values(self, field):
+        """The distinct indexed values of field, in order"""
+        return self._indexes[field].values()
+
+    def _criterion(self, field, criterion):
+        """criterion with its values as field's index keys them"""
+        if isinstance(criterion, Range):
+            return criterion._replace(
+                low=self._key(field, criterion.low) if criterion.low is not None else None,
+                high=self._key(field, criterion.high) if criterion.high is not None else None)
+        if isinstance(criterion, (list, set, frozenset)):
+            return [self._key(field, value) for value in criterion]
+        return self._key(field, criterion)
+
+    def _key(self, field, value):
+        if isinstance(value, (tuple, list, set, frozenset)):
+            raise TypeError('Values of {} are matched singly, not as {!r}; '
+                            'give a list, set or frozenset to match any of several'.format(field, value))
+        key = self.Indexed_Fields[field](value)
+        if key is None:
+            raise ValueError('{!r} is not a value of {}'.format(value, field))
+        return key
+
+
+class PackStats(object):
+    """Sizes of a storage before and after a pack, and the time it took"""
+    def __init__(self, size_before):
+        self.started = time.monotonic()
+        self.size_before = size_before
+        self.size_after = None
+        self.seconds = None
+
+    def finish(self, size_after):
+        self.size_after = size_after
+        self.seconds = time.monotonic() - self.started
+
+    @property
+    def reclaimed(self):
+        return self.size_before - self.size_after
+
+    def __str__(self):
+        return (f"{self.size_before / 2 ** 20:.1f}MB to {self.size_after / 2 ** 20:.1f}MB "
+                f"({self.reclaimed / 2 ** 20:.1f}MB reclaimed) in {self.seconds:.1f}s")
+
+
+class MaintenanceScheduler(object):
+    """
+    Background thread packing a ZODBDAO's storage while the app is idle:
+    once nothing has called touch for idle_seconds, is_busy, if given,
+    returns false, interval seconds have passed since the last pack and the
+    storage has grown by min_growth bytes since then. A pack is never
+    interrupted, but close waits for it to finish.
+
+    history holds the PackStats of each pack.
+    """
+    def __init__(self, dao, idle_seconds=DEFAULT_IDLE_SECONDS, interval=DEFAULT_PACK_INTERVAL,
+                 retention_days=DEFAULT_PACK_RETENTION_DAYS, min_growth=DEFAULT_PACK_MIN_GROWTH,
+                 is_busy=None):
+        self.dao = dao
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.retention_days = retention_days
+        self.min_growth = min_growth
+        self.is_busy = is_busy
+        self.history = []
+        self._last_activity = time.monotonic()
+        # No pack yet this session, so the first is due as soon as idle
+        self._last_pack = None
+        self._size_after_pack = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='MaintenanceScheduler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def touch(self):
+        """Note activity, postponing maintenance until idle again"""
+        self._last_activity = time.monotonic()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _seconds_until_due(self):
+        now = time.monotonic()
+        wait = self._last_activity + self.idle_seconds - now
+        if self._last_pack is not None:
+            wait = max(wait, self._last_pack + self.interval - now)
+        return wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                wait = self._seconds_until_due()
+                while not self._closed and wait > 0:
+                    self._condition.wait(wait)
+                    wait = self._seconds_until_due()
+                if self._closed:
+                    return
+
+            if self.is_busy is not None and self.is_busy():
+                self.touch()
+                continue
+            if self.dao.storage_size - self._size_after_pack < self.min_growth:
+                # Not worth packing; check again after another interval
+                self._last_pack = time.monotonic()
+                continue
+
+            try:
+                stats = self.dao.pack(self.retention_days)
+            except Exception as e:
+                logger.warning('Failed to pack [%s]: %s: %s', self.dao.filepath, e.__class__.__name__, e)
+                stats = None
+            self._last_pack = time.monotonic()
+            if stats is not None:
+                self._size_after_pack = stats.size_after
+                self.history.append(stats)
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class IngestStats(object):
+    """Progress of a BulkIngest, updated at each savepoint and commit"""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.photographs = 0
+        self.savepoints = 0
+        self.commits = 0
+        # Non-ghost objects in the database's caches after the last commit
+        self.cached_objects = 0
+        self.peak_rss_bytes = _peak_rss_bytes()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def photographs_per_second(self):
+        elapsed = self.elapsed
+        return self.photographs / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return (f"{self.photographs} photographs in {self.elapsed:.1f}s "
+                f"({self.photographs_per_second:.0f}/s), {self.commits} commits, {self.savepoints} savepoints, "
+                f"{self.cached_objects} cached objects, peak RSS {self.peak_rss_bytes / 2 ** 20:.1f}MB")
+
+
+class BulkIngest(object):
+    """
+    Adds many photographs to a Catalog in chunks, committing every
+    chunk_size photographs rather than each or all at once, so that memory
+    stays flat however many there are.
+
+    Within a chunk, a savepoint every savepoint_size photographs moves the
+    changes so far out of memory into the storage's temporary file, and
+    after each commit the connection's cache is minimised, releasing the
+    objects the chunk loaded. On leaving the with block, the last chunk is
+    committed, or aborted if leaving with an exception; earlier chunks stay
+    committed. on_commit, if given, is called after each commit, e.g. to
+    checkpoint what has been stored.
+    """
+    def __init__(self, connection, catalog, chunk_size=DEFAULT_INGEST_CHUNK_SIZE,
+                 savepoint_size=DEFAULT_INGEST_SAVEPOINT_SIZE, on_commit=None):
+        if chunk_size < 1 or savepoint_size < 1:
+            raise ValueError('chunk_size and savepoint_size must be positive')
+        self.connection = connection
+        self._transaction_manager = connection.transaction_manager
+        self.catalog = catalog
+        self.chunk_size = chunk_size
+        self.savepoint_size = savepoint_size
+        self.on_commit = on_commit
+        self.stats = IngestStats()
+        self._in_chunk = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._transaction_manager.abort()
+            self._in_chunk = 0
+        self.stats.finished = time.monotonic()
+
+    def add(self, photograph):
+        photograph_id = self.catalog.add(photograph)
+        self.stats.photographs += 1
+        self._in_chunk += 1
+        if self._in_chunk >= self.chunk_size:
+            self.commit()
+        elif self._in_chunk % self.savepoint_size == 0:
+            self._transaction_manager.savepoint(optimistic=True)
+            self.stats.savepoints += 1
+        return photograph_id
+
+    def add_file(self, filepath, categorised=None):
+        if categorised is None:
+            categorised = exifparse.CategorisedExifData(filepath).categorised
+        return self.add(Photograph.from_categorised(filepath, categorised))
+
+    def add_many(self, photographs):
+        for photograph in photographs:
+            self.add(photograph)
+        return self.stats
+
+    def commit(self):
+        """Commit the current chunk, if any, and minimise the cache"""
+        if self._in_chunk:
+            with instrumentation.span('catalog.commit'):
+                self._transaction_manager.commit()
+            self.stats.commits += 1
+            self._in_chunk = 0
+            if self.on_commit is not None:
+                self.on_commit()
+        self.connection.cacheMinimize()
+        self.stats.cached_objects = self.connection.db().cacheSize()
+        self.stats.peak_rss_bytes = _peak_rss_bytes()
+
+
+if __name__ == '__main__':
+    # The library is used through the dao module, so its objects must be
+    # stored as dao's classes rather than __main__'s
+    from dao import Catalog, ZODBDAO
 
     with ZODBDAO('photolibrary.fs') as dao:
-        root = dao.root
-        if not root.has_key(PHOTOGRAPHS_KEY):
-            root[PHOTOGRAPHS_KEY] = {}
-        photographs = root[PHOTOGRAPHS_KEY]
+        with dao.bulk_ingest() as ingest:
+            for filepath in sys.argv[1:]:
+                ingest.add_file(os.path.abspath(filepath))
+        print(ingest.stats)
+
+        catalog = ingest.catalog
+        print(f'{len(catalog)} photographs')
+        for field in Catalog.Indexed_Fields:
+            print(f'{field}: {list(catalog.values(field))}')
@@ -0,0 +1,146 @@
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+
+# Quality tiers for decoding RAW files, fastest first
+RAW_PREVIEW = 'preview'
+RAW_DETAIL = 'detail'
+RAW_FULL = 'full'
+Raw_Tiers = (RAW_PREVIEW, RAW_DETAIL, RAW_FULL)
+
+# Kivy colour formats of the PIL image modes that can be uploaded unconverted
+_Texture_Formats = {'RGB': 'rgb', 'RGBA': 'rgba', 'L': 'luminance'}
+# Kivy colour formats by the number of channels in a pixel array
+_Array_Formats = {1: 'luminance', 3: 'rgb', 4: 'rgba'}
+
+
+def pixels_from_pil(image):
+    """
+    (width, height, colorfmt, buffer) of a PIL image's pixels, converting
+    only modes a texture can't take
+    """
+    if image.mode == '1':
+        image = image.convert('L')
+    elif image.mode not in _Texture_Formats:
+        image = image.convert('RGB')
+    return (image.width, image.height, _Texture_Formats[image.mode], memoryview(image.tobytes()))
+
+
+def pixels_from_array(pixels):
+    """
+    (width, height, colorfmt, buffer) of a uint8 NumPy array shaped
+    (height, width) or (height, width, channels), as rawpy produces,
+    sharing its memory where it is already contiguous
+    """
+    (height, width) = pixels.shape[:2]
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    if not pixels.flags['C_CONTIGUOUS']:
+        pixels = pixels.copy()
+    return (width, height, _Array_Formats[channels], memoryview(pixels).cast('B'))
+
+
+def to_pixels(decoded):
+    """(width, height, colorfmt, buffer) of a PIL image or NumPy array"""
+    import PIL.Image
+    if isinstance(decoded, PIL.Image.Image):
+        return pixels_from_pil(decoded)
+    return pixels_from_array(decoded)
+
+
+def decode_image(filename, size=None, mode=None):
+    """
+    Decode an image PIL can open, fully loaded so the file is closed. With
+    size, JPEGs are scaled down while decoding to no less than size pixels
+    on each edge. With mode, the image is converted to that PIL mode.
+    """
+    # PIL is imported where it is used, so importing this module, as the
+    # app does before its first frame, doesn't load it
+    import PIL.Image
+
+    with PIL.Image.open(filename) as image:
+        if size is not None:
+            image.draft(image.mode, (size, size))
+        image.load()
+        if mode is not None and image.mode != mode:
+            return image.convert(mode)
+        return image
+
+
+def decode_raw(filename, tier=RAW_PREVIEW):
+    """
+    Decode a RAW file at one of the quality tiers, returning a PIL image or
+    an RGB NumPy array:
+
+    RAW_PREVIEW extracts the embedded thumbnail without demosaicing, falling
+    back to RAW_DETAIL for files without a usable one
+    RAW_DETAIL demosaics at half size with the fast linear algorithm
+    RAW_FULL runs the full postprocessing pipeline at full size
+
+    The LibRaw handle is released before returning.
+    """
+    if tier not in Raw_Tiers:
+        raise ValueError('Parameter "tier" must be one of: {}'.format(', '.join(Raw_Tiers)))
+
+    # Imported on first use, as LibRaw and NumPy are slow to load and most
+    # processes never open a RAW file
+    import rawpy
+
+    with rawpy.imread(filename) as raw:
+        if tier == RAW_PREVIEW:
+            try:
+                thumb = raw.extract_thumb()
+            except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                tier = RAW_DETAIL
+            else:
+                if thumb.format == rawpy.ThumbFormat.JPEG:
+                    import PIL.Image
+                    image = PIL.Image.open(BytesIO(thumb.data))
+                    image.load()
+                    return image
+                return thumb.data
+
+        if tier == RAW_DETAIL:
+            return raw.postprocess(half_size=True, demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR)
+
+        return raw.postprocess()
+
+
+def decode_to_shared_memory(filename, size=None, mode=None, raw_tier=None):
+    """
+    Decode filename, with decode_raw at raw_tier if given or decode_image
+    otherwise, into a new block of shared memory, so a worker process can
+    return megabytes of pixels without pickling them. Returns (name, width,
+    height, colorfmt, length); whoever receives it must unlink the block.
+    """
+    if raw_tier is not None:
+        decoded = decode_raw(filename, raw_tier)
+    else:
+        decoded = decode_image(filename, size, mode)
+    (width, height, colorfmt, buffer) = to_pixels(decoded)
+
+    length = len(buffer)
+    block = shared_memory.SharedMemory(create=True, size=max(1, length))
+    # Ownership passes to the receiver, so stop this process's resource
+    # tracker from unlinking the block when the worker exits
+    resource_tracker.unregister(block._name, 'shared_memory')
+    try:
+        block.buf[:length] = buffer
+        return (block.name, width, height, colorfmt, length)
+    finally:
+        block.close()
+
+
+def read_shared_memory(name, length, reader):
+    """
+    Call reader with a memoryview of the first length bytes of the shared
+    memory block name, then release and unlink the block, returning what
+    reader returns. With no reader, the block is only unlinked.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        if reader is None:
+            return None
+        with block.buf[:length] as view:
+            return reader(view)
+    finally:
+        block.close()
+        block.unlink()
@@ -1,7 +1,16 @@
 from collections import OrderedDict
 from datetime import datetime
+from functools import partial
+import logging
 import math
-import exif
+import multiprocessing
+import exifreader
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Number of files handed to a worker process at a time by parse_files
+DEFAULT_CHUNKSIZE = 16
 
 def metering_mode_to_description(mm):
     metering_modes = {
@@ -87,32 +96,18 @@ def flash_to_description(f):
 
 
 class ExifDataItem:
-    __name = None
-    __data = None
-    __cols = None
-    __rows = None
-
-    def __init__(self, name, data, cols=1, rows=1):
-        self.__name = name
-        self.__data = data
-        self.__cols = cols
-        self.__rows = rows
-
-    @property
-    def name(self):
-        return self.__name
-
-    @property
-    def data(self):
-        return self.__data
+    __slots__ = ('name', 'data', 'cols', 'rows', 'raw')
 
-    @property
-    def cols(self):
-        return self.__cols
+    def __init__(self, name, data, cols=1, rows=1, raw=None):
+        self.name = name
+        self.data = data
+        self.cols = cols
+        self.rows = rows
+        # Value(s) as read from the file, before formatting
+        self.raw = raw
 
-    @property
-    def rows(self):
-        return self.__rows
+    def __reduce__(self):
+        return (ExifDataItem, (self.name, self.data, self.cols, self.rows, self.raw))
 
     def __str__(self):
         return f"ExifDataItem {{name=[{self.name}], data=[{self.data}], cols=[{self.cols}], rows=[{self.rows}]}}"
@@ -138,18 +133,9 @@ class ExifParserItem(ExifParserBase):
         super().__init__(alias, function, cols, rows)
         self.name = name
 
-    def parse(self, exif_data):
-        data = exif_data.get(self.name)
-
-        if data is None:
-            return None
-
-        if self.function is not None:
-            data = self.function(data)
-
-        del exif_data[self.name]
-
-        return ExifDataItem(self.alias or self.name, data, self.cols, self.rows)
+    @property
+    def names(self):
+        return (self.name,)
 
 
 class ExifParserPair(ExifParserBase):
@@ -163,22 +149,66 @@ class ExifParserPair(ExifParserBase):
         else:
             raise Exception('Parameter "names" must be a tuple or list of two items only')
 
-    def parse(self, exif_data):
-        data_a = exif_data.get(self.name_a)
-        data_b = exif_data.get(self.name_b)
-
-        if data_a is None and data_b is None:
-            return None
-
-        if self.function is not None:
-            data = self.function(data_a, data_b)
-        else:
-            data = (data_a, data_b)
-
-        del exif_data[data_a]
-        del exif_data[data_b]
-
-        return ExifDataItem(self.alias, data, self.cols, self.rows)
+    @property
+    def names(self):
+        return (self.name_a, self.name_b)
+
+
+class ExtractionPlan:
+    """
+    A category table compiled into a flat mapping of EXIF tag id to the
+    category slots it fills, so that extraction is a single pass over the
+    decoded tags rather than a lookup per item.
+
+    Each target is (category index, slot index, position, alias, function,
+    cols, rows), where position is None for an item and 0 or 1 for either
+    half of a pair.
+    """
+    __slots__ = ('categories', 'slot_counts', 'tags', 'pairs')
+
+    def __init__(self, categories):
+        self.categories = tuple(categories.keys())
+        self.slot_counts = tuple(len(items) for items in categories.values())
+        targets = {}
+        self.pairs = {}
+        for category_index, items in enumerate(categories.values()):
+            for slot_index, item in enumerate(items):
+                names = item.names
+                for position, name in enumerate(names):
+                    target = (category_index, slot_index, position if len(names) == 2 else None,
+                              item.alias or name, item.function, item.cols, item.rows)
+                    targets.setdefault(exifreader.Tags[name], []).append(target)
+                if len(names) == 2:
+                    self.pairs[(category_index, slot_index)] = (item.alias, item.function, item.cols, item.rows)
+        # Tag id to its targets, in the form exifreader.read_exif takes
+        self.tags = {tag: tuple(tag_targets) for tag, tag_targets in targets.items()}
+
+    def apply(self, values):
+        """
+        Build the categorised mapping from values, as returned by
+        exifreader.read_exif for tags, in the table's order
+        """
+        slots = [[None] * count for count in self.slot_counts]
+        halves = {}
+        for targets, value in values.items():
+            for category_index, slot_index, position, alias, function, cols, rows in targets:
+                if position is None:
+                    data = function(value) if function is not None else value
+                    slots[category_index][slot_index] = ExifDataItem(alias, data, cols, rows, value)
+                else:
+                    halves.setdefault((category_index, slot_index), [None, None])[position] = value
+
+        for key, (data_a, data_b) in halves.items():
+            (alias, function, cols, rows) = self.pairs[key]
+            if function is not None:
+                if data_a is None or data_b is None:
+                    continue
+                data = function(data_a, data_b)
+            else:
+                data = (data_a, data_b)
+            slots[key[0]][key[1]] = ExifDataItem(alias, data, cols, rows, (data_a, data_b))
+
+        return OrderedDict(zip(self.categories, ([i for i in items if i is not None] for items in slots)))
 
 
 _Categories = OrderedDict([
@@ -215,23 +245,143 @@ _Categories = OrderedDict([
     # ))
 ])
 
+_Plan = ExtractionPlan(_Categories)
+
 
 class CategorisedExifData:
     def __init__(self, filename):
-        self.__categorised = OrderedDict()
-        with open(filename, 'rb') as image_file:
-            exif_data = exif.Image(image_file)
-            if exif_data.has_exif:
-                self.__parse(exif_data)
-                self.__print(exif_data)
-
-    def __parse(self, exif_data):
-        for category_name, items in _Categories.items():
-            self.__categorised[category_name] = [e for e in (i.parse(exif_data) for i in items) if e]
-
-    def __print(self, exif_data):
-        pass
+        with instrumentation.span('exif.parse'):
+            values = exifreader.read_exif(filename, _Plan.tags)
+            self.__categorised = _Plan.apply(values) if values is not None else OrderedDict()
 
     @property
     def categorised(self):
         return self.__categorised
+
+
+# Fields of a summary shown as the range of their values, by category and
+# alias; any other field that differs between pictures just says so
+Ranged_Fields = frozenset((
+    ('Photo', 'ISO'),
+    ('Photo', 'Aperture'),
+    ('Photo', 'Focal Length'),
+    ('Photo', 'Focal Length (35mm)'),
+    ('Photo', 'Exposure Time'),
+    ('Photo', 'Exposure Bias'),
+    ('File', 'Date'),
+))
+_Date_Fields = frozenset((('File', 'Date'),))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value)
+
+
+def _date_range(lowest, highest):
+    """Two-line range between EXIF datetimes, times shown only within a day"""
+    (low_date, low_time) = lowest.split(' ', 1)
+    (high_date, high_time) = highest.split(' ', 1)
+    if low_date == high_date:
+        return f"{low_date.replace(':', '-')}\n{low_time[:5]} \u2013 {high_time[:5]}"
+    return f"{low_date.replace(':', '-')} \u2013\n{high_date.replace(':', '-')}"
+
+
+def _summarise_items(category, items):
+    """
+    One ExifDataItem standing for the same field of several pictures: its
+    value where they all agree, the range between the lowest and highest raw
+    values for the Ranged_Fields, or otherwise a count of distinct values
+    """
+    first = items[0]
+    distinct = set(str(item.data) for item in items)
+    if len(distinct) == 1:
+        return ExifDataItem(first.name, first.data, first.cols, first.rows, first.raw)
+
+    field = (category, first.name)
+    raws = [item.raw for item in items]
+    if field in _Date_Fields and all(isinstance(raw, str) and ' ' in raw for raw in raws):
+        (lowest, highest) = (min(raws), max(raws))
+        return ExifDataItem(first.name, _date_range(lowest, highest), first.cols, 2, (lowest, highest))
+    if field in Ranged_Fields and all(_is_number(raw) for raw in raws):
+        lowest = min(items, key=lambda item: item.raw)
+        highest = max(items, key=lambda item: item.raw)
+        data = f"{lowest.data} \u2013 {highest.data}"
+        return ExifDataItem(first.name, data, first.cols, first.rows, (lowest.raw, highest.raw))
+
+    return ExifDataItem(first.name, f"varies ({len(distinct)} values)", first.cols, 1, None)
+
+
+def summarise_categorised(categorised_list):
+    """
+    Summarise the categorised mappings of several pictures as one, in the
+    same form, with an item per field any of them has
+    """
+    fields = OrderedDict()
+    for categorised in categorised_list:
+        for category, items in categorised.items():
+            category_fields = fields.setdefault(category, OrderedDict())
+            for item in items:
+                category_fields.setdefault(item.name, []).append(item)
+
+    return OrderedDict(
+        (category, [_summarise_items(category, items) for items in category_fields.values()])
+        for category, category_fields in fields.items())
+
+
+def pack_categorised(categorised):
+    """
+    Compact, picklable form of a categorised mapping, as nested tuples of
+    plain values rather than ExifDataItem objects
+    """
+    return tuple(
+        (category, tuple((i.name, i.data, i.cols, i.rows, i.raw) for i in items))
+        for category, items in categorised.items())
+
+
+def unpack_categorised(packed):
+    return OrderedDict(
+        (category, [ExifDataItem(*item) for item in items])
+        for category, items in packed)
+
+
+def worker_context(preload=()):
+    """
+    Multiprocessing context for pools of worker processes. Pools are started
+    from processes with threads running, Kivy's, the library's, the
+    scanner's, and a forked child inherits whatever locks those threads
+    held, so workers are forked from a forkserver instead, or spawned where
+    there is none. The forkserver imports this module and preload once, so
+    that workers start with them loaded; only the first pool started in a
+    process decides what the forkserver imports.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__, *preload])
+    return context
+
+
+def _parse_file(filename, instrument=False):
+    with instrumentation.collecting(instrument) as spans:
+        try:
+            categorised = CategorisedExifData(filename).categorised
+        except Exception as e:
+            logger.warning('Failed to parse EXIF of [%s]: %s: %s', filename, e.__class__.__name__, e)
+            categorised = OrderedDict()
+    return (filename, categorised, spans)
+
+
+def parse_files(filenames, processes=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Parse the EXIF of many files across a pool of processes, yielding
+    (filename, categorised) pairs as they complete, which is not necessarily
+    the order of filenames. Files that fail to parse yield empty categories.
+
+    processes is the optional number of worker processes, by default one per CPU
+    chunksize is the number of files sent to a worker at a time
+    """
+    parse = partial(_parse_file, instrument=instrumentation.enabled())
+    with worker_context().Pool(processes) as pool:
+        for filename, categorised, spans in pool.imap_unordered(parse, filenames, chunksize):
+            instrumentation.record_spans(spans)
+            yield (filename, categorised)
@@ -0,0 +1,264 @@
+import struct
+
+# Tag ids of the EXIF fields picman reads, by the attribute names the exif
+# package gives them
+Tags = {
+    'make': 0x010F,
+    'model': 0x0110,
+    'software': 0x0131,
+    'exposure_time': 0x829A,
+    'f_number': 0x829D,
+    'exposure_program': 0x8822,
+    'photographic_sensitivity': 0x8827,
+    'datetime_original': 0x9003,
+    'exposure_bias_value': 0x9204,
+    'max_aperture_value': 0x9205,
+    'metering_mode': 0x9207,
+    'flash': 0x9209,
+    'focal_length': 0x920A,
+    'pixel_x_dimension': 0xA002,
+    'pixel_y_dimension': 0xA003,
+    'focal_length_in_35mm_film': 0xA405,
+    'lens_specification': 0xA432,
+    'lens_make': 0xA433,
+    'lens_model': 0xA434,
+    'lens_serial_number': 0xA435,
+}
+
+EXIF_IFD_POINTER = 0x8769
+# Tags of IFD1 locating the thumbnail JPEG within the TIFF structure
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+
+JPEG_SOI = b'\xff\xd8'
+RAF_MAGIC = b'FUJIFILMCCD-RAW '
+# Offset in a RAF header of the big-endian offset and length of its JPEG
+RAF_JPEG_POINTER = 84
+EXIF_HEADER = b'Exif\x00\x00'
+
+# TIFF field types, as (struct format, size in bytes)
+_Field_Types = {
+    1: ('B', 1),    # BYTE
+    2: ('s', 1),    # ASCII
+    3: ('H', 2),    # SHORT
+    4: ('L', 4),    # LONG
+    5: ('LL', 8),   # RATIONAL
+    6: ('b', 1),    # SBYTE
+    7: ('B', 1),    # UNDEFINED
+    8: ('h', 2),    # SSHORT
+    9: ('l', 4),    # SLONG
+    10: ('ll', 8),  # SRATIONAL
+    11: ('f', 4),   # FLOAT
+    12: ('d', 8),   # DOUBLE
+}
+
+# JPEG markers that stand alone, without a length
+_Standalone_Markers = frozenset([0x01] + list(range(0xD0, 0xD8)))
+# Markers after which no further metadata segments are expected
+_End_Markers = frozenset((0xD9, 0xDA))
+
+
+class ExifReaderError(Exception):
+    pass
+
+
+def _jpeg_location(image_file):
+    """
+    (offset, length) in image_file of its JPEG stream: the whole of a JPEG,
+    with length None, or the embedded preview of a Fuji RAF
+    """
+    header = image_file.read(len(RAF_MAGIC))
+    if header.startswith(JPEG_SOI):
+        return (0, None)
+    if header == RAF_MAGIC:
+        image_file.seek(RAF_JPEG_POINTER)
+        return struct.unpack('>II', image_file.read(8))
+    return (None, None)
+
+
+def _find_segment(image_file, wanted_marker, prefix):
+    """
+    Walk the JPEG segments from the current position, seeking past each one,
+    until finding a wanted_marker segment starting with prefix. Returns the
+    (offset, data) of that segment's contents after the prefix, or None.
+    """
+    if image_file.read(2) != JPEG_SOI:
+        return None
+
+    while True:
+        byte = image_file.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        # Any number of 0xFF fill bytes may precede the marker
+        marker = 0xFF
+        while marker == 0xFF:
+            byte = image_file.read(1)
+            if not byte:
+                return None
+            marker = byte[0]
+
+        if marker in _End_Markers:
+            return None
+        if marker in _Standalone_Markers or marker == 0x00:
+            continue
+
+        length_bytes = image_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length,) = struct.unpack('>H', length_bytes)
+
+        if marker == wanted_marker:
+            start = image_file.tell()
+            data = image_file.read(length - 2)
+            if data.startswith(prefix):
+                return (start + len(prefix), data[len(prefix):])
+        else:
+            image_file.seek(length - 2, 1)
+
+
+def read_exif_segment(image_file):
+    """
+    Return the TIFF structure from the EXIF APP1 segment of image_file, a JPEG
+    or Fuji RAF opened for binary reading, or None if it has no EXIF. Only the
+    segment headers are read on the way to it.
+    """
+    (offset, length) = _jpeg_location(image_file)
+    if offset is None:
+        return None
+    image_file.seek(offset)
+    segment = _find_segment(image_file, 0xE1, EXIF_HEADER)
+    return segment[1] if segment else None
+
+
+def _decode_value(tiff, order, field_type, count, value_offset):
+    (fmt, size) = _Field_Types[field_type]
+    total_size = size * count
+    if total_size <= 4:
+        start = value_offset
+    else:
+        (start,) = struct.unpack_from(order + 'L', tiff, value_offset)
+    if start + total_size > len(tiff):
+        raise ExifReaderError('Value extends beyond the EXIF segment')
+
+    if field_type == 2:
+        return tiff[start:start + count].split(b'\x00', 1)[0].decode('utf-8', 'replace')
+
+    values = struct.unpack_from(order + fmt * count, tiff, start)
+    if len(fmt) == 2:
+        values = tuple(
+            numerator / denominator if denominator else float('nan')
+            for numerator, denominator in zip(values[::2], values[1::2]))
+
+    return values[0] if count == 1 else values
+
+
+def _read_ifd(tiff, order, offset, wanted, results):
+    """
+    Decode the fields of the IFD at offset whose tag is in wanted into
+    results, keyed by wanted[tag], returning the offset of the EXIF sub-IFD
+    """
+    exif_ifd = None
+    (count,) = struct.unpack_from(order + 'H', tiff, offset)
+    for entry in range(offset + 2, offset + 2 + count * 12, 12):
+        (tag, field_type, value_count) = struct.unpack_from(order + 'HHL', tiff, entry)
+        if tag == EXIF_IFD_POINTER:
+            (exif_ifd,) = struct.unpack_from(order + 'L', tiff, entry + 8)
+        elif tag in wanted and field_type in _Field_Types and value_count:
+            try:
+                results[wanted[tag]] = _decode_value(tiff, order, field_type, value_count, entry + 8)
+            except (ExifReaderError, struct.error):
+                continue
+    return exif_ifd
+
+
+def _byte_order(tiff):
+    byte_order = tiff[:2]
+    if byte_order == b'II':
+        order = '<'
+    elif byte_order == b'MM':
+        order = '>'
+    else:
+        raise ExifReaderError('Unknown TIFF byte order: {!r}'.format(byte_order))
+
+    (magic, ifd0) = struct.unpack_from(order + 'HL', tiff, 2)
+    if magic != 42:
+        raise ExifReaderError('Bad TIFF magic number: {}'.format(magic))
+    return (order, ifd0)
+
+
+def read_tiff_tags(tiff, wanted):
+    """
+    Decode the fields of IFD0 and the EXIF sub-IFD of a TIFF structure whose
+    tag is a key of wanted, returning a dict of the values keyed by the
+    corresponding value of wanted
+    """
+    (order, ifd0) = _byte_order(tiff)
+    results = {}
+    try:
+        exif_ifd = _read_ifd(tiff, order, ifd0, wanted, results)
+        if exif_ifd:
+            _read_ifd(tiff, order, exif_ifd, wanted, results)
+    except struct.error:
+        # Truncated IFD; keep whatever was decoded before it
+        pass
+    return results
+
+
+def read_exif(filename, wanted):
+    """
+    Read the EXIF fields whose tag is a key of wanted from a JPEG or Fuji RAF,
+    returning a dict of the values keyed by the corresponding value of wanted,
+    or None if the file has no EXIF
+    """
+    with open(filename, 'rb') as image_file:
+        tiff = read_exif_segment(image_file)
+    if tiff is None:
+        return None
+    return read_tiff_tags(tiff, wanted)
+
+
+def read_tiff_thumbnail(tiff):
+    """Return the thumbnail JPEG held in IFD1 of a TIFF structure, or None"""
+    (order, ifd0) = _byte_order(tiff)
+    try:
+        (count,) = struct.unpack_from(order + 'H', tiff, ifd0)
+        (ifd1,) = struct.unpack_from(order + 'L', tiff, ifd0 + 2 + count * 12)
+        if not ifd1:
+            return None
+        location = {}
+        _read_ifd(tiff, order, ifd1, {THUMBNAIL_OFFSET: 'offset', THUMBNAIL_LENGTH: 'length'}, location)
+    except struct.error:
+        return None
+
+    if 'offset' not in location or 'length' not in location:
+        return None
+    thumbnail = tiff[location['offset']:location['offset'] + location['length']]
+    return thumbnail if thumbnail.startswith(JPEG_SOI) else None
+
+
+def read_embedded_preview(filename):
+    """
+    Return the largest preview JPEG embedded in a JPEG or Fuji RAF without
+    decoding the image: a RAF's full preview, or the EXIF thumbnail.
+    Returns None if there isn't one.
+    """
+    with open(filename, 'rb') as image_file:
+        (offset, length) = _jpeg_location(image_file)
+        if offset is None:
+            return None
+        if length:
+            image_file.seek(offset)
+            preview = image_file.read(length)
+            if preview.startswith(JPEG_SOI):
+                return preview
+        image_file.seek(offset)
+        segment = _find_segment(image_file, 0xE1, EXIF_HEADER)
+
+    if segment is None:
+        return None
+    try:
+        return read_tiff_thumbnail(segment[1])
+    except ExifReaderError:
+        return None
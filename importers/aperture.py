@@ -2,10 +2,22 @@
 
 from __future__ import print_function
 
+import argparse
 import os
 import platform
 import datetime
+import errno
+import itertools
 import logging
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from importers.dedup import Dedup_Modes, HASH_INDEX_FILENAME, HashIndex, partial_hash
+from importers.manifest import MANIFEST_FILENAME, ScanManifest
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +34,28 @@ File_Types = {
     '': Categories[0],
     '.RAF': Categories[1],
     '.JPG': Categories[1],
+    '.JPEG': Categories[1],
     '.MOV': Categories[2],
 }
+# Directory scanning is bound by filesystem latency rather than CPU, so use
+# more threads than cores; slow network mounts benefit from more still
+DEFAULT_SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Maximum number of scanned file records waiting for the action stage
+SCAN_QUEUE_SIZE = 4096
+# Seconds between progress reports while walking
+PROGRESS_INTERVAL = 5.0
+# Number of files copied concurrently
+DEFAULT_COPY_WORKERS = 4
+# Upper bound on the total size of files being copied at once
+DEFAULT_INFLIGHT_BYTES = 512 * 1024 * 1024
+# Buffer size for the chunked copy fallback
+COPY_CHUNK_SIZE = 1024 * 1024
+# Errors meaning a zero-copy call isn't supported for this pair of files,
+# rather than that the copy itself failed
+_Unsupported_Copy_Errors = frozenset(
+    getattr(errno, name) for name in
+    ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK', 'EBADF', 'EPERM')
+    if hasattr(errno, name))
 
 def creation_date(target):
     """
@@ -31,7 +63,13 @@ def creation_date(target):
     last modified if that isn't possible.
     See https://stackoverflow.com/a/39501288/1709587 for explanation.
     """
-    stat = os.stat(target)
+    return stat_creation_date(os.stat(target))
+
+def stat_creation_date(stat):
+    """
+    As creation_date, but using an existing os.stat_result (e.g. from a
+    DirEntry) rather than stat-ing the file again.
+    """
     result = None
     if Is_Windows:
         result = stat.st_ctime
@@ -75,6 +113,23 @@ def category_req_stdin(filename, extension):
 
     return category
 
+def category_req_fixed(category):
+    """
+    Return a category_req that puts every uncategorised file type in
+    category without asking, for running unattended
+    """
+    def category_req(filename, extension):
+        logging.info('File [%s] has extension [%s], which is uncategorised; categorising as [%s]',
+                     filename, extension, category)
+        File_Types[extension] = category
+        return category
+    return category_req
+
+# Ways of categorising unknown file types, by name: asking on stdin, or
+# putting them all in one category
+Category_Policies = OrderedDict([('ask', category_req_stdin)] +
+                                [(c.lower(), category_req_fixed(c)) for c in Categories])
+
 def categorise_file_type(filename, category_req):
     (path, extension) = os.path.splitext(filename.upper())
     try:
@@ -94,56 +149,543 @@ def make_dirs(target):
     else:
         return True
 
-def copy_file_action(destination_fmt, do_action=True):
-    def action(filepath, category, crdate):
+def _copy_fd_range(src_fd, dst_fd, size):
+    """
+    Copy size bytes between file descriptors, trying copy_file_range, then
+    sendfile, then falling back to chunked reads into a reused buffer.
+    Returns the number of bytes copied.
+    """
+    offset = 0
+
+    # Some filesystems (FUSE, overlays, procfs-like ones) report 0 bytes
+    # copied before the end of the file, so each method gives way to the
+    # next rather than ending the copy short
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                if not copied:
+                    break
+                offset += copied
+            else:
+                return offset
+        except OSError as e:
+            if e.errno not in _Unsupported_Copy_Errors:
+                raise
+
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < size:
+                copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+            else:
+                return offset
+        except OSError as e:
+            if e.errno not in _Unsupported_Copy_Errors:
+                raise
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+    with os.fdopen(src_fd, 'rb', buffering=0, closefd=False) as fsrc:
+        while True:
+            read = fsrc.readinto(buf)
+            if not read:
+                return offset
+            written = 0
+            while written < read:
+                written += os.write(dst_fd, view[written:read])
+            offset += read
+
+def _partial_path(destination):
+    # Unique to the copying process and thread, so concurrent copies never
+    # write to the same temporary file
+    return '{}.{}-{}.part'.format(destination, os.getpid(), threading.get_ident())
+
+def copy_file(source, destination):
+    """
+    Copy source to destination, keeping the file's timestamps, without
+    passing the contents through Python where the OS allows.
+
+    The copy is written alongside the destination and moved into place once
+    complete, so an interrupted copy never leaves a truncated file behind.
+    Returns False if destination already holds a copy with the same size and
+    modification time, in which case nothing is copied.
+    """
+    src_stat = os.stat(source)
+    try:
+        dst_stat = os.stat(destination)
+    except FileNotFoundError:
+        pass
+    else:
+        if (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns):
+            logging.debug('Skipping [%s], already copied to [%s]', source, destination)
+            return False
+
+    partial = _partial_path(destination)
+    try:
+        with open(source, 'rb') as fsrc, open(partial, 'wb') as fdst:
+            copied = _copy_fd_range(fsrc.fileno(), fdst.fileno(), src_stat.st_size)
+        copied_size = os.path.getsize(partial)
+        if copied != src_stat.st_size or copied_size != src_stat.st_size:
+            raise IOError('Copied {} of {} bytes of [{}]'.format(copied_size, src_stat.st_size, source))
+        shutil.copystat(source, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+        raise
+
+    return True
+
+class DirectoryCache(object):
+    """
+    Remembers which directories are known to exist, so each is only created
+    once rather than for every file copied into it
+    """
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def ensure(self, target):
+        if target in self._known:
+            return
+        with self._lock:
+            if target not in self._known:
+                make_dirs(target)
+                self._known.add(target)
+
+def _same_content(source, destination):
+    """Whether destination looks like a copy of source, by size, mtime and partial hash"""
+    try:
+        (src_stat, dst_stat) = (os.stat(source), os.stat(destination))
+    except OSError:
+        return False
+    if (src_stat.st_size, src_stat.st_mtime_ns) != (dst_stat.st_size, dst_stat.st_mtime_ns):
+        return False
+    return partial_hash(source, src_stat.st_size) == partial_hash(destination, dst_stat.st_size)
+
+class DestinationNames(object):
+    """
+    Gives each imported file a destination path of its own, so that files
+    with the same name and date from different directories don't overwrite
+    each other. A path claimed by another source, or already holding a
+    different file, gets a counter added to the name, as IMG_0001-1.JPG.
+
+    A source imported before is given the same path again, from manifest
+    if there is one, or by finding its copy in place.
+    """
+    def __init__(self, manifest=None):
+        self.manifest = manifest
+        self._claimed = {}
+        self._lock = threading.Lock()
+
+    def claim(self, source, folder, filename):
+        previous = self.manifest.destination(source) if self.manifest is not None else None
+        with self._lock:
+            if previous is not None and os.path.dirname(previous) == folder \
+                    and self._claimed.get(previous, source) == source:
+                self._claimed[previous] = source
+                return previous
+
+            (stem, extension) = os.path.splitext(filename)
+            for counter in itertools.count():
+                name = '{}-{}{}'.format(stem, counter, extension) if counter else filename
+                candidate = os.path.join(folder, name)
+                owner = self._claimed.get(candidate)
+                if owner == source or (owner is None and (not os.path.lexists(candidate)
+                                                          or _same_content(source, candidate))):
+                    self._claimed[candidate] = source
+                    return candidate
+
+class CopyEngine(object):
+    """
+    Copies files on a thread pool, limiting the total size of the files being
+    copied at any one time to max_inflight_bytes.
+
+    submit blocks while the byte budget is used up, which in turn slows the
+    walk feeding it. Copy errors are logged and kept in errors rather than
+    stopping the import. Use as a context manager, or call close, to wait
+    for outstanding copies.
+    """
+    def __init__(self, workers=DEFAULT_COPY_WORKERS, max_inflight_bytes=DEFAULT_INFLIGHT_BYTES):
+        self.max_inflight_bytes = max_inflight_bytes
+        self.directories = DirectoryCache()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.skipped_files = 0
+        self.linked_files = 0
+        self.errors = []
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='CopyEngine')
+        self._budget = threading.Condition()
+        self._inflight_bytes = 0
+        self._stats_lock = threading.Lock()
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        (human_size, scale) = human_sizing(self.copied_bytes)
+        logging.info("Copied %d files (%0.02f %s), linked %d, skipped %d, failed %d" % (
+            self.copied_files, human_size, scale, self.linked_files, self.skipped_files, len(self.errors)))
+
+    def submit(self, source, destination, size, callback=None):
+        """
+        Queue a copy of source to destination, returning its Future.
+        callback(source, destination) is called from the copying thread once
+        the copy succeeds.
+        """
+        with self._budget:
+            # Always admit a file when nothing is in flight, however large
+            while self._inflight_bytes and self._inflight_bytes + size > self.max_inflight_bytes:
+                self._budget.wait()
+            self._inflight_bytes += size
+        future = self._executor.submit(self._copy, source, destination, size, callback)
+        with self._stats_lock:
+            self._pending[destination] = future
+        future.add_done_callback(lambda f: self._forget(destination, f))
+        return future
+
+    def link(self, source, existing, destination, callback=None):
+        """
+        Queue a hardlink of existing, a file with the same content as source,
+        at destination, once any copy to existing has finished. Falls back to
+        copying source where the link can't be made.
+        """
+        with self._stats_lock:
+            waiting_on = self._pending.get(existing)
+        return self._executor.submit(self._link, source, existing, destination, waiting_on, callback)
+
+    def _forget(self, destination, future):
+        with self._stats_lock:
+            if self._pending.get(destination) is future:
+                del self._pending[destination]
+
+    def _link(self, source, existing, destination, waiting_on, callback):
+        # Copies are queued in order, so the one waited on was taken up by
+        # a worker before this, and waiting can't starve the pool
+        if waiting_on is not None:
+            waiting_on.result()
+
+        try:
+            self.directories.ensure(os.path.dirname(destination))
+            try:
+                if os.path.exists(destination) and os.path.samefile(existing, destination):
+                    with self._stats_lock:
+                        self.skipped_files += 1
+                else:
+                    partial = _partial_path(destination)
+                    os.link(existing, partial)
+                    os.replace(partial, destination)
+                    with self._stats_lock:
+                        self.linked_files += 1
+            except OSError as e:
+                logging.debug("Error [%s] on linking [%s] to [%s], copying instead", e, existing, destination)
+                if copy_file(source, destination):
+                    with self._stats_lock:
+                        self.copied_files += 1
+                        self.copied_bytes += os.path.getsize(destination)
+            if callback is not None:
+                callback(source, destination)
+        except Exception as e:
+            logging.error("Error [%s] on linking [%s] to [%s]", e, source, destination)
+            with self._stats_lock:
+                self.errors.append((source, destination, e))
+
+    def _copy(self, source, destination, size, callback):
+        try:
+            self.directories.ensure(os.path.dirname(destination))
+            copied = copy_file(source, destination)
+            with self._stats_lock:
+                if copied:
+                    self.copied_files += 1
+                    self.copied_bytes += size
+                else:
+                    self.skipped_files += 1
+            if callback is not None:
+                callback(source, destination)
+        except Exception as e:
+            logging.error("Error [%s] on copying [%s] to [%s]", e, source, destination)
+            with self._stats_lock:
+                self.errors.append((source, destination, e))
+        finally:
+            with self._budget:
+                self._inflight_bytes -= size
+                self._budget.notify_all()
+
+def copy_file_action(destination_fmt, do_action=True, engine=None, manifest=None, hash_index=None, dedup_mode='hardlink',
+                     on_imported=None):
+    """
+    Return an action copying each file into destination_fmt, filled in with
+    the file's category and creation date. Copies are queued on engine if
+    given, otherwise made synchronously, and recorded in manifest if given
+    once complete.
+
+    With a HashIndex, files duplicating one already imported are hardlinked
+    to it or, with dedup_mode 'skip', not imported at all. Files whose names
+    collide are given unique ones by DestinationNames.
+
+    on_imported is an optional function called with (source, destination)
+    once each file is imported, from the engine's threads if there is one.
+    """
+    def recorded(source, destination):
+        if manifest is not None:
+            manifest.record(source, destination)
+        if on_imported is not None:
+            on_imported(source, destination)
+
+    def callback(source, destination):
+        if hash_index is not None:
+            hash_index.copied(destination)
+        recorded(source, destination)
+
+    names = DestinationNames(manifest)
+
+    def action(filepath, category, crdate, size):
         filename = os.path.basename(filepath)
         params = {'category': category, 'year': crdate.year, 'month': crdate.month, 'day': crdate.day}
         destination_folder = destination_fmt % params
-        destination_path = os.path.join(destination_folder, filename)
+        destination_path = names.claim(filepath, destination_folder, filename)
         logging.debug('Copying [%s] to [%s]' % (filepath, destination_path))
         if do_action:
-            make_dirs(destination_folder)
-            # TODO! Copy the file across, creating the target folder
-            pass
+            duplicate = None
+            if hash_index is not None:
+                duplicate = hash_index.register(filepath, size, destination_path)
+
+            if duplicate is not None and duplicate != destination_path:
+                logging.debug('Deduplicating [%s] as [%s]' % (filepath, duplicate))
+                if dedup_mode == 'skip':
+                    # Nothing was copied; the duplicate's own copy may still
+                    # be under way
+                    recorded(filepath, duplicate)
+                elif engine is not None:
+                    engine.link(filepath, duplicate, destination_path, callback)
+                else:
+                    make_dirs(destination_folder)
+                    os.link(duplicate, destination_path)
+                    callback(filepath, destination_path)
+            elif engine is not None:
+                engine.submit(filepath, destination_path, size, callback)
+            else:
+                make_dirs(destination_folder)
+                copy_file(filepath, destination_path)
+                callback(filepath, destination_path)
     return action
 
-def walk_path(top, action, category_req):
-    logging.info("Walking from top-level directory: %s" % top)
-    total_files = 0
-    total_bytes = 0
+class ScanProgress(object):
+    """
+    Thread-safe running totals for a directory scan, with throughput rates
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.directories = 0
+        self.files = 0
+        self.bytes = 0
+        self.unchanged = 0
+
+    def add_directory(self, file_count, byte_count, unchanged_count=0):
+        with self._lock:
+            self.directories += 1
+            self.files += file_count
+            self.bytes += byte_count
+            self.unchanged += unchanged_count
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    @property
+    def files_per_second(self):
+        return self.files / max(self.elapsed, 1e-6)
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        (human_size, scale) = human_sizing(self.bytes)
+        (human_rate, rate_scale) = human_sizing(self.bytes_per_second)
+        return "%d files (%d unchanged) in %d directories, %0.02f %s (%0.01f files/s, %0.02f %s/s)" % (
+            self.files, self.unchanged, self.directories, human_size, scale,
+            self.files_per_second, human_rate, rate_scale)
+
+class TreeScanner(object):
+    """
+    Walks a directory tree on a bounded pool of worker threads.
 
-    categorised_files = dict()
+    Each worker takes a directory from the work queue, lists it with
+    os.scandir, queues any subdirectories for the other workers, and emits a
+    (filepath, category, crdate, size) record per file. Records are consumed
+    by iterating over the scanner, so the action stage runs separately from
+    traversal and a slow action applies back-pressure through the bounded
+    record queue.
 
-    for root, dirs, files in os.walk(top):
-        if files:
-            file_count = len(files)
-            total_files += file_count
-            space_used = 0
+    With a ScanManifest, files it holds as unchanged are counted but not
+    emitted, and the rest are staged in it to be recorded by the action.
+    """
+    def __init__(self, top, category_req, workers=DEFAULT_SCAN_WORKERS, progress=None, manifest=None):
+        self.top = top
+        self.category_req = category_req
+        self.manifest = manifest
+        self.workers = max(1, workers)
+        self.progress = progress or ScanProgress()
+        self.records = queue.Queue(SCAN_QUEUE_SIZE)
+        self._directories = queue.Queue()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._category_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._add_directory(self.top)
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._worker, name='TreeScanner-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __iter__(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            yield record
+
+    def _add_directory(self, path):
+        with self._pending_lock:
+            self._pending += 1
+        self._directories.put(path)
+
+    def _put_record(self, record):
+        while not self._stopped.is_set():
+            try:
+                self.records.put(record, timeout=0.1)
+            except queue.Full:
+                continue
+            else:
+                return
+
+    def _worker(self):
+        while True:
+            path = self._directories.get()
+            if path is None:
+                return
+            try:
+                if not self._stopped.is_set():
+                    self._scan_directory(path)
+            except Exception:
+                logging.exception("Unexpected error scanning directory: %s", path)
+            finally:
+                with self._pending_lock:
+                    self._pending -= 1
+                    finished = (self._pending == 0)
+                if finished:
+                    # Nothing left queued or in progress anywhere, so release
+                    # the workers and signal the end of the records
+                    for _ in range(self.workers):
+                        self._directories.put(None)
+                    self._put_record(None)
+
+    def _categorise(self, name):
+        # category_req may prompt the user and updates File_Types, so only
+        # one worker may categorise at a time
+        with self._category_lock:
+            return categorise_file_type(name, self.category_req)
+
+    def _scan_directory(self, path):
+        file_count = 0
+        space_used = 0
+        unchanged_count = 0
+
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            logging.warning("Error [%s] on attempting to scan directory: %s", e, path)
+            return
+
+        with entries:
+            for entry in entries:
+                try:
+                    # Match os.walk, which doesn't follow symlinked directories
+                    if entry.is_dir(follow_symlinks=False):
+                        self._add_directory(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError as e:
+                    logging.warning("Error [%s] on attempting to stat: %s", e, entry.path)
+                    continue
+
+                filepath = os.path.normpath(entry.path)
+                file_count += 1
+                space_used += stat.st_size
 
-            encountered_filetypes = dict()
-            for name in files:
-                filepath = os.path.normpath(os.path.join(root, name))
-                space_used += os.path.getsize(filepath)
-                total_bytes += space_used
-                crdate = creation_date(filepath)
+                if self.manifest is not None:
+                    if self.manifest.is_current(filepath, stat):
+                        unchanged_count += 1
+                        continue
+                    self.manifest.stage(filepath, stat)
 
+                crdate = stat_creation_date(stat)
                 logging.debug('File [%s] created on [%s]' % (filepath, crdate))
 
-                (extension, category) = categorise_file_type(name, category_req)
-                if category not in categorised_files:
-                    categorised_files[category] = set()
-                categorised_files[category].add(filepath)
+                (extension, category) = self._categorise(entry.name)
+                self._put_record((filepath, category, crdate, stat.st_size))
 
-                action(filepath, category, crdate)
+        self.progress.add_directory(file_count, space_used, unchanged_count)
 
+        if file_count:
             (human_size, scale) = human_sizing(space_used)
+            logging.info("[%s] consumes %0.02f %s in %d files" % (path, human_size, scale, file_count))
 
-            logging.info("[%s] consumes %0.02f %s in %d files" % (root, human_size, scale, file_count))
+def walk_path(top, action, category_req, workers=DEFAULT_SCAN_WORKERS, progress=None, manifest=None):
+    """
+    Walk top with a TreeScanner, calling action(filepath, category, crdate, size)
+    for each file found, and return the ScanProgress of the walk
+
+    workers is the number of threads listing directories concurrently
+    progress is an optional ScanProgress to update while walking
+    manifest is an optional ScanManifest of files to skip as unchanged
+    """
+    logging.info("Walking from top-level directory: %s" % top)
+    scanner = TreeScanner(top, category_req, workers, progress, manifest)
+    progress = scanner.progress
+    next_report = time.monotonic() + PROGRESS_INTERVAL
+
+    scanner.start()
+    try:
+        for record in scanner:
+            action(*record)
 
-    (human_size, scale) = human_sizing(total_bytes)
-    logging.info("%s contains total of %d files consuming %0.02f %s" % (top, total_files, human_size, scale))
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+                logging.info("Scanned %s" % progress)
+    finally:
+        scanner.stop()
 
-def import_files(src, dst, subdst_fmt, category_req=category_req_stdin):
+    (human_size, scale) = human_sizing(progress.bytes)
+    logging.info("%s contains total of %d files consuming %0.02f %s" % (top, progress.files, human_size, scale))
+    logging.info("Scan complete: %s" % progress)
+    return progress
+
+def import_files(src, dst, subdst_fmt, category_req=category_req_stdin, workers=DEFAULT_SCAN_WORKERS,
+                 copy_workers=DEFAULT_COPY_WORKERS, max_inflight_bytes=DEFAULT_INFLIGHT_BYTES,
+                 incremental=True, manifest_path=None, dedup_mode=None):
     """
     Walk path src and copy files to dst/subdst_fmt
 
@@ -151,19 +693,66 @@ def import_files(src, dst, subdst_fmt, category_req=category_req_stdin):
     dst is the top-level target directory for copying
     subdst_fmt is the format for categorising imported files
     category_req is the optional function for requesting the file type categorisation
+    workers is the optional number of threads used to scan directories
+    copy_workers is the optional number of files copied concurrently
+    max_inflight_bytes is the optional limit on the total size of files being copied at once
+    incremental is whether to skip files imported unchanged by a previous run
+    manifest_path is the optional location of the manifest of imported files, by default in dst
+    dedup_mode is the optional handling of duplicate files, either 'hardlink' or 'skip'
     """
+    if dedup_mode not in (None,) + Dedup_Modes:
+        raise ValueError('Parameter "dedup_mode" must be one of: %s' % ', '.join(Dedup_Modes))
+
     destination = os.path.join(dst, subdst_fmt)
-    action = copy_file_action(destination)
-    walk_path(src, action, category_req)
-
-def main():
-    logging.basicConfig(level=logging.DEBUG)
-    src = "/Users/filipedesousa/Pictures/TestLibrary.aplibrary/Masters"
-    dst = "/Users/filipedesousa/Documents/MediaLibrary"
-    subdst_fmt = os.path.join("%(category)s", "%(year)d", "%(month)d", "%(day)d")
-    # src = "/Volumes/Photos/Aperture Library.aplibrary/Masters"
-    # dst = "/Volumes/Photos/Library"
-    import_files(src, dst, subdst_fmt)
+    make_dirs(dst)
+    manifest = None
+    if incremental:
+        manifest = ScanManifest(manifest_path or os.path.join(dst, MANIFEST_FILENAME))
+    hash_index = None
+    if dedup_mode:
+        hash_index = HashIndex(os.path.join(dst, HASH_INDEX_FILENAME))
+
+    completed = False
+    try:
+        with CopyEngine(copy_workers, max_inflight_bytes) as engine:
+            action = copy_file_action(destination, engine=engine, manifest=manifest,
+                                      hash_index=hash_index, dedup_mode=dedup_mode)
+            progress = walk_path(src, action, category_req, workers, manifest=manifest)
+        completed = True
+        return progress
+    finally:
+        # Keep whatever was copied even if the walk failed part way, so the
+        # next run picks up where this one stopped
+        if manifest is not None:
+            manifest.save(prune=completed)
+        if hash_index is not None:
+            hash_index.save()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy files from a tree into a library organised by category and date.')
+    parser.add_argument('src', help='top-level directory to import from')
+    parser.add_argument('dst', help='top-level directory of the library to import to')
+    parser.add_argument('--format', default=os.path.join("%(category)s", "%(year)d", "%(month)d", "%(day)d"),
+                        help='format of the directories files are copied to, within dst')
+    parser.add_argument('--category-policy', choices=list(Category_Policies), default='ask',
+                        help='how to categorise unknown file types: ask on stdin, or use the category given')
+    parser.add_argument('--workers', type=int, default=DEFAULT_SCAN_WORKERS,
+                        help='threads scanning directories')
+    parser.add_argument('--copy-workers', type=int, default=DEFAULT_COPY_WORKERS,
+                        help='files copied concurrently')
+    parser.add_argument('--dedup', choices=Dedup_Modes, default=None,
+                        help='hardlink or skip files duplicating ones already imported')
+    parser.add_argument('--full', action='store_true',
+                        help='copy every file, rather than only those changed since the last import')
+    parser.add_argument('--manifest', default=None,
+                        help='manifest of imported files, by default in dst')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    import_files(args.src, args.dst, args.format, category_req=Category_Policies[args.category_policy],
+                 workers=args.workers, copy_workers=args.copy_workers, incremental=not args.full,
+                 manifest_path=args.manifest, dedup_mode=args.dedup)
 
 if __name__ == '__main__':
     main()
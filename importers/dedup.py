@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from importers.manifest import dump_json_mapping
+
+logger = logging.getLogger(__name__)
+
+HASH_INDEX_FILENAME = '.picman-hashes.json'
+HASH_INDEX_VERSION = 1
+# Size of the blocks at the start and end of a file used for its partial hash
+PARTIAL_BLOCK_SIZE = 64 * 1024
+# Buffer size for full-content hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+Dedup_Modes = ('hardlink', 'skip')
+
+
+def partial_hash(filepath, size, block_size=PARTIAL_BLOCK_SIZE):
+    """
+    Hash of a file's size plus its first and last block_size bytes, which is
+    cheap to compute and tells most same-sized files apart. Files no larger
+    than two blocks are hashed whole, so this is also their full hash.
+    """
+    digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=20)
+    with open(filepath, 'rb') as hash_file:
+        if size <= 2 * block_size:
+            digest.update(hash_file.read())
+        else:
+            digest.update(hash_file.read(block_size))
+            hash_file.seek(-block_size, os.SEEK_END)
+            digest.update(hash_file.read(block_size))
+    return digest.hexdigest()
+
+
+def full_hash(filepath):
+    digest = hashlib.blake2b(digest_size=32)
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filepath, 'rb', buffering=0) as hash_file:
+        while True:
+            read = hash_file.readinto(buf)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+class HashIndex(object):
+    """
+    Persistent index of imported file contents, used to find files that
+    duplicate something already imported.
+
+    Files are bucketed by size, so a file with a unique size is never read.
+    Within a bucket, files are compared by partial hash, and only those whose
+    partial hashes collide are hashed in full. Hashes are computed lazily and
+    kept, so each file is read at most once per hash across runs. Entries are
+    [destination, source, partial, full], and the index is stored as a JSON
+    sidecar file.
+
+    Hashes describe the destination, the file duplicates are linked to. Until
+    copied is called for a destination registered in this run, its copy may
+    still be under way, so its source is hashed instead.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._buckets = {}
+        self._sizes = {}
+        # Destinations registered whose copies haven't completed
+        self._copying = set()
+        self._lock = threading.Lock()
+        # Serialises saves, which write outside _lock
+        self._save_lock = threading.Lock()
+        self._changes = 0
+        self._saved_changes = 0
+        self.hashed_partial = 0
+        self.hashed_full = 0
+        self.load()
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @property
+    def dirty(self):
+        """Whether there are changes since the last save"""
+        return self._changes != self._saved_changes
+
+    def load(self):
+        try:
+            with open(self.filepath, 'r') as index_file:
+                data = json.load(index_file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logging.warning("Error [%s] on reading hash index, starting afresh: %s", e, self.filepath)
+            return
+
+        if data.get('version') != HASH_INDEX_VERSION:
+            logging.warning("Hash index version [%s] not supported, starting afresh: %s",
+                            data.get('version'), self.filepath)
+            return
+
+        with self._lock:
+            self._buckets = {int(size): entries for size, entries in data.get('buckets', {}).items()}
+            self._sizes = {entry[0]: size for size, entries in self._buckets.items() for entry in entries}
+        logging.info("Loaded hash index of %d files from: %s", len(self._sizes), self.filepath)
+
+    def save(self):
+        """
+        Write the index out if changed, replacing the previous file
+        atomically. Entries are copied under the lock and serialised outside
+        it, so registering isn't held up meanwhile.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self.dirty:
+                    return False
+                buckets = {size: [list(entry) for entry in entries] for size, entries in self._buckets.items()}
+                changes = self._changes
+
+            dump_json_mapping(self.filepath, {'version': HASH_INDEX_VERSION, 'buckets': buckets}, 'buckets')
+            self._saved_changes = changes
+        logging.debug("Saved hash index of %d files to: %s", len(self._sizes), self.filepath)
+        return True
+
+    def register(self, source, size, destination):
+        """
+        Return the destination of an indexed file with the same content as
+        source, or None after indexing source as imported to destination
+        """
+        with self._lock:
+            if self._sizes.get(destination) not in (None, size):
+                # The file previously imported here has since changed
+                self._remove(destination)
+
+            bucket = self._buckets.get(size)
+            if not bucket:
+                self._add(size, [destination, source, None, None])
+                return None
+
+            for entry in bucket:
+                if entry[0] == destination:
+                    # Re-imported, perhaps with other content of the same
+                    # size, so any hashes kept are out of date
+                    entry[1:] = [source, None, None]
+                    self._changes += 1
+                    self._copying.add(destination)
+                    return destination
+
+            source_partial = self._partial(source, size)
+            candidates = [entry for entry in bucket if self._entry_partial(entry, size) == source_partial]
+
+            source_full = None
+            if candidates:
+                source_full = self._full(source, size, source_partial)
+                for entry in candidates:
+                    if self._entry_full(entry, size) == source_full:
+                        logging.debug("File [%s] duplicates [%s]", source, entry[0])
+                        return entry[0]
+
+            self._add(size, [destination, source, source_partial, source_full])
+            return None
+
+    def copied(self, destination):
+        """Note that the copy to a registered destination has completed"""
+        with self._lock:
+            self._copying.discard(destination)
+
+    def _add(self, size, entry):
+        self._buckets.setdefault(size, []).append(entry)
+        self._sizes[entry[0]] = size
+        self._copying.add(entry[0])
+        self._changes += 1
+
+    def _remove(self, destination):
+        size = self._sizes.pop(destination)
+        self._buckets[size] = [entry for entry in self._buckets[size] if entry[0] != destination]
+        self._changes += 1
+
+    def _partial(self, filepath, size):
+        self.hashed_partial += 1
+        return partial_hash(filepath, size)
+
+    def _full(self, filepath, size, partial):
+        if size <= 2 * PARTIAL_BLOCK_SIZE:
+            return partial
+        self.hashed_full += 1
+        return full_hash(filepath)
+
+    def _read_entry(self, entry, hasher):
+        # The destination is what duplicates are linked to, and the source
+        # may have changed since, but while a copy is under way only the
+        # source has the content on its way to the destination
+        filepath = entry[1] if entry[0] in self._copying else entry[0]
+        try:
+            return hasher(filepath)
+        except OSError:
+            return None
+
+    def _entry_partial(self, entry, size):
+        if entry[2] is None:
+            entry[2] = self._read_entry(entry, lambda filepath: self._partial(filepath, size))
+            self._changes += 1
+        return entry[2]
+
+    def _entry_full(self, entry, size):
+        if entry[3] is None:
+            entry[3] = self._read_entry(entry, lambda filepath: self._full(filepath, size, entry[2]))
+            self._changes += 1
+        return entry[3]
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = '.picman-manifest.json'
+MANIFEST_VERSION = 1
+# Entries encoded at a time on saving, so that other threads get the GIL
+# between chunks rather than waiting out the whole encoding
+SAVE_CHUNK_ENTRIES = 5000
+
+
+def dump_json_mapping(filepath, data, key):
+    """
+    Write data as JSON to filepath, replacing it atomically, encoding the
+    large mapping data[key] a chunk of SAVE_CHUNK_ENTRIES entries at a time
+    """
+    header = json.dumps({k: v for k, v in data.items() if k != key}, separators=(',', ':'))[:-1]
+    items = list(data[key].items())
+    temp_path = filepath + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json_file.write(header + (',' if len(data) > 1 else '') + json.dumps(key) + ':{')
+        for start in range(0, len(items), SAVE_CHUNK_ENTRIES):
+            chunk = json.dumps(dict(items[start:start + SAVE_CHUNK_ENTRIES]), separators=(',', ':'))
+            json_file.write((',' if start else '') + chunk[1:-1])
+        json_file.write('}}')
+    os.replace(temp_path, filepath)
+
+
+class ScanManifest(object):
+    """
+    Record of the files already imported from a source tree, so later runs
+    can skip files that haven't changed since.
+
+    Each entry maps a source path to the (size, mtime_ns, inode) it had when
+    imported, plus the destination it was imported to. Files found by a scan
+    are staged with their identity and only recorded once their action has
+    completed, so a failed or interrupted import is retried on the next run.
+    The manifest is stored as a JSON sidecar file.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._entries = {}
+        self._staged = {}
+        self._seen = set()
+        self._lock = threading.Lock()
+        # Serialises saves, which write outside _lock
+        self._save_lock = threading.Lock()
+        self._changes = 0
+        self._saved_changes = 0
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    @property
+    def dirty(self):
+        """Whether there are changes since the last save"""
+        return self._changes != self._saved_changes
+
+    @staticmethod
+    def identity(stat):
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def load(self):
+        try:
+            with open(self.filepath, 'r') as manifest_file:
+                data = json.load(manifest_file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logging.warning("Error [%s] on reading manifest, starting afresh: %s", e, self.filepath)
+            return
+
+        if data.get('version') != MANIFEST_VERSION:
+            logging.warning("Manifest version [%s] not supported, starting afresh: %s",
+                            data.get('version'), self.filepath)
+            return
+
+        with self._lock:
+            # Tuples of plain values aren't tracked by the garbage
+            # collector, so a large manifest doesn't slow every collection
+            self._entries = {path: tuple(entry) for path, entry in data.get('entries', {}).items()}
+        logging.info("Loaded manifest of %d files from: %s", len(self._entries), self.filepath)
+
+    def save(self, prune=False):
+        """
+        Write the manifest out if changed, replacing the previous file
+        atomically. With prune, entries for files not seen since loading
+        are dropped.
+
+        Only a shallow copy of the entries is taken under the lock, so
+        recording isn't held up while they're serialised.
+        """
+        with self._save_lock:
+            with self._lock:
+                if prune:
+                    entries = {path: entry for path, entry in self._entries.items() if path in self._seen}
+                    if len(entries) != len(self._entries):
+                        self._entries = entries
+                        self._changes += 1
+                if not self.dirty:
+                    return False
+                # Entries are immutable tuples, so a shallow copy can be
+                # serialised while recording carries on
+                entries = dict(self._entries)
+                changes = self._changes
+
+            dump_json_mapping(self.filepath, {'version': MANIFEST_VERSION, 'entries': entries}, 'entries')
+            self._saved_changes = changes
+        logging.debug("Saved manifest of %d files to: %s", len(entries), self.filepath)
+        return True
+
+    def is_current(self, path, stat):
+        """
+        Whether path was imported with the same identity as stat, marking it
+        as seen either way
+        """
+        identity = self.identity(stat)
+        with self._lock:
+            self._seen.add(path)
+            entry = self._entries.get(path)
+        return entry is not None and entry[:3] == identity
+
+    def stage(self, path, stat):
+        with self._lock:
+            self._staged[path] = self.identity(stat)
+
+    def record(self, path, destination):
+        """Record a staged path as imported to destination"""
+        with self._lock:
+            identity = self._staged.pop(path, None)
+            if identity is not None:
+                self._entries[path] = (*identity, destination)
+                self._changes += 1
+
+    def destination(self, path):
+        entry = self._entries.get(path)
+        return entry[3] if entry else None
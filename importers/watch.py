@@ -0,0 +1,601 @@
+#!/usr/bin/python
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from importers.aperture import (Category_Policies, CopyEngine, DEFAULT_COPY_WORKERS, DEFAULT_INFLIGHT_BYTES,
+                                DEFAULT_SCAN_WORKERS, categorise_file_type, copy_file_action, make_dirs,
+                                stat_creation_date, walk_path)
+from importers.dedup import Dedup_Modes, HASH_INDEX_FILENAME, HashIndex
+from importers.manifest import MANIFEST_FILENAME, ScanManifest
+
+logger = logging.getLogger(__name__)
+
+# Seconds a file must go without changing before it's imported, where no
+# event says it's finished: when polling, or when found in a directory
+# inotify has only started watching. Files still being written by a
+# capture station are then less likely to be picked up half done
+DEFAULT_SETTLE_SECONDS = 0.25
+# Seconds between scans when polling, and between full rescans, which also
+# catch files changed in place in directories that didn't change
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_FULL_SCAN_INTERVAL = 60.0
+# Scans for which a file reported as changed is stat-ed again when polling,
+# so that a file still growing keeps being reported
+POLL_RECENT_SCANS = 3
+# Longest the watch loop waits for events, bounding how long finished
+# copies wait to be handed on
+MAX_WAIT_SECONDS = 0.1
+# Seconds between checks for changes to save to the manifest and hash
+# index while watching
+CHECKPOINT_INTERVAL = 5.0
+# Filesystem types on which inotify sees only local changes, so polling is
+# used instead
+Network_Filesystems = frozenset(('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph',
+                                 'glusterfs', 'lustre', 'gpfs', 'fuse.sshfs', 'fuse.rclone', 'davfs'))
+# Suffixes and prefixes of files that are never imported: partial copies
+# and the importer's own sidecar files
+Ignored_Suffixes = ('.part', '.tmp')
+Ignored_Prefixes = ('.picman-',)
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+# Files are reported once written and closed, or moved in, never while
+# still being written; IN_CREATE is for the directories to watch
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def is_ignored(path):
+    name = os.path.basename(path)
+    return name.endswith(Ignored_Suffixes) or name.startswith(Ignored_Prefixes)
+
+
+def _scan_files(top, on_directory=None):
+    """Yield the paths of the files under top, calling on_directory for each directory"""
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        if on_directory is not None:
+            on_directory(path)
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            logging.warning("Error [%s] on attempting to scan directory: %s", e, path)
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield os.path.normpath(entry.path)
+                except OSError:
+                    continue
+
+
+def _unescape_mount_path(path):
+    # /proc/mounts escapes spaces, tabs, newlines and backslashes as octal
+    return path.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+
+def filesystem_type(path, mounts_path='/proc/mounts'):
+    """The type of the filesystem holding path, or None where unknown"""
+    path = os.path.realpath(path)
+    best = (None, '')
+    try:
+        with open(mounts_path, 'r') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = _unescape_mount_path(fields[1])
+                inside = path == mount_point or path.startswith(mount_point.rstrip(os.sep) + os.sep)
+                if inside and len(mount_point) >= len(best[1]):
+                    best = (fields[2], mount_point)
+    except OSError:
+        return None
+    return best[0]
+
+
+class InotifyWatcher(object):
+    """
+    Watches every directory under top with inotify, through libc by ctypes,
+    reporting the paths of files as they are closed after writing or moved
+    in, so finished.
+
+    Directories created or moved in are watched as they appear, and the
+    files already in them reported as unsettled, since they may have been
+    written, or started, before the watch was added. If the kernel's event
+    queue overflows, every file is reported as unsettled again, leaving the
+    manifest to skip those unchanged.
+    """
+    def __init__(self, top):
+        self.top = top
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1: ' + os.strerror(error))
+        self._directories = {}
+        try:
+            for _ in self._watch_tree(top):
+                pass
+        except BaseException:
+            self.close()
+            raise
+        logger.info('Watching %d directories under [%s] with inotify', len(self._directories), top)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._directories.clear()
+
+    def _add_watch(self, path):
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Gone again before it could be watched
+                return
+            raise OSError(error, 'inotify_add_watch [{}]: {}'.format(path, os.strerror(error)))
+        self._directories[descriptor] = path
+
+    def _watch_tree(self, top):
+        """Watch top and the directories under it, yielding the files in them"""
+        return _scan_files(top, self._add_watch)
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for events, returning (finished,
+        unsettled): the paths of files closed after writing or moved in, and
+        of files found by scanning, which may still be being written
+        """
+        (readable, _, _) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return ([], [])
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return ([], [])
+
+        finished = []
+        unsettled = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            (descriptor, mask, cookie, length) = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += _EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify event queue overflowed, rescanning [%s]', self.top)
+                unsettled.extend(self._watch_tree(self.top))
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(descriptor, None)
+                continue
+            directory = self._directories.get(descriptor)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    unsettled.extend(self._watch_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                finished.append(path)
+        return (finished, unsettled)
+
+
+class PollingWatcher(object):
+    """
+    Watches the directories under top by scanning them every interval,
+    reporting the paths of files whose size or modification time changed,
+    for filesystems such as network mounts where inotify doesn't work.
+
+    Only directories whose modification time changed are listed again, and
+    files recently reported are stat-ed again each scan so that ones still
+    being written keep being reported. Every full_scan_interval, the whole
+    tree is listed to catch files changed in place.
+    """
+    def __init__(self, top, interval=DEFAULT_POLL_INTERVAL, full_scan_interval=DEFAULT_FULL_SCAN_INTERVAL):
+        self.top = top
+        self.interval = interval
+        self.full_scan_interval = full_scan_interval
+        # Directory path to (mtime_ns, subdirectories, files)
+        self._directories = {}
+        # File path to (size, mtime_ns)
+        self._files = {}
+        # File path to the number of scans it's still stat-ed again for
+        self._recent = {}
+        self._scan(full=True)
+        now = time.monotonic()
+        self._next_scan = now + interval
+        self._next_full_scan = now + full_scan_interval
+        logger.info('Polling %d directories under [%s] every %.1fs', len(self._directories), top, interval)
+
+    def close(self):
+        self._directories.clear()
+        self._files.clear()
+        self._recent.clear()
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for the next scan, returning (finished,
+        unsettled) as InotifyWatcher does. Scans can't tell when a file is
+        finished, so every file changed is unsettled.
+        """
+        now = time.monotonic()
+        if now < self._next_scan:
+            time.sleep(min(timeout, self._next_scan - now))
+            now = time.monotonic()
+            if now < self._next_scan:
+                return ([], [])
+        full = now >= self._next_full_scan
+        if full:
+            self._next_full_scan = now + self.full_scan_interval
+        changed = self._scan(full)
+        self._next_scan = time.monotonic() + self.interval
+        return ([], changed)
+
+    def _check_file(self, path, stat, changed):
+        identity = (stat.st_size, stat.st_mtime_ns)
+        if self._files.get(path) != identity:
+            self._files[path] = identity
+            self._recent[path] = POLL_RECENT_SCANS
+            changed.append(path)
+
+    def _scan(self, full):
+        changed = []
+        listed = set()
+        recent = list(self._recent)
+        self._recent = {path: scans - 1 for path, scans in self._recent.items() if scans > 1}
+
+        stack = [self.top]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._forget_directory(path)
+                continue
+            known = self._directories.get(path)
+            if not full and known is not None and known[0] == mtime:
+                stack.extend(known[1])
+                continue
+
+            subdirectories = []
+            present = set()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirectories.append(entry.path)
+                            elif entry.is_file():
+                                filepath = os.path.normpath(entry.path)
+                                present.add(filepath)
+                                self._check_file(filepath, entry.stat(), changed)
+                        except OSError:
+                            continue
+            except OSError as e:
+                logging.warning("Error [%s] on attempting to scan directory: %s", e, path)
+                continue
+
+            if known is not None:
+                self._forget_files(known[2] - present)
+            self._directories[path] = (mtime, subdirectories, present)
+            listed.add(path)
+            stack.extend(subdirectories)
+
+        # Files in directories that weren't listed may still be growing
+        for filepath in recent:
+            if filepath in self._files and os.path.dirname(filepath) not in listed:
+                try:
+                    self._check_file(filepath, os.stat(filepath), changed)
+                except OSError:
+                    self._forget_files((filepath,))
+        return changed
+
+    def _forget_files(self, filepaths):
+        for filepath in filepaths:
+            self._files.pop(filepath, None)
+            self._recent.pop(filepath, None)
+
+    def _forget_directory(self, path):
+        known = self._directories.pop(path, None)
+        if known is not None:
+            self._forget_files(known[2])
+            for subdirectory in known[1]:
+                self._forget_directory(subdirectory)
+
+
+def create_watcher(top, polling=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    An InotifyWatcher of top, or a PollingWatcher if polling is true, top
+    is on a network filesystem when polling is None, or inotify fails
+    """
+    if polling is None:
+        fstype = filesystem_type(top)
+        polling = fstype in Network_Filesystems
+        if polling:
+            logger.info('[%s] is on a %s filesystem, polling for changes', top, fstype)
+    if not polling:
+        try:
+            return InotifyWatcher(top)
+        except (OSError, AttributeError) as e:
+            # AttributeError where libc has no inotify, e.g. not on Linux
+            logging.warning('inotify unavailable for [%s], polling instead: %s', top, e)
+    return PollingWatcher(top, poll_interval)
+
+
+class Debouncer(object):
+    """
+    Holds back paths until settle seconds pass without them being touched,
+    so files are only handed on once they've stopped being written, or
+    until they're marked finished
+    """
+    def __init__(self, settle=DEFAULT_SETTLE_SECONDS):
+        self.settle = settle
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def touch(self, path, now=None):
+        self._deadlines[path] = (time.monotonic() if now is None else now) + self.settle
+
+    def finish(self, path, now=None):
+        """Hand path on with the next ready, whether or not it has settled"""
+        self._deadlines[path] = time.monotonic() if now is None else now
+
+    def wait_time(self, now=None):
+        """Seconds until the next path settles, or None if none are pending"""
+        if not self._deadlines:
+            return None
+        return max(0.0, min(self._deadlines.values()) - (time.monotonic() if now is None else now))
+
+    def ready(self, now=None):
+        """Remove and return the paths that have settled, with their os.stat_result"""
+        if now is None:
+            now = time.monotonic()
+        settled = []
+        for path in [p for p, deadline in self._deadlines.items() if deadline <= now]:
+            del self._deadlines[path]
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Moved away or deleted while settling, e.g. a temporary file
+                continue
+            settled.append((path, stat))
+        return settled
+
+
+class WatchImporter(object):
+    """
+    Imports the files arriving under src into dst/subdst_fmt as they
+    appear, pushing only new or changed paths through the same categorise
+    and copy steps as import_files rather than walking the whole tree.
+
+    Files are reported by a watcher from create_watcher. Those it reports
+    as finished are imported straight away, and those it can't tell are
+    finished are held by a Debouncer until settled. Files current in the
+    manifest are skipped, and the rest categorised and copied on a
+    CopyEngine. As copies complete, on_imported, if given, is called on the
+    watching thread with a list of (source, destination, category), e.g. to
+    add them to the catalog.
+    """
+    def __init__(self, src, dst, subdst_fmt, category_req, on_imported=None, polling=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL, settle=DEFAULT_SETTLE_SECONDS,
+                 copy_workers=DEFAULT_COPY_WORKERS, max_inflight_bytes=DEFAULT_INFLIGHT_BYTES,
+                 manifest_path=None, dedup_mode=None):
+        if dedup_mode not in (None,) + Dedup_Modes:
+            raise ValueError('Parameter "dedup_mode" must be one of: %s' % ', '.join(Dedup_Modes))
+        self.src = os.path.abspath(src)
+        self.dst = os.path.abspath(dst)
+        self.destination = os.path.join(self.dst, subdst_fmt)
+        self.category_req = category_req
+        self.on_imported = on_imported
+        self.polling = polling
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.copy_workers = copy_workers
+        self.max_inflight_bytes = max_inflight_bytes
+        self.dedup_mode = dedup_mode
+        self.imported = 0
+        self.unchanged = 0
+
+        make_dirs(self.dst)
+        self.manifest = ScanManifest(manifest_path or os.path.join(self.dst, MANIFEST_FILENAME))
+        self.hash_index = HashIndex(os.path.join(self.dst, HASH_INDEX_FILENAME)) if dedup_mode else None
+        self._completed = queue.Queue()
+        # Categories of the files being copied, by source path
+        self._categories = {}
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Stop watching, from any thread"""
+        self._stop.set()
+
+    def run(self, initial_scan=True):
+        """
+        Watch until stopped, first importing anything that arrived while
+        not watching with an incremental walk if initial_scan
+        """
+        watcher = create_watcher(self.src, self.polling, self.poll_interval)
+        # Polled changes only show up once per interval, so a file must go
+        # unchanged for a whole interval to have settled. With inotify,
+        # only files found by scanning, rather than by an event, settle
+        settle = self.settle + (self.poll_interval if isinstance(watcher, PollingWatcher) else 0)
+        debouncer = Debouncer(settle)
+        # Saving a large manifest takes a while, so it's done on a thread
+        # of its own rather than holding up the watch
+        stopping = threading.Event()
+        checkpointer = threading.Thread(target=self._checkpoint_periodically, args=(stopping,),
+                                        name='WatchCheckpoint', daemon=True)
+        checkpointer.start()
+        try:
+            with CopyEngine(self.copy_workers, self.max_inflight_bytes) as engine:
+                action = copy_file_action(self.destination, engine=engine, manifest=self.manifest,
+                                          hash_index=self.hash_index, dedup_mode=self.dedup_mode,
+                                          on_imported=self._copied)
+                if initial_scan:
+                    # The watch is already in place, so nothing arriving
+                    # during the walk is missed
+                    progress = walk_path(self.src, self._tracked(action), self.category_req,
+                                         DEFAULT_SCAN_WORKERS, manifest=self.manifest)
+                    logger.info('Caught up with [%s]: %s', self.src, progress)
+
+                while not self._stop.is_set():
+                    wait = debouncer.wait_time()
+                    (finished, unsettled) = watcher.poll(
+                        MAX_WAIT_SECONDS if wait is None else min(wait, MAX_WAIT_SECONDS))
+                    now = time.monotonic()
+                    for path in unsettled:
+                        if self._wanted(path):
+                            debouncer.touch(path, now)
+                    for path in finished:
+                        if self._wanted(path):
+                            debouncer.finish(path, now)
+
+                    for path, stat in debouncer.ready(now):
+                        self._import(action, path, stat)
+                    self._hand_on()
+            # Leaving the engine waits for the last copies
+            self._hand_on()
+        finally:
+            watcher.close()
+            stopping.set()
+            checkpointer.join()
+            self._checkpoint()
+
+    def _tracked(self, action):
+        def tracked(filepath, category, crdate, size):
+            self._categories[filepath] = category
+            action(filepath, category, crdate, size)
+        return tracked
+
+    def _wanted(self, path):
+        # Where dst is inside src, the copies would otherwise be imported too
+        return not is_ignored(path) and not (path == self.dst or path.startswith(self.dst + os.sep))
+
+    def _import(self, action, path, stat):
+        if self.manifest.is_current(path, stat):
+            self.unchanged += 1
+            return
+        self.manifest.stage(path, stat)
+        (extension, category) = categorise_file_type(os.path.basename(path), self.category_req)
+        logging.debug('File [%s] settled, importing as [%s]', path, category)
+        self._categories[path] = category
+        action(path, category, stat_creation_date(stat), stat.st_size)
+
+    def _copied(self, source, destination):
+        # Called on the engine's threads
+        self._completed.put((source, destination))
+
+    def _hand_on(self):
+        imported = []
+        while True:
+            try:
+                (source, destination) = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            imported.append((source, destination, self._categories.pop(source, None)))
+        if not imported:
+            return
+        self.imported += len(imported)
+        logger.info('Imported %d files from [%s]', len(imported), self.src)
+        if self.on_imported is not None:
+            self.on_imported(imported)
+
+    def _checkpoint_periodically(self, stopping):
+        while not stopping.wait(CHECKPOINT_INTERVAL):
+            try:
+                self._checkpoint()
+            except OSError as e:
+                logging.warning('Error [%s] on saving the manifest of [%s]', e, self.src)
+
+    def _checkpoint(self):
+        # Each only writes anything if changed since last saved
+        self.manifest.save()
+        if self.hash_index is not None:
+            self.hash_index.save()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch a directory, importing files as they arrive.')
+    parser.add_argument('src', help='directory to watch')
+    parser.add_argument('dst', help='top-level directory of the library to import to')
+    parser.add_argument('--format', default=os.path.join("%(category)s", "%(year)d", "%(month)d", "%(day)d"),
+                        help='format of the directories files are copied to, within dst')
+    parser.add_argument('--category-policy', choices=list(Category_Policies), default='unknown',
+                        help='how to categorise unknown file types; "ask" prompts on stdin')
+    parser.add_argument('--library', default=None,
+                        help='library FileStorage to add imported pictures to, if any')
+    parser.add_argument('--thumbnails', default=None, help='thumbnail cache directory to fill, if any')
+    parser.add_argument('--poll', dest='polling', action='store_const', const=True, default=None,
+                        help='poll for changes, rather than using inotify where the filesystem allows')
+    parser.add_argument('--inotify', dest='polling', action='store_const', const=False,
+                        help='use inotify even on network filesystems')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='seconds between scans when polling')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help='seconds a file must go unchanged before being imported, '
+                             'where no event marks it finished')
+    parser.add_argument('--copy-workers', type=int, default=DEFAULT_COPY_WORKERS,
+                        help='files copied concurrently')
+    parser.add_argument('--dedup', choices=Dedup_Modes, default=None,
+                        help='hardlink or skip files duplicating ones already imported')
+    parser.add_argument('--manifest', default=None, help='manifest of imported files, by default in dst')
+    parser.add_argument('--no-initial-scan', action='store_true',
+                        help="don't import files that arrived while not watching")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    importer = WatchImporter(args.src, args.dst, args.format, Category_Policies[args.category_policy],
+                             polling=args.polling, poll_interval=args.poll_interval, settle=args.settle,
+                             copy_workers=args.copy_workers, manifest_path=args.manifest,
+                             dedup_mode=args.dedup)
+    library = None
+    if args.library:
+        # Imported here so that watching without a library doesn't need ZODB
+        import dao
+        import indexer
+        library = dao.ZODBDAO(args.library)
+        importer.on_imported = indexer.LibraryFeed(library, thumbnail_dir=args.thumbnails)
+    try:
+        importer.run(initial_scan=not args.no_initial_scan)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if library is not None:
+            importer.on_imported.close()
+            library.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import dao
+import exifparse
+import instrumentation
+import thumbnails
+from importers import aperture
+from importers.manifest import ScanManifest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photolibrary.fs')
+# Seconds between progress events
+DEFAULT_PROGRESS_INTERVAL = 5.0
+# Categories of the files indexed; anything else is only scanned
+Indexed_Categories = ('Image',)
+
+
+def _index_file(task):
+    """
+    Worker process half of the indexer: parse the EXIF of a file and make
+    its thumbnails, returning (filepath, identity, packed categorised,
+    error, spans), with error None unless it failed and spans those
+    collected if instrumenting
+    """
+    (filepath, thumbnail_dir, instrument) = task
+    with instrumentation.collecting(instrument) as spans:
+        try:
+            stat = os.stat(filepath)
+            categorised = exifparse.CategorisedExifData(filepath).categorised
+            if thumbnail_dir is not None:
+                thumbnails.ThumbnailCache(thumbnail_dir).get(filepath, thumbnails.Thumbnail_Sizes[0])
+            result = (filepath, (stat.st_size, stat.st_mtime_ns), exifparse.pack_categorised(categorised), None)
+        except Exception as e:
+            result = (filepath, None, None, '{}: {}'.format(e.__class__.__name__, e))
+    return result + (spans,)
+
+
+class JSONLinesProgress(object):
+    """Writes indexing events to stream as JSON objects, one per line"""
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = round(time.time(), 3)
+        self.stream.write(json.dumps(fields, separators=(',', ':')) + '\n')
+        self.stream.flush()
+
+
+class Indexer(object):
+    """
+    Indexes the pictures under a directory into a ZODBDAO's library without
+    Kivy, filling its catalog, metadata cache and thumbnails in one
+    streaming pass.
+
+    A TreeScanner walks the tree, and the files in Indexed_Categories are
+    parsed and thumbnailed on a pool of processes as they're found. Their
+    results are added to the catalog through a BulkIngest and to the
+    MetadataCache. Files are recorded in the manifest only once the chunk
+    holding them is committed, so that on resuming, the manifest skips
+    exactly the files already stored.
+    """
+    def __init__(self, library, manifest, category_req, thumbnail_dir=thumbnails.DEFAULT_CACHE_DIR,
+                 processes=None, scan_workers=aperture.DEFAULT_SCAN_WORKERS,
+                 chunk_size=dao.DEFAULT_INGEST_CHUNK_SIZE, progress=None,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        self.library = library
+        self.manifest = manifest
+        self.category_req = category_req
+        self.thumbnail_dir = thumbnail_dir
+        self.processes = processes
+        self.scan_workers = scan_workers
+        self.chunk_size = chunk_size
+        self.progress = progress or JSONLinesProgress()
+        self.progress_interval = progress_interval
+        self.indexed = 0
+        self.skipped = 0
+        self.errors = 0
+        self._uncommitted = []
+
+    def run(self, top):
+        """Index the tree at top, returning the number of errors"""
+        scanner = aperture.TreeScanner(top, self.category_req, self.scan_workers, manifest=self.manifest)
+        ingest = self.library.bulk_ingest(self.chunk_size, on_commit=self._checkpoint)
+        # Opened after the catalog is set up, so that its connection sees it
+        self._metadata_cache = dao.MetadataCache(self.library)
+        self.progress.emit('start', top=top, library=self.library.filepath,
+                           manifest_entries=len(self.manifest))
+        next_report = time.monotonic() + self.progress_interval
+        completed = False
+
+        scanner.start()
+        try:
+            with ingest:
+                with exifparse.worker_context([__name__]).Pool(self.processes) as pool:
+                    results = pool.imap_unordered(_index_file, self._tasks(scanner), exifparse.DEFAULT_CHUNKSIZE)
+                    for filepath, identity, packed, error, spans in results:
+                        instrumentation.record_spans(spans)
+                        if error is not None:
+                            self.errors += 1
+                            self.progress.emit('error', path=filepath, error=error)
+                        else:
+                            self._store(ingest, filepath, identity, packed)
+
+                        if time.monotonic() >= next_report:
+                            next_report = time.monotonic() + self.progress_interval
+                            self._emit_progress('progress', scanner.progress, ingest.stats)
+            completed = True
+        finally:
+            scanner.stop()
+            self._metadata_cache.close()
+            # Files recorded so far were committed; staged ones weren't, and
+            # are indexed again next time
+            self.manifest.save(prune=completed)
+
+        self._emit_progress('done', scanner.progress, ingest.stats)
+        return self.errors
+
+    def _store(self, ingest, filepath, identity, packed):
+        # One malformed file is reported and skipped rather than ending the run
+        try:
+            categorised = exifparse.unpack_categorised(packed)
+            with instrumentation.span('index.store'):
+                ingest.add_file(filepath, categorised)
+            self._metadata_cache.put(filepath, categorised, identity)
+        except Exception as e:
+            self.errors += 1
+            logger.debug('Failed to store [%s]', filepath, exc_info=True)
+            self.progress.emit('error', path=filepath, error='{}: {}'.format(e.__class__.__name__, e))
+            return
+        self._uncommitted.append(filepath)
+        self.indexed += 1
+
+    def _tasks(self, scanner):
+        for filepath, category, crdate, size in scanner:
+            if category in Indexed_Categories:
+                yield (filepath, self.thumbnail_dir, instrumentation.enabled())
+            else:
+                # Nothing to store, so there's nothing to wait for
+                self.skipped += 1
+                self.manifest.record(filepath, None)
+
+    def _checkpoint(self):
+        self._metadata_cache.flush()
+        for filepath in self._uncommitted:
+            self.manifest.record(filepath, filepath)
+        self._uncommitted = []
+        self.manifest.save()
+        self.progress.emit('checkpoint', indexed=self.indexed, manifest_entries=len(self.manifest))
+
+    def _emit_progress(self, event, scan_progress, ingest_stats):
+        self.progress.emit(event, scanned=scan_progress.files, unchanged=scan_progress.unchanged,
+                           directories=scan_progress.directories, indexed=self.indexed,
+                           skipped=self.skipped, errors=self.errors, commits=ingest_stats.commits,
+                           elapsed=round(scan_progress.elapsed, 3),
+                           files_per_second=round(self.indexed / max(scan_progress.elapsed, 1e-6), 1),
+                           peak_rss_bytes=ingest_stats.peak_rss_bytes)
+
+
+class LibraryFeed(object):
+    """
+    Stores files as a WatchImporter imports them, adding the pictures among
+    them to the library's catalog and MetadataCache and committing each
+    batch straight away, so new captures are searchable within moments.
+
+    Called with lists of (source, destination, category) on the watching
+    thread, which is the only one to use the DAO's connection.
+    """
+    def __init__(self, library, thumbnail_dir=None, progress=None):
+        self.library = library
+        self.thumbnail_dir = thumbnail_dir
+        self.progress = progress
+        self.indexed = 0
+        self.errors = 0
+        self._ingest = library.bulk_ingest()
+        self._metadata_cache = dao.MetadataCache(library)
+        self._thumbnails = thumbnails.ThumbnailCache(thumbnail_dir) if thumbnail_dir is not None else None
+
+    def __call__(self, imported):
+        stored = []
+        for source, destination, category in imported:
+            if category not in Indexed_Categories:
+                continue
+            try:
+                with instrumentation.span('index.store'):
+                    self._ingest.add_file(destination, self._metadata_cache.load(destination))
+                stored.append(destination)
+            except Exception as e:
+                self.errors += 1
+                logger.warning('Failed to index [%s]: %s', destination, e)
+        if not stored:
+            return
+
+        self._ingest.commit()
+        self._metadata_cache.flush()
+        self.indexed += len(stored)
+        if self.progress is not None:
+            self.progress.emit('indexed', paths=stored, indexed=self.indexed)
+        logger.info('Indexed %d new files, %d in all', len(stored), self.indexed)
+
+        # After committing, so thumbnailing doesn't hold back the catalog
+        if self._thumbnails is not None:
+            for destination in stored:
+                try:
+                    self._thumbnails.get(destination, thumbnails.Thumbnail_Sizes[0])
+                except Exception as e:
+                    logger.warning('Failed to thumbnail [%s]: %s', destination, e)
+
+    def close(self):
+        self._ingest.commit()
+        self._metadata_cache.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index a tree of pictures into the library, without the GUI.')
+    parser.add_argument('top', help='top-level directory to index')
+    parser.add_argument('--library', default=DEFAULT_LIBRARY_PATH, help='library FileStorage to fill')
+    parser.add_argument('--manifest', default=None,
+                        help='checkpoint of the files indexed, by default beside the library')
+    parser.add_argument('--full', action='store_true',
+                        help='index every file, rather than resuming from the checkpoint')
+    parser.add_argument('--thumbnails', default=thumbnails.DEFAULT_CACHE_DIR, help='thumbnail cache directory')
+    parser.add_argument('--no-thumbnails', action='store_true', help="don't generate thumbnails")
+    parser.add_argument('--category-policy', choices=list(aperture.Category_Policies), default='unknown',
+                        help='how to categorise unknown file types; "ask" prompts on stdin')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes parsing and thumbnailing, by default one per CPU')
+    parser.add_argument('--scan-workers', type=int, default=aperture.DEFAULT_SCAN_WORKERS,
+                        help='threads scanning directories')
+    parser.add_argument('--chunk-size', type=int, default=dao.DEFAULT_INGEST_CHUNK_SIZE,
+                        help='files committed to the catalog at a time, and so between checkpoints')
+    parser.add_argument('--progress-interval', type=float, default=DEFAULT_PROGRESS_INTERVAL,
+                        help='seconds between progress events')
+    parser.add_argument('--instrument', metavar='PATH', default=None,
+                        help='record timing spans of this process, written as JSON to PATH at exit')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log debugging detail to stderr')
+    args = parser.parse_args(argv)
+
+    if args.instrument:
+        instrumentation.enable(args.instrument)
+    else:
+        instrumentation.enable_from_environment()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stderr)
+    manifest_path = args.manifest or args.library + '.manifest.json'
+    if args.full and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    with dao.ZODBDAO(args.library) as library:
+        indexer = Indexer(library, ScanManifest(manifest_path), aperture.Category_Policies[args.category_policy],
+                          thumbnail_dir=None if args.no_thumbnails else args.thumbnails,
+                          processes=args.processes, scan_workers=args.scan_workers,
+                          chunk_size=args.chunk_size, progress_interval=args.progress_interval)
+        errors = indexer.run(os.path.abspath(args.top))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+import atexit
+from bisect import bisect_left
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Environment variable enabling instrumentation at startup, set to the path
+# of the JSON written at exit, or to 1 for DEFAULT_DUMP_PATH
+ENVIRONMENT_VARIABLE = 'PICMAN_INSTRUMENT'
+DEFAULT_DUMP_PATH = 'picman-spans.json'
+# Samples of each measure kept per span name for percentiles
+SAMPLE_SIZE = 4096
+# Upper bounds, in milliseconds, of the wall time histogram's buckets
+Histogram_Bounds_Ms = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+Percentiles = (50, 90, 99)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_STATM_PATH = '/proc/self/statm'
+_IO_PATH = '/proc/thread-self/io'
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _read_rss():
+    """Current resident set size in bytes, or the peak where unavailable"""
+    try:
+        with open(_STATM_PATH, 'rb') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _read_bytes_read():
+    """Bytes read by the calling thread, or None where unavailable"""
+    try:
+        with open(_IO_PATH, 'rb') as io:
+            for line in io:
+                if line.startswith(b'rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Measure(object):
+    """
+    Running total, count and maximum of one measure of a span, keeping a
+    uniform random sample of its values for percentiles
+    """
+    __slots__ = ('count', 'total', 'maximum', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = None
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(value)
+        else:
+            # Reservoir sampling, so every value is equally likely to be kept
+            index = random.randrange(self.count)
+            if index < SAMPLE_SIZE:
+                self.samples[index] = value
+
+    def percentile(self, percent):
+        return _percentile(sorted(self.samples), percent)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        summary = {'count': self.count, 'total': self.total, 'max': self.maximum,
+                   'mean': self.total / self.count if self.count else None}
+        for percent in Percentiles:
+            summary['p{}'.format(percent)] = _percentile(ordered, percent)
+        return summary
+
+
+class SpanStats(object):
+    """Aggregated measures of every span of one name"""
+    __slots__ = ('wall', 'cpu', 'rss_delta', 'bytes_read', 'histogram')
+
+    def __init__(self):
+        self.wall = Measure()
+        self.cpu = Measure()
+        self.rss_delta = Measure()
+        self.bytes_read = Measure()
+        # Counts of wall times up to each of Histogram_Bounds_Ms, then beyond
+        self.histogram = [0] * (len(Histogram_Bounds_Ms) + 1)
+
+    def add(self, wall, cpu, rss_delta, bytes_read):
+        self.wall.add(wall)
+        self.cpu.add(cpu)
+        self.rss_delta.add(rss_delta)
+        if bytes_read is not None:
+            self.bytes_read.add(bytes_read)
+        self.histogram[bisect_left(Histogram_Bounds_Ms, wall * 1000)] += 1
+
+    def summary(self):
+        return {
+            'wall_seconds': self.wall.summary(),
+            'cpu_seconds': self.cpu.summary(),
+            'rss_delta_bytes': self.rss_delta.summary(),
+            'bytes_read': self.bytes_read.summary(),
+            'wall_histogram_ms': dict(zip([str(b) for b in Histogram_Bounds_Ms] + ['inf'], self.histogram)),
+        }
+
+
+class Recorder(object):
+    """Thread-safe collection of SpanStats by span name"""
+    def __init__(self):
+        self.started = time.time()
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, wall, cpu, rss_delta, bytes_read):
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = SpanStats()
+            stats.add(wall, cpu, rss_delta, bytes_read)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._spans)
+
+    def stats(self, name):
+        with self._lock:
+            return self._spans.get(name)
+
+    def summary(self):
+        with self._lock:
+            spans = {name: stats.summary() for name, stats in self._spans.items()}
+        return {'pid': os.getpid(), 'started': self.started, 'finished': time.time(), 'spans': spans}
+
+    def dump(self, filepath):
+        """Write the summary as JSON, replacing filepath atomically"""
+        temp_path = '{}.{}.tmp'.format(filepath, os.getpid())
+        with open(temp_path, 'w') as dump_file:
+            json.dump(self.summary(), dump_file, indent=1, sort_keys=True)
+        os.replace(temp_path, filepath)
+
+
+class _Span(object):
+    __slots__ = ('recorder', 'name', 'wall', 'cpu', 'rss', 'bytes_read')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.rss = _read_rss()
+        self.bytes_read = _read_bytes_read()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        bytes_read = _read_bytes_read()
+        if bytes_read is not None and self.bytes_read is not None:
+            bytes_read -= self.bytes_read
+        else:
+            bytes_read = None
+        self.recorder.add(self.name, wall, cpu, _read_rss() - self.rss, bytes_read)
+        return False
+
+
+class _NullSpan(object):
+    """Stands in for a span while disabled, doing nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+# The Recorder while enabled, otherwise None
+_recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def recorder():
+    return _recorder
+
+
+def span(name):
+    """
+    Context manager measuring the wall time, CPU time of the calling
+    thread, RSS change and bytes read by the calling thread of its block as
+    a span of name. While disabled, it costs a global lookup.
+    """
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name)
+
+
+def record(name, wall, cpu=0.0, rss_delta=0, bytes_read=None):
+    """Record a span measured by other means, e.g. across threads"""
+    if _recorder is not None:
+        _recorder.add(name, wall, cpu, rss_delta, bytes_read)
+
+
+class _Collector(object):
+    """Stands in for the Recorder in a worker process, keeping each span"""
+    def __init__(self):
+        self.spans = []
+
+    def add(self, name, wall, cpu, rss_delta, bytes_read):
+        self.spans.append((name, wall, cpu, rss_delta, bytes_read))
+
+
+@contextlib.contextmanager
+def collecting(enabled=True):
+    """
+    Context manager for the task of a worker process, whose spans would
+    otherwise be lost with it, collecting those of its block into the list
+    it yields. Return the list with the task's result for the parent to pass
+    to record_spans. Does nothing unless enabled, normally enabled() in the
+    parent when it handed out the task.
+    """
+    global _recorder
+    spans = []
+    if not enabled:
+        yield spans
+        return
+    previous = _recorder
+    collector = _Collector()
+    _recorder = collector
+    try:
+        yield spans
+    finally:
+        _recorder = previous
+        spans.extend(collector.spans)
+
+
+def record_spans(spans):
+    """Record the spans a worker collected, while enabled"""
+    if _recorder is not None:
+        for span in spans:
+            _recorder.add(*span)
+
+
+def instrumented(name):
+    """Decorator running each call of the function in a span of name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _Span(_recorder, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(dump_path=None):
+    """
+    Start recording spans in this process, writing their summary as JSON
+    to dump_path, if given, at exit. Returns the Recorder.
+    """
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder()
+        if dump_path is not None:
+            atexit.register(_dump_at_exit, _recorder, dump_path, os.getpid())
+        logger.info('Instrumentation enabled%s', ', dumping to [{}]'.format(dump_path) if dump_path else '')
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def enable_from_environment():
+    """Enable as set by ENVIRONMENT_VARIABLE, returning whether enabled"""
+    setting = os.environ.get(ENVIRONMENT_VARIABLE, '')
+    if setting in ('', '0'):
+        return False
+    enable(DEFAULT_DUMP_PATH if setting == '1' else setting)
+    return True
+
+
+def _dump_at_exit(recorder, dump_path, pid):
+    # Forked children inherit the handler, but only the process that
+    # enabled instrumentation writes the dump
+    if os.getpid() != pid:
+        return
+    try:
+        recorder.dump(dump_path)
+    except OSError as e:
+        logger.warning('Failed to write spans to [%s]: %s', dump_path, e)
+
+
+def format_summary(names=None):
+    """Lines of span count and wall time percentiles, for display"""
+    if _recorder is None:
+        return []
+    lines = []
+    for name in names or _recorder.names():
+        stats = _recorder.stats(name)
+        if stats is None:
+            continue
+        wall = stats.wall
+        lines.append('{}: n={} p50={:.1f}ms p99={:.1f}ms max={:.1f}ms'.format(
+            name, wall.count, wall.percentile(50) * 1000, wall.percentile(99) * 1000, wall.maximum * 1000))
+    return lines
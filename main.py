@@ -1,45 +1,78 @@
+import time
+# Start of the app's own startup, for StartupTimings
+_Import_Started = time.perf_counter()
+
 import kivy
 kivy.require('1.10.1')
 
-from contextlib import contextmanager
-from io import BytesIO
 from collections import OrderedDict
 
 from kivy.app import App
 from kivy.clock import Clock, mainthread
-from kivy.core.image import Image as CoreImage
-from kivy.graphics import Color, Rectangle
+from kivy.core.image import ImageData, ImageLoaderBase
+from kivy.core.window import Window
+from kivy.graphics.texture import Texture
 from kivy.loader import Loader
-from kivy.metrics import dp, sp
+from kivy.metrics import sp
 from kivy.properties import StringProperty, ListProperty, ObjectProperty, NumericProperty, ReferenceListProperty
 from kivy.uix.behaviors import FocusBehavior
-from kivy.uix.behaviors.compoundselection import CompoundSelectionBehavior
 from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.button import Button
-from kivy.uix.gridlayout import GridLayout
-from kivy.uix.anchorlayout import AnchorLayout
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.layout import LayoutSelectionBehavior
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recyclegridlayout import RecycleGridLayout
 from kivy.uix.image import Image
 from kivy.uix.label import Label
-from kivy.uix.relativelayout import RelativeLayout
-from kivy.uix.scatter import Scatter
 from kivy.uix.screenmanager import ScreenManager, Screen
-from kivy.uix.slider import Slider
 from kivy.uix.splitter import Splitter
-from kivy.uix.stacklayout import StackLayout
-from kivy.uix.tabbedpanel import TabbedPanel
 from kivy.uix.textinput import TextInput
+# Widgets used only in kivypil.kv are loaded by the Factory when first used
 
 from kivy.garden.simpletablelayout import SimpleTableLayout
 
-import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import heapq
+import importlib.machinery
+import itertools
+
+import decoding
 import exifparse
-import multiprocessing
+import instrumentation
+import logging
 import os
-import PIL
-import psutil
-import rawpy
+import thumbnails
 import threading
 
+logger = logging.getLogger(__name__)
+# Enabled as early as possible, so that startup is recorded too
+instrumentation.enable_from_environment()
+
+# Extensions of the files shown when loading a folder
+Image_Extensions = ('.JPG', '.JPEG')
+# Extensions of RAW files, which are decoded with rawpy
+Raw_Extensions = ('.RAF',)
+# Long-edge size, in pixels, of the thumbnails shown in the grid
+GRID_THUMBNAIL_SIZE = 256
+# Number of thumbnails generated concurrently while loading a folder
+THUMBNAIL_WORKERS = 4
+# Texture memory, in MB, that TextureCache keeps resident
+DEFAULT_TEXTURE_BUDGET_MB = 256
+# Seconds per frame that DecodePool may spend turning decoded pixels into textures
+FRAME_UPLOAD_BUDGET = 0.004
+# Priorities of LoadScheduler loads, most urgent first
+PRIORITY_VISIBLE = 0
+PRIORITY_PREFETCH = 1
+# Number of decodes LoadScheduler keeps in flight at once
+MAX_CONCURRENT_LOADS = os.cpu_count() or 2
+# Number of rows beyond the view, in the scroll direction, to prefetch
+PREFETCH_ROWS = 3
+# Key code of F12, which toggles the instrumentation overlay
+Keyboard_F12 = 293
+# Bytes per pixel of the texture colour formats
+_Texture_Bytes_Per_Pixel = {'rgb': 3, 'rgba': 4, 'luminance': 1}
+
 
 class PropertyLabel(Label):
     bcolor = ListProperty([1, 1, 1, 1])
@@ -80,18 +113,152 @@ class Sidebar(Splitter):
 
 
 class MetadataTable(SimpleTableLayout):
-    pass
+    """
+    Table of metadata fields by category, under an optional title.
+
+    Widgets are kept between calls to show, which only changes their text
+    while the fields shown stay the same, and rebuilds the table only when
+    they change.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._fields = None
+        self._title_label = None
+        self._value_texts = []
+
+    def show(self, categorised, title=None):
+        fields = (title is not None,
+                  tuple((category, tuple((item.name, item.rows) for item in items))
+                        for category, items in categorised.items()))
+        if fields != self._fields:
+            self._rebuild(categorised, title is not None)
+            self._fields = fields
+
+        if self._title_label is not None and self._title_label.text != title:
+            self._title_label.text = title
+        values = (item.data for items in categorised.values() for item in items)
+        for value_text, data in zip(self._value_texts, values):
+            if value_text.text != data:
+                value_text.text = data
+
+    def _rebuild(self, categorised, titled):
+        self.clear_widgets()
+        self._title_label = None
+        self._value_texts = []
+
+        self.cols = 3 if categorised else 1
+        self.rows = (int(titled) + len(categorised) +
+                     sum(sum(item.rows for item in items) for items in categorised.values()))
+        self.height = self.rows * sp(20)
+
+        if titled:
+            self._title_label = PropertyLabel(text='', colspan=self.cols, bcolor=[1, 0, 0, 1],
+                                              halign='center', valign='middle', font_size=30)
+            self.add_widget(self._title_label)
+
+        for category, items in categorised.items():
+            self.add_widget(PropertyLabel(text=category, colspan=3, bold=True, halign='center', valign='middle', font_size=30))
+            for item in items:
+                self.add_widget(PropertyLabel(text=f"{item.name}:", bold=True, size_hint=(1.0, 1.0), rowspan=item.rows, halign='right', valign='top'))
+                value_text = PropertyText(text='', multiline=True, rowspan=item.rows, colspan=2)
+                self.add_widget(value_text)
+                self._value_texts.append(value_text)
+
+
+class InstrumentationOverlay(Label):
+    """
+    Summary of the instrumentation's spans over the window, refreshed every
+    interval seconds while shown. F12 toggles it.
+    """
+    def __init__(self, interval=1.0, **kwargs):
+        kwargs.setdefault('size_hint', (None, None))
+        kwargs.setdefault('halign', 'left')
+        kwargs.setdefault('valign', 'top')
+        kwargs.setdefault('font_size', sp(12))
+        super().__init__(**kwargs)
+        self.bind(texture_size=self.setter('size'))
+        self._refresh = Clock.schedule_interval(self.refresh, interval)
+
+    def refresh(self, *args):
+        self.text = '\n'.join(instrumentation.format_summary()) or 'No spans yet'
+        if self.parent is not None:
+            self.pos = (0, self.parent.height - self.height)
+
+    def toggle(self):
+        if self.parent is None:
+            Window.add_widget(self)
+            self._refresh()
+            self.refresh()
+        else:
+            self._refresh.cancel()
+            Window.remove_widget(self)
 
 
 class ImageLibraryScreen(Screen):
     pass
 
 
-class SelectableGrid(FocusBehavior, CompoundSelectionBehavior, GridLayout):
+class ImageGrid(RecycleView):
+    """
+    Scrolling view over the pictures' data, creating SelectablePicture
+    widgets only for the rows in view plus prefetch_rows either side, and
+    recycling them as it scrolls. As it scrolls, the thumbnails of the next
+    PREFETCH_ROWS rows in the scroll direction are prefetched into the app's
+    TextureCache.
+    """
+    prefetch_rows = NumericProperty(2)
+    _last_scroll_y = 1.0
+
+    def on_scroll_y(self, grid, scroll_y):
+        # Content moves up, towards later rows, as scroll_y decreases
+        direction = 1 if scroll_y < self._last_scroll_y else -1
+        self._last_scroll_y = scroll_y
+        self.prefetch(direction)
+
+    def visible_rows(self):
+        """(first, last) indices of the rows at least partly in view"""
+        layout = self.layout_manager
+        (left, bottom, width, height) = super().get_viewport()
+        row_height = layout.default_size[1] + layout.spacing[1]
+        first = int((layout.height - bottom - height) // row_height)
+        last = int((layout.height - bottom) // row_height)
+        return (max(0, first), max(0, last))
+
+    def prefetch(self, direction=1):
+        layout = self.layout_manager
+        cache = App.get_running_app().texture_cache
+        if layout is None or cache is None or not self.data or not layout.default_size[1]:
+            return
+
+        (first, last) = self.visible_rows()
+        (start, end) = ((last + 1, last + 1 + PREFETCH_ROWS) if direction > 0
+                        else (max(0, first - PREFETCH_ROWS), first))
+        cols = max(1, int(layout.cols or 1))
+        cache.prefetch(item['thumbnail'] for item in self.data[start * cols:end * cols] if item.get('thumbnail'))
+
+    def get_viewport(self):
+        (left, bottom, width, height) = super().get_viewport()
+        layout = self.layout_manager
+        if layout is None or not getattr(layout, 'default_size', None):
+            return (left, bottom, width, height)
+
+        margin = self.prefetch_rows * (layout.default_size[1] + layout.spacing[1])
+        extended_bottom = max(0, bottom - margin)
+        extended_top = min(layout.height, bottom + height + margin)
+        return (left, extended_bottom, width, extended_top - extended_bottom)
+
+
+class SelectableGrid(FocusBehavior, LayoutSelectionBehavior, RecycleGridLayout):
+    """
+    Layout of an ImageGrid, adding keyboard and touch selection over its
+    data. Selected nodes are indices into the data.
+    """
     metadata_layout = None
+    metadata_table = None
 
-    def __init__(self, **kwargs):
-        GridLayout.__init__(self, **kwargs)
+    def do_layout(self, *largs, **kwargs):
+        with instrumentation.span('grid.layout'):
+            super().do_layout(*largs, **kwargs)
 
     def keyboard_on_key_down(self, window, keycode, text, modifiers):
         if super().keyboard_on_key_down(window, keycode, text, modifiers):
@@ -107,58 +274,6 @@ class SelectableGrid(FocusBehavior, CompoundSelectionBehavior, GridLayout):
             return True
         return False
 
-    def add_widget(self, widget):
-        widget.bind(on_touch_down=self.button_touch_down
-            # , on_touch_up=self.button_touch_up
-                    )
-        return super().add_widget(widget)
-
-    def button_touch_down(self, button, touch):
-        if button.collide_point(*touch.pos):
-            self.select_with_touch(button, touch)
-
-    def button_touch_up(self, button, touch):
-        if not (button.collide_point(*touch.pos) or self.touch_multiselect):
-            self.deselect_node(button)
-
-    @mainthread
-    def select_node(self, node):
-        try:
-            if hasattr(node, 'select'):
-                node.select()
-                node.selected = True
-        except Exception as e:
-            print('SelectableGrid.select_node(node={}); node.select() failed. Exception: {}'.format(node, e))
-
-        try:
-            if hasattr(node, 'parent'):
-                if hasattr(node.parent, 'select'):
-                    node.parent.select()
-                    node.parent.selected = True
-        except Exception as e:
-            print('SelectableGrid.select_node(node={}); node.parent.select() failed. Exception: {}'.format(node, e))
-
-        return super().select_node(node)
-
-    @mainthread
-    def deselect_node(self, node):
-        try:
-            if hasattr(node, 'deselect'):
-                node.deselect()
-                node.selected = False
-        except Exception as e:
-            print('SelectableGrid.deselect_node(node={}); node.deselect() failed. Exception: {}'.format(node, e))
-
-        try:
-            if hasattr(node, 'parent'):
-                if hasattr(node.parent, 'deselect'):
-                    node.parent.deselect()
-                    node.parent.selected = False
-        except Exception as e:
-            print('SelectableGrid.deselect_node(node={}); node.parent.deselect() failed. Exception: {}'.format(node, e))
-
-        super().deselect_node(node)
-
     @mainthread
     def on_selected_nodes(self, grid, nodes):
         if self.metadata_layout is None:
@@ -167,77 +282,35 @@ class SelectableGrid(FocusBehavior, CompoundSelectionBehavior, GridLayout):
             # parent 1 is the boxlayout holding the main screen panel
             # parent 2 is the boxlayout holding the image screen layout
             # parent 3 is the image screen itself, which holds the ids
-            print('='*80)
-            print('on_selected_nodes')
-            print('self={} ({}): {}; {}\n'.format(self.id, self, self.children, self.ids))
-            print('self.parent={} ({}): {}; {}\n'.format(self.parent.id, self.parent, self.parent.children, self.parent.ids))
-            print('self.parent.parent={} ({}): {}; {}\n'.format(self.parent.parent.id, self.parent.parent, self.parent.parent.children, self.parent.parent.ids))
-            print('self.parent.parent.parent={} ({}): {}; {}\n'.format(self.parent.parent.parent.id, self.parent.parent.parent, self.parent.parent.parent.children, self.parent.parent.parent.ids))
-            print('self.parent.parent.parent.parent={} ({}): {}; {}\n'.format(self.parent.parent.parent.parent.id, self.parent.parent.parent.parent, self.parent.parent.parent.parent.children, self.parent.parent.parent.parent.ids))
-            print('='*80)
+            logger.debug('on_selected_nodes: finding the metadata layout from [%s] up through [%s]',
+                         self, self.parent.parent.parent.parent)
             self.metadata_layout = self.parent.parent.parent.parent.ids.metadata_layout
 
-        metadata_table = None
+        if self.metadata_table is None:
+            try:
+                self.metadata_table = self.metadata_layout.children[-1].children[-1]
+            except Exception as e:
+                logger.warning('%s.on_selected_nodes(grid=%s, nodes=%s); Caught %s: %s',
+                               self.__class__.__name__, grid, nodes, e.__class__.__name__, e)
 
-        try:
-            metadata_table = self.metadata_layout.children[-1].children[-1]
-            while metadata_table.children:
-                metadata_table.remove_widget(metadata_table.children[0])
-        except Exception as e:
-            print('{}.on_selected_nodes(grid={}, nodes={}); Caught {}: {}'
-                  .format(self.__class__.__name__, grid, nodes,
-                          e.__class__.__name__, e))
+            if not isinstance(self.metadata_table, MetadataTable):
+                self.metadata_table = MetadataTable(id='metadata_table', cols=1, rows=1, size_hint=(1.0, None))
+                self.metadata_layout.add_widget(self.metadata_table)
 
-        if not metadata_table:
-            metadata_table = MetadataTable(id='metadata_table', cols=1, rows=1, size_hint=(1.0, None))
-            self.metadata_layout.add_widget(metadata_table)
+        data = self.recycleview.data
 
         if len(nodes) == 1:
             # Single node selected, display the metadata
-            metadata_list = nodes[0].metadata
-            metadata_table.cols = 3
-            metadata_table.rows = (len(metadata_list) +
-                sum(sum(i.rows for i in v if i) for v in metadata_list.values()))
-            metadata_table.height = metadata_table.rows * sp(20)
-
-            for category, properties in metadata_list.items():
-                metadata_table.add_widget(PropertyLabel(text=category, colspan=3, bold=True, halign='center', valign='middle', font_size=30))
-                for prop in properties:
-                    try:
-                        metadata_table.add_widget(PropertyLabel(text=f"{prop.name}:", bold=True, size_hint=(1.0, 1.0), rowspan=prop.rows, halign='right', valign='top'))
-                    except:
-                        print(f'Exception raised while adding label for "{prop.name}" data "{prop.data}"')
-                        print(f'Properties:({", ".join(properties)})')
-                        raise
-
-                    try:
-                        metadata_table.add_widget(PropertyText(text=prop.data, multiline=True, rowspan=prop.rows, colspan=2))
-                    except:
-                        print(f'Exception raised while adding text input for "{prop.name}" data "{prop.data}"')
-                        print(f'Properties:({", ".join(str(p) for p in properties)})')
-                        raise
+            self.metadata_table.show(data[nodes[0]]['metadata'])
         elif len(nodes) == 0:
             # No nodes selected, display defaults
-            metadata_table.rows = 1
-            metadata_table.cols = 1
-            metadata_table.add_widget(
-                PropertyLabel(text="No nodes selected",
-                              size_hint=(1.0, None),
-                              bcolor=[1, 0, 0, 1],
-                              halign='center',
-                              valign='middle',
-                              font_size=30))
+            self.metadata_table.show(OrderedDict(), "No nodes selected")
         else:
-            # More than one node selected, display how many
-            metadata_table.rows = 1
-            metadata_table.cols = 1
-            metadata_table.add_widget(
-                PropertyLabel(text=f"{len(nodes)} nodes selected",
-                              size_hint=(1.0, None),
-                              bcolor=[1, 0, 0, 1],
-                              halign='center',
-                              valign='middle',
-                              font_size=30))
+            # More than one node selected, display how many and a summary of
+            # their metadata
+            self.metadata_table.show(
+                exifparse.summarise_categorised(data[node]['metadata'] for node in nodes),
+                f"{len(nodes)} nodes selected")
 
         self.metadata_layout.do_layout()
 
@@ -247,7 +320,7 @@ class Image(Image):
         pass
 
 
-class SelectablePicture(BoxLayout):
+class SelectablePicture(RecycleDataViewBehavior, BoxLayout):
     # Properties to control the background colour of the widget
     r = NumericProperty(0.3)
     g = NumericProperty(0.5)
@@ -270,15 +343,48 @@ class SelectablePicture(BoxLayout):
     # Texture of the image to display
     texture = ObjectProperty(None)
     # Filename source of the image
-    source = StringProperty(None)
+    source = StringProperty('')
+    # Filename of a cached thumbnail to display in place of the source
+    thumbnail = StringProperty('')
     # Metadata container for the image
-    metadata = None
+    metadata = ObjectProperty(None, allownone=True)
+    # Index of the data this view currently shows
+    index = None
 
-    def __init__(self, source, metadata, texture=None, **kwargs):
-        super().__init__(source=source, texture=texture, **kwargs)
-        self.metadata = metadata
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.deselect()
 
+    def refresh_view_attrs(self, rv, index, data):
+        previous_thumbnail = self.thumbnail
+        self.index = index
+        result = super().refresh_view_attrs(rv, index, data)
+        cache = App.get_running_app().texture_cache
+        if cache is not None and previous_thumbnail and previous_thumbnail != self.thumbnail:
+            # Scrolled out of view; let the load give way to those in view
+            cache.release(previous_thumbnail)
+        if self.texture is None and self.thumbnail and cache is not None:
+            self.texture = cache.get(self.thumbnail)
+            if self.texture is None:
+                cache.request(self.thumbnail, partial(self._texture_loaded, index, self.thumbnail))
+        return result
+
+    def _texture_loaded(self, index, thumbnail, texture):
+        # The view may have been recycled for other data while loading
+        if self.index == index and self.thumbnail == thumbnail:
+            self.texture = texture
+
+    def on_touch_down(self, touch):
+        if self.collide_point(*touch.pos):
+            return self.parent.select_with_touch(self.index, touch)
+        return False
+
+    def apply_selection(self, rv, index, is_selected):
+        if is_selected:
+            self.select()
+        else:
+            self.deselect()
+
     def select(self):
         # self.background_colour = (0, 0, 1, 1)
         self.a = 1
@@ -292,51 +398,301 @@ class SelectablePicture(BoxLayout):
         self.border_a = 0
 
 
-@contextmanager
-def report_memory_usage(block_name):
-    proc = psutil.Process(os.getpid())
-    start_bytes = proc.memory_info().rss
-    print('[{}] Start of [{}]: {} MB'.format(
-          datetime.datetime.now(), block_name, start_bytes / float(2 ** 20))
-    )
-
-    try:
-        yield proc
-    finally:
-        end_bytes = proc.memory_info().rss
-        print('[{}] End of [{}]: {} MB (Delta: {} MB) '.format(
-              datetime.datetime.now(), block_name, end_bytes / float(2 ** 20),
-              (end_bytes - start_bytes) / float(2 ** 20)
-            )
-        )
-
-
-def _load_jpg_callback(filename):
-    def action(filename):
-        return Image(source=filename, size_hint=(1.0, 1.0))
-    process = multiprocessing.Process(target=action, args=(filename,), daemon=True)
-    process.start()
-    return process
-
-
-def _post_jpg_callback(process):
-    process.join()
-
-
-def _load_converted_callback(filename):
-    pass
-
-
-def _post_converted_callback(process):
-    pass
-
-
-def _load_raw_callback(filename):
-    pass
-
+class DecodePool(object):
+    """
+    Decodes images in a pool of worker processes, which return the pixels
+    through shared memory rather than pickling them.
+
+    Decoded pixels queue up for a dispatcher that runs on the main thread
+    each frame. It turns them into textures for at most frame_budget
+    seconds per frame, so that decoding never stalls the frame loop, and
+    calls each request's callback exactly once: with the texture, or with
+    None if the decode failed or was cancelled.
+    """
+    def __init__(self, processes=None, frame_budget=FRAME_UPLOAD_BUDGET):
+        self.frame_budget = frame_budget
+        self._executor = ProcessPoolExecutor(max_workers=processes, mp_context=exifparse.worker_context(['decoding']))
+        self._ready = deque()
+        self._discarded = set()
+        self._dispatcher = Clock.schedule_interval(self._dispatch, 0)
+
+    def submit(self, filename, callback, size=None, mode=None, raw_tier=None):
+        """
+        Queue filename for decoding, as decoding.decode_to_shared_memory
+        takes it, returning the Future of the decode
+        """
+        submitted = time.perf_counter()
+        future = self._executor.submit(decoding.decode_to_shared_memory, filename, size, mode, raw_tier)
+
+        def done(future):
+            # Called from the executor's thread; appending to a deque is atomic
+            instrumentation.record('decode', time.perf_counter() - submitted)
+            self._ready.append((future, filename, callback))
+        future.add_done_callback(done)
+        return future
+
+    def cancel(self, future):
+        """
+        Stop a decode from producing a texture, so its callback gets None,
+        returning whether it was stopped before running
+        """
+        if future.cancel():
+            return True
+        self._discarded.add(future)
+        return False
 
-def _post_raw_callback(process):
-    pass
+    def close(self):
+        self._dispatcher.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        # Free the shared memory of anything decoded but not yet dispatched
+        while self._ready:
+            (future, filename, callback) = self._ready.popleft()
+            self._release(future)
+
+    def _dispatch(self, dt):
+        deadline = time.perf_counter() + self.frame_budget
+        while self._ready and time.perf_counter() < deadline:
+            (future, filename, callback) = self._ready.popleft()
+            if future in self._discarded or future.cancelled():
+                self._discarded.discard(future)
+                self._release(future)
+                callback(None)
+                continue
+
+            texture = None
+            try:
+                (name, width, height, colorfmt, length) = future.result()
+                with instrumentation.span('texture.upload'):
+                    texture = decoding.read_shared_memory(
+                        name, length, lambda view: texture_from_pixels(width, height, colorfmt, view))
+            except Exception as e:
+                logger.warning('DecodePool failed to load [%s]; Caught %s: %s',
+                               filename, e.__class__.__name__, e)
+            callback(texture)
+
+    @staticmethod
+    def _release(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        (name, width, height, colorfmt, length) = future.result()
+        decoding.read_shared_memory(name, length, None)
+
+
+class LoadScheduler(object):
+    """
+    Feeds image loads to a DecodePool in priority order: PRIORITY_VISIBLE,
+    then PRIORITY_PREFETCH, first come first served within each. No more
+    than max_concurrent decodes are in flight at once.
+
+    Loads are identified by key, and scheduling a key that is already queued
+    or in flight adds its callback, raising its priority if more urgent.
+    Loads can be cancelled singly or all at once, as when the folder changes,
+    and callbacks of a cancelled load are never called. Callbacks are called
+    on the main thread with the texture, or None if the load failed. Use
+    from the main thread only.
+    """
+    def __init__(self, decode_pool, max_concurrent=MAX_CONCURRENT_LOADS):
+        self.decode_pool = decode_pool
+        self.max_concurrent = max_concurrent
+        self.completed = 0
+        self._heap = []
+        self._queued = {}
+        self._in_flight = {}
+        # Cancelled requests still decoding, by id, which hold their slot
+        # until they finish but no longer answer for their key
+        self._cancelled = {}
+        self._sequence = itertools.count()
+
+    @property
+    def pending(self):
+        """(queued, in flight) load counts"""
+        return (len(self._queued), len(self._in_flight) + len(self._cancelled))
+
+    def schedule(self, key, filename, callback, priority=PRIORITY_VISIBLE, **decode_kwargs):
+        if key in self._in_flight:
+            self._in_flight[key]['callbacks'].append(callback)
+            return
+
+        request = self._queued.get(key)
+        if request is None:
+            request = {'filename': filename, 'callbacks': [callback],
+                       'priority': priority, 'decode_kwargs': decode_kwargs}
+            self._queued[key] = request
+            heapq.heappush(self._heap, (priority, next(self._sequence), key))
+        else:
+            request['callbacks'].append(callback)
+            self.reprioritise(key, min(priority, request['priority']))
+        self._pump()
+
+    def reprioritise(self, key, priority):
+        request = self._queued.get(key)
+        if request is not None and request['priority'] != priority:
+            # The old heap entry is skipped when popped, as its priority no
+            # longer matches the request's
+            request['priority'] = priority
+            heapq.heappush(self._heap, (priority, next(self._sequence), key))
+
+    def priority_of(self, key):
+        request = self._queued.get(key) or self._in_flight.get(key)
+        return request['priority'] if request else None
+
+    def cancel(self, key):
+        if self._queued.pop(key, None) is not None:
+            return
+        request = self._in_flight.pop(key, None)
+        if request is not None:
+            # Scheduling the key again starts a fresh load rather than
+            # joining this one
+            request['callbacks'] = []
+            self._cancelled[id(request)] = request
+            self.decode_pool.cancel(request['future'])
+
+    def cancel_all(self):
+        for key in list(self._queued) + list(self._in_flight):
+            self.cancel(key)
+        self._heap = []
+
+    def _pump(self):
+        while self._heap and len(self._in_flight) + len(self._cancelled) < self.max_concurrent:
+            (priority, sequence, key) = heapq.heappop(self._heap)
+            request = self._queued.get(key)
+            if request is None or request['priority'] != priority:
+                continue
+            del self._queued[key]
+            self._in_flight[key] = request
+            request['future'] = self.decode_pool.submit(
+                request['filename'], partial(self._finished, key, request), **request['decode_kwargs'])
+
+    def _finished(self, key, request, texture):
+        if self._in_flight.get(key) is request:
+            del self._in_flight[key]
+        else:
+            self._cancelled.pop(id(request), None)
+        self.completed += 1
+        for callback in request['callbacks']:
+            callback(texture)
+        self._pump()
+
+
+class TextureCache(object):
+    """
+    Thumbnail textures keyed by filename, holding at most budget_mb of
+    texture memory and evicting the least recently used beyond that.
+
+    Files are loaded through a LoadScheduler. request calls back, on the
+    main thread, once a texture is ready. prefetch loads ahead of need at
+    PRIORITY_PREFETCH, cancelling prefetches from the previous call that
+    are no longer wanted, and release demotes a load nothing is showing
+    any more to a prefetch, for the next prefetch call to cancel.
+    """
+    def __init__(self, scheduler, budget_mb=DEFAULT_TEXTURE_BUDGET_MB):
+        self.scheduler = scheduler
+        self.budget_bytes = budget_mb * 2 ** 20
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._textures = OrderedDict()
+        self._prefetching = set()
+
+    def get(self, filename):
+        entry = self._textures.get(filename)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._textures.move_to_end(filename)
+        self.hits += 1
+        return entry[0]
+
+    def request(self, filename, callback, priority=PRIORITY_VISIBLE):
+        texture = self.get(filename)
+        if texture is not None:
+            callback(texture)
+            return
+        self._prefetching.discard(filename)
+        self.scheduler.schedule(filename, filename, partial(self._loaded, filename, callback), priority)
+
+    def prefetch(self, filenames):
+        wanted = set(filename for filename in filenames if filename not in self._textures)
+        for filename in self._prefetching - wanted:
+            if self.scheduler.priority_of(filename) == PRIORITY_PREFETCH:
+                self.scheduler.cancel(filename)
+        for filename in wanted - self._prefetching:
+            self.scheduler.schedule(filename, filename, partial(self._loaded, filename, None), PRIORITY_PREFETCH)
+        self._prefetching = wanted
+
+    def release(self, filename):
+        if filename not in self._textures and self.scheduler.priority_of(filename) is not None:
+            self.scheduler.reprioritise(filename, PRIORITY_PREFETCH)
+            self._prefetching.add(filename)
+
+    def close(self):
+        self._textures.clear()
+        self.used_bytes = 0
+
+    def _loaded(self, filename, callback, texture):
+        self._prefetching.discard(filename)
+        if texture is None:
+            return
+        if filename not in self._textures:
+            self._put(filename, texture)
+        if callback is not None:
+            callback(texture)
+
+    def _put(self, filename, texture):
+        size = texture.width * texture.height * _Texture_Bytes_Per_Pixel.get(texture.colorfmt, 4)
+        self._textures[filename] = (texture, size)
+        self.used_bytes += size
+        while self.used_bytes > self.budget_bytes and len(self._textures) > 1:
+            (evicted, (evicted_texture, evicted_size)) = self._textures.popitem(last=False)
+            self.used_bytes -= evicted_size
+
+
+class StartupTimings(object):
+    """
+    Times of the milestones of startup, reported as the time each took after
+    the one before, so that a regression shows which stage it's in
+    """
+    def __init__(self, started):
+        self.started = started
+        self.marks = OrderedDict()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        previous = next(reversed(self.marks.values())) if self.marks else self.started
+        self.marks[name] = now
+        instrumentation.record('startup.' + name, now - previous)
+
+    def __str__(self):
+        stages = []
+        previous = self.started
+        for name, at in self.marks.items():
+            stages.append('{} {:.0f}ms'.format(name, (at - previous) * 1000))
+            previous = at
+        return 'Startup: {} (total {:.0f}ms)'.format(', '.join(stages), (previous - self.started) * 1000)
+
+
+def texture_from_pixels(width, height, colorfmt, buffer):
+    """Upload pixel rows, top first, into a new texture. Main thread only."""
+    texture = Texture.create(size=(width, height), colorfmt=colorfmt)
+    texture.blit_buffer(buffer, colorfmt=colorfmt, bufferfmt='ubyte')
+    texture.flip_vertical()
+    return texture
+
+
+class PixelImage(ImageLoaderBase):
+    """
+    Decoded pixels in the form Loader hands to its clients, which Kivy
+    uploads as a texture when first used on the main thread
+    """
+    def __init__(self, width, height, colorfmt, buffer, **kwargs):
+        self._pixels = (width, height, colorfmt, buffer)
+        kwargs.setdefault('nocache', True)
+        super().__init__('', **kwargs)
+
+    def load(self, filename):
+        (width, height, colorfmt, buffer) = self._pixels
+        self._pixels = None
+        return [ImageData(width, height, colorfmt, buffer)]
 
 
 def load_image_file_metadata(filename):
@@ -347,64 +703,153 @@ def load_image_file_metadata(filename):
 class KivyPILApp(App):
     title = "Photo Viewer"
     stop_event = threading.Event()
+    library_path = os.path.join(os.path.dirname(__file__), 'photolibrary.fs')
+    library = None
+    metadata_cache = None
+    thumbnail_cache = None
+    texture_cache = None
+    decode_pool = None
+    load_scheduler = None
+    maintenance = None
+    overlay = None
+    # Incremented on each load_folder, so loads for older folders are dropped
+    _folder_generation = 0
 
-    def _load_jpg(self, filename):
-        with report_memory_usage('Original JPG'):
-            self.add_image_with_label(filename)
+    def __init__(self, **kwargs):
+        self.startup = StartupTimings(_Import_Started)
+        self.startup.mark('imports')
+        super().__init__(**kwargs)
+        # Grid items waiting to be added, all at once on the next frame, as
+        # each change to the grid's data lays out every item again
+        self._pending_items = []
+        self._flush_items_trigger = Clock.create_trigger(self._flush_items)
 
     def _convert_jpg(self, filename):
-        with report_memory_usage('Converted JPG'):
-            data = BytesIO()
-            PIL.Image.open(filename).convert('1').save(data, format='png')
-            data.seek(0)
-            im = CoreImage(BytesIO(data.read()), ext='png')
-
-            self.add_image_with_label(filename, im.texture)
-
-    def _load_raw(self, filename):
-        with report_memory_usage('RAW'):
-            raw = rawpy.imread(filename)
-            rgb = raw.postprocess()
-
-            data = BytesIO()
-            PIL.Image.fromarray(rgb).save(data, format='png')
-            data.seek(0)
-            im = CoreImage(BytesIO(data.read()), ext='png')
+        self.load_scheduler.schedule((filename, 'converted'), filename,
+                                     partial(self._add_decoded_image, filename), mode='1')
+
+    def load_folder(self, folder):
+        """
+        Show the pictures of folder in place of those shown, cancelling any
+        loads still outstanding for them
+        """
+        self._folder_generation += 1
+        self.load_scheduler.cancel_all()
+        image_grid = self.root.current_screen.ids.image_grid
+        # Selected indices would refer past the end of the new, shorter data
+        image_grid.layout_manager.clear_selection()
+        self._pending_items = []
+        image_grid.data = []
+
+        filenames = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                     if os.path.splitext(name)[1].upper() in Image_Extensions]
+        thread = threading.Thread(target=self._load_folder, args=(filenames, self._folder_generation), daemon=True)
+        thread.start()
+        return thread
+
+    def _load_folder(self, filenames, generation):
+        # Runs off the main thread, adding each picture once its EXIF is
+        # parsed and its thumbnail is ready
+        with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+            for filename, metadata in self.metadata_cache.load_many(filenames):
+                if self.stop_event.is_set() or generation != self._folder_generation:
+                    break
+                future = executor.submit(self.thumbnail_cache.get, filename, GRID_THUMBNAIL_SIZE)
+                future.add_done_callback(partial(self._thumbnail_ready, filename, metadata, generation))
+
+    def _thumbnail_ready(self, filename, metadata, generation, future):
+        try:
+            thumbnail = future.result()
+        except Exception as e:
+            logger.warning('Failed to generate thumbnail for [%s]; Caught %s: %s',
+                           filename, e.__class__.__name__, e)
+            thumbnail = None
+        self.add_image_with_label(filename, metadata=metadata, thumbnail=thumbnail, generation=generation)
 
-            self.add_image_with_label(filename, im.texture)
+    def _load_raw(self, filename, tier=decoding.RAW_PREVIEW):
+        # Only an explicit RAW_FULL request runs the full demosaic
+        self.load_scheduler.schedule((filename, tier), filename,
+                                     partial(self._add_decoded_image, filename), raw_tier=tier)
 
-    @mainthread
-    def add_image_with_label(self, filename, texture=None):
-        metadata = load_image_file_metadata(filename)
-        picture = SelectablePicture(filename, metadata, texture)
-        self.root.current_screen.ids.image_layout.add_widget(picture)
+    def _add_decoded_image(self, filename, texture):
+        if texture is not None:
+            self.add_image_with_label(filename, texture)
 
     @mainthread
-    def add_proxyimage_with_label(self, filename, proxyimage):
-        picture = SelectablePicture(filename, None, proxyimage)
+    def add_image_with_label(self, filename, texture=None, metadata=None, thumbnail=None, generation=None):
+        if generation is not None and generation != self._folder_generation:
+            return
+        if metadata is None:
+            metadata = load_image_file_metadata(filename)
+        self._pending_items.append({
+            'source': filename,
+            'metadata': metadata,
+            'texture': texture,
+            'thumbnail': thumbnail or '',
+        })
+        self._flush_items_trigger()
+
+    def _flush_items(self, dt):
+        items, self._pending_items = self._pending_items, []
+        if items:
+            self.root.current_screen.ids.image_grid.data.extend(items)
 
     def build(self):
+        self.startup.mark('app')
         sm = ScreenManager()
         sm.add_widget(ImageLibraryScreen(name=ImageLibraryScreen.__name__))
         return sm
 
     def _load_callback(self, filename):
-        print('_load_callback(filename={})'.format(filename))
-        with report_memory_usage('Load callback converting JPG'):
-            data = BytesIO()
-            PIL.Image.open(filename).convert('1').save(data, format='png')
-            data.seek(0)
-            im = CoreImage(BytesIO(data.read()), ext='png')
-            return im
+        # Runs on a Loader thread, so only decodes; the texture is made from
+        # the pixels on the main thread
+        logger.debug('_load_callback(filename=%s)', filename)
+        with instrumentation.span('decode.loader'):
+            return PixelImage(*decoding.pixels_from_pil(decoding.decode_image(filename, mode='1')))
 
     def _post_callback(self, im):
-        print('_post_callback(im={})'.format(im))
-        return im.texture
+        logger.debug('_post_callback(im=%s)', im)
+        return im
 
     def _on_load(self, *args, **kwargs):
-        print('_on_load(*args={}, **kwargs={})'.format(args, kwargs))
+        logger.debug('_on_load(*args=%s, **kwargs=%s)', args, kwargs)
 
     def on_start(self, **kwargs):
+        self.startup.mark('build')
+        # Nothing is read from disk until the first frame is on screen
+        Window.bind(on_flip=self._on_first_frame)
+
+    def _on_first_frame(self, *args):
+        Window.unbind(on_flip=self._on_first_frame)
+        self.startup.mark('first frame')
+
+        Window.bind(on_motion=self._on_activity, on_key_down=self._on_activity)
+        if instrumentation.enabled():
+            self.overlay = InstrumentationOverlay()
+            Window.bind(on_key_down=self._on_overlay_key)
+        self.thumbnail_cache = thumbnails.ThumbnailCache()
+        self.decode_pool = DecodePool()
+        self.load_scheduler = LoadScheduler(self.decode_pool)
+        self.texture_cache = TextureCache(self.load_scheduler)
+        threading.Thread(target=self._open_library, daemon=True).start()
+
+    def _open_library(self):
+        # Runs off the main thread, as ZODB is slow to import and the
+        # storage's index is read on opening
+        import dao
+        self.library = dao.ZODBDAO(self.library_path)
+        self.metadata_cache = dao.MetadataCache(self.library)
+        # Pack the library while nothing is being loaded and there's no input
+        self.maintenance = dao.MaintenanceScheduler(
+            self.library, is_busy=lambda: any(self.load_scheduler.pending)).start()
+        self._library_opened()
+        self.metadata_cache.prewarm()
+
+    @mainthread
+    def _library_opened(self):
+        self.startup.mark('library')
+        logger.info('%s', self.startup)
+
         image_dir = os.path.join(os.path.dirname(__file__), 'images')
         image_jpg_original = os.path.join(image_dir, 'DSCF2364.JPG')
         image_raf_original = os.path.join(image_dir, 'DSCF2364.RAF')
@@ -415,18 +860,35 @@ class KivyPILApp(App):
         # proxyImage.bind(on_load=self._on_load)
         # print('Going back to regularly scheduled programming')
 
-        frame_wait = 0
+        # Loads are prioritised by the scheduler, so there's no need to
+        # stagger them here
+        self.load_folder(image_dir)
+        self._convert_jpg(image_jpg_original)
+        # self._load_raw(image_raf_original)
+
+    def _on_overlay_key(self, window, key, scancode, codepoint, modifiers):
+        if key == Keyboard_F12:
+            self.overlay.toggle()
+            return True
+        return False
 
-        frame_wait += 1
-        Clock.schedule_once(lambda dt: self._load_jpg(image_jpg_original), frame_wait)
-        frame_wait += 2
-        Clock.schedule_once(lambda dt: self._convert_jpg(image_jpg_original), frame_wait)
-        # frame_wait += 4
-        # Clock.schedule_once(lambda dt: self._load_raw(image_raf_original), frame_wait)
-        # frame_wait += 8
+    def _on_activity(self, *args):
+        if self.maintenance is not None:
+            self.maintenance.touch()
 
     def on_stop(self):
         self.stop_event.set()
+        if self.maintenance is not None:
+            self.maintenance.close()
+        if self.load_scheduler is not None:
+            self.load_scheduler.cancel_all()
+        if self.texture_cache is not None:
+            self.texture_cache.close()
+        if self.decode_pool is not None:
+            self.decode_pool.close()
+        if self.library is not None:
+            self.metadata_cache.close()
+            self.library.close()
 
     def on_pause(self):
         return True
@@ -436,4 +898,9 @@ class KivyPILApp(App):
 
 
 if __name__ == "__main__":
+    # Worker processes re-run the script they were started from to rebuild
+    # __main__, and importing Kivy there would open a window in each. Naming
+    # this module __main__ tells them there is nothing to rebuild; all they
+    # run lives in importable modules.
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
     KivyPILApp().run()
@@ -0,0 +1,43 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+Entry_Point = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '__main__.py')
+
+
+def run_cli(*args, timeout=60):
+    return subprocess.run([sys.executable, Entry_Point] + [str(arg) for arg in args],
+                          capture_output=True, text=True, timeout=timeout)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    from PIL import Image
+    top = tmp_path / 'corpus'
+    for index in range(6):
+        folder = top / 'roll{}'.format(index % 2)
+        folder.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (32, 24), (index * 40, 0, 0)).save(folder / 'IMG_{:04d}.JPG'.format(index), 'JPEG')
+    return top
+
+
+def test_index_through_main(tmp_path, corpus):
+    # Runs with worker processes, which mustn't run the command again
+    library = tmp_path / 'library.fs'
+    result = run_cli('index', corpus, '--library', library, '--no-thumbnails', '--processes', 2)
+    assert result.returncode == 0, result.stderr
+
+    events = [json.loads(line) for line in result.stdout.splitlines()]
+    done = [event for event in events if event['event'] == 'done']
+    assert len(done) == 1
+    assert done[0]['indexed'] == 6
+    assert done[0]['errors'] == 0
+
+    # A second run resumes from the manifest, indexing nothing new
+    result = run_cli('index', corpus, '--library', library, '--no-thumbnails', '--processes', 2)
+    assert result.returncode == 0, result.stderr
+    (done,) = [json.loads(line) for line in result.stdout.splitlines() if '"done"' in line]
+    assert done['indexed'] == 0
@@ -0,0 +1,282 @@
+from datetime import date, datetime
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import dao
+from dao import Catalog, Photograph, Range
+
+
+def photograph(name, **fields):
+    return Photograph('/photos/' + name, os.path.splitext(name)[1].lstrip('.').upper(), 1, **fields)
+
+
+@pytest.fixture
+def library(tmp_path):
+    with dao.ZODBDAO(str(tmp_path / 'library.fs')) as library:
+        yield library
+
+
+@pytest.fixture
+def catalog(library):
+    catalog = Catalog(library.root)
+    for index, (make, iso, captured) in enumerate([
+            ('FUJIFILM', 200, datetime(2019, 3, 1, 9, 30)),
+            ('Fujifilm ', 800, datetime(2019, 12, 31, 23, 59)),
+            ('Canon', 3200, datetime(2020, 1, 1)),
+            ('Canon', 6400, datetime(2021, 6, 15)),
+            ('NIKON', None, None)]):
+        catalog.add(photograph('IMG_{:04d}.JPG'.format(index), make=make, iso=iso, captured=captured,
+                               focal_length=23.0 + index))
+    library.commit()
+    return catalog
+
+
+def names(result):
+    return sorted(os.path.basename(photograph.filepath) for photograph in result)
+
+
+def test_equality_ignores_case_and_whitespace(catalog):
+    assert names(catalog.query(make='fujifilm')) == ['IMG_0000.JPG', 'IMG_0001.JPG']
+    assert names(catalog.query(make='  CANON')) == ['IMG_0002.JPG', 'IMG_0003.JPG']
+    assert len(catalog.query(make='leica')) == 0
+    assert list(catalog.values('make')) == ['canon', 'fujifilm', 'nikon']
+
+
+def test_any_of(catalog):
+    assert names(catalog.query(make=['nikon', 'canon'])) == ['IMG_0002.JPG', 'IMG_0003.JPG', 'IMG_0004.JPG']
+    assert names(catalog.query(iso={200, 6400})) == ['IMG_0000.JPG', 'IMG_0003.JPG']
+
+
+def test_ranges(catalog):
+    assert names(catalog.query(iso=Range(800, 3200))) == ['IMG_0001.JPG', 'IMG_0002.JPG']
+    assert names(catalog.query(iso=Range(800, 3200, exclude_low=True))) == ['IMG_0002.JPG']
+    assert names(catalog.query(iso=Range(3200, exclude_low=True))) == ['IMG_0003.JPG']
+    assert names(catalog.query(iso=Range(high=800, exclude_high=True))) == ['IMG_0000.JPG']
+    assert names(catalog.query(focal_length=Range(24.5, 25.5))) == ['IMG_0002.JPG']
+
+    year_2019 = Range(datetime(2019, 1, 1), datetime(2020, 1, 1), exclude_high=True)
+    assert names(catalog.query(captured=year_2019)) == ['IMG_0000.JPG', 'IMG_0001.JPG']
+    assert names(catalog.query(make=Range('d', 'g'))) == ['IMG_0000.JPG', 'IMG_0001.JPG']
+
+
+def test_criteria_intersect(catalog):
+    assert names(catalog.query(make='canon', iso=Range(5000))) == ['IMG_0003.JPG']
+    assert len(catalog.query(make='fujifilm', iso=Range(5000))) == 0
+    # Photographs without a value aren't indexed under the field
+    assert names(catalog.query(make='nikon', iso=Range())) == []
+    assert len(catalog.query()) == 5
+
+
+def test_unknown_field(catalog):
+    with pytest.raises(ValueError):
+        catalog.query(aperture=2.8)
+
+
+@pytest.mark.parametrize('criteria', [
+    {'iso': Range('500')},
+    {'iso': Range(100, '500')},
+    {'captured': Range(date(2019, 1, 1))},
+    {'iso': '800'},
+    {'iso': float('nan')},
+    {'iso': True},
+    {'make': 42},
+    {'make': '  '},
+    {'make': ['canon', 42]},
+    {'captured': '2019:03:01 09:30:00'},
+])
+def test_criteria_that_cannot_be_keyed_raise(catalog, criteria):
+    with pytest.raises(ValueError):
+        catalog.query(**criteria)
+
+
+@pytest.mark.parametrize('criteria', [
+    {'make': ('canon', 'nikon')},
+    {'iso': (200,)},
+    {'iso': [(200, 400)]},
+])
+def test_tuple_criteria_raise(catalog, criteria):
+    with pytest.raises(TypeError):
+        catalog.query(**criteria)
+
+
+def test_values_of_the_wrong_type_are_not_indexed(library):
+    catalog = Catalog(library.root)
+    catalog.add(photograph('a.JPG', make=b'Fujifilm', iso=(400, 0)))
+    catalog.add(photograph('b.JPG', make=42, iso='400', focal_length=float('nan'), captured='2019:03:01'))
+    library.commit()
+
+    assert names(catalog.query(make='fujifilm')) == ['a.JPG']
+    assert names(catalog.query(iso=400)) == ['a.JPG']
+    assert list(catalog.values('focal_length')) == []
+    assert list(catalog.values('captured')) == []
+
+
+def test_reindex_and_remove(catalog, library):
+    changed = catalog.get('/photos/IMG_0000.JPG')
+    changed.make = 'Leica'
+    catalog.add(changed)
+    assert names(catalog.query(make='leica')) == ['IMG_0000.JPG']
+    assert names(catalog.query(make='fujifilm')) == ['IMG_0001.JPG']
+
+    assert catalog.remove('/photos/IMG_0001.JPG')
+    assert not catalog.remove('/photos/IMG_0001.JPG')
+    assert len(catalog.query(make='fujifilm')) == 0
+    assert len(catalog) == 4
+    library.commit()
+
+
+def test_reopened_catalog(catalog, tmp_path):
+    # Read only, the storage opens without the lock the fixture holds
+    with dao.ZODBDAO(str(tmp_path / 'library.fs'), read_only=True) as reopened:
+        catalog = Catalog(reopened.root)
+        assert names(catalog.query(iso=Range(800, 3200))) == ['IMG_0001.JPG', 'IMG_0002.JPG']
+
+
+def test_library_built_by_the_script_opens_through_the_module(tmp_path):
+    from PIL import Image
+    picture = tmp_path / 'IMG_0001.JPG'
+    Image.new('RGB', (16, 8)).save(picture, 'JPEG')
+    result = subprocess.run([sys.executable, os.path.abspath(dao.__file__), str(picture)],
+                            cwd=tmp_path, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+    with dao.ZODBDAO(str(tmp_path / 'photolibrary.fs')) as library:
+        catalog = Catalog(library.root)
+        (found,) = catalog.query(filetype='jpg')
+        assert type(found) is Photograph
+        assert found.filepath == str(picture)
+
+
+def test_bulk_ingest_commits_in_chunks(library):
+    commits = []
+    with library.bulk_ingest(chunk_size=4, savepoint_size=2, on_commit=lambda: commits.append(len(catalog))) as ingest:
+        catalog = ingest.catalog
+        stats = ingest.add_many(photograph('IMG_{:04d}.JPG'.format(index), iso=100 * index) for index in range(10))
+    assert (stats.photographs, stats.commits) == (10, 3)
+    # Every second photograph in a chunk, but not where the chunk commits
+    assert stats.savepoints == 3
+    assert commits == [4, 8, 10]
+    assert stats.finished is not None
+    assert stats.photographs_per_second > 0
+
+    # Nothing is left to commit, and what was is in the storage
+    library.abort()
+    assert len(Catalog(library.root)) == 10
+    assert names(Catalog(library.root).query(iso=Range(800))) == ['IMG_0008.JPG', 'IMG_0009.JPG']
+
+
+def test_bulk_ingest_aborts_only_the_last_chunk(library):
+    with pytest.raises(RuntimeError):
+        with library.bulk_ingest(chunk_size=3, savepoint_size=2) as ingest:
+            for index in range(5):
+                ingest.add(photograph('IMG_{:04d}.JPG'.format(index)))
+            raise RuntimeError('interrupted')
+    assert ingest.stats.commits == 1
+    catalog = Catalog(library.root)
+    assert len(catalog) == 3
+    assert len(catalog.query(filetype='jpg')) == 3
+    assert catalog.get('/photos/IMG_0003.JPG') is None
+
+
+def test_bulk_ingest_persists(library, tmp_path):
+    with library.bulk_ingest(chunk_size=2) as ingest:
+        ingest.add_many(photograph('IMG_{:04d}.JPG'.format(index), make='Canon') for index in range(3))
+    with dao.ZODBDAO(str(tmp_path / 'library.fs'), read_only=True) as reopened:
+        assert len(Catalog(reopened.root).query(make='canon')) == 3
+
+
+@pytest.mark.parametrize('sizes', [(0, 1), (1, 0), (-1, 10)])
+def test_bulk_ingest_sizes_must_be_positive(library, sizes):
+    with pytest.raises(ValueError):
+        library.bulk_ingest(*sizes)
+
+
+def revise(library, times):
+    """Leave times superseded revisions of the catalog in the storage"""
+    catalog = Catalog(library.root)
+    for index in range(times):
+        catalog.add(photograph('IMG_0000.JPG', iso=100 + index))
+        library.commit()
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_pack_reclaims_old_revisions(library):
+    revise(library, 20)
+    stats = library.pack(retention_days=0)
+    assert stats.size_after == library.storage_size
+    assert stats.reclaimed > 0
+    assert stats.seconds >= 0
+    assert names(Catalog(library.root).query(iso=119)) == ['IMG_0000.JPG']
+
+
+def test_prewarm_loads_the_catalog(library):
+    revise(library, 1)
+    with library.checked_out() as connection:
+        connection.cacheMinimize()
+        cold = connection._cache.cache_non_ghost_count
+    library.prewarm()
+    # The warmed connection is the one checked out next
+    with library.checked_out() as connection:
+        assert connection._cache.cache_non_ghost_count > cold
+
+
+def test_maintenance_packs_once_idle(library):
+    revise(library, 20)
+    size = library.storage_size
+    scheduler = dao.MaintenanceScheduler(library, idle_seconds=0.1, interval=60, retention_days=0,
+                                         min_growth=0).start()
+    try:
+        assert wait_for(lambda: scheduler.history)
+        # Not again until the interval has passed
+        time.sleep(0.3)
+    finally:
+        scheduler.close()
+    (stats,) = scheduler.history
+    assert stats.size_before == size
+    assert stats.size_after < size
+
+
+def test_maintenance_waits_while_busy_or_touched(library):
+    revise(library, 5)
+    busy = [True]
+    scheduler = dao.MaintenanceScheduler(library, idle_seconds=0.1, interval=0, retention_days=0,
+                                         min_growth=0, is_busy=lambda: busy[0]).start()
+    try:
+        time.sleep(0.4)
+        assert scheduler.history == []
+
+        busy[0] = False
+        for _ in range(20):
+            scheduler.touch()
+            time.sleep(0.02)
+        assert scheduler.history == []
+        assert wait_for(lambda: scheduler.history)
+    finally:
+        scheduler.close()
+
+
+def test_maintenance_skips_storage_that_has_not_grown(library):
+    revise(library, 5)
+    scheduler = dao.MaintenanceScheduler(library, idle_seconds=0, interval=0.05, retention_days=0,
+                                         min_growth=library.storage_size + 2 ** 20).start()
+    time.sleep(0.3)
+    scheduler.close()
+    assert scheduler.history == []
+
+
+def test_maintenance_close_stops_the_thread(library):
+    scheduler = dao.MaintenanceScheduler(library, idle_seconds=3600).start()
+    started = time.monotonic()
+    scheduler.close()
+    assert time.monotonic() - started < 1
+    assert not scheduler._thread.is_alive()
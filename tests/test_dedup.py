@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+from importers import aperture, dedup
+from importers.dedup import HashIndex, full_hash, partial_hash
+
+Block = dedup.PARTIAL_BLOCK_SIZE
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return str(path)
+
+
+def imported(index, source, destination):
+    """Register source as imported to destination and make the copy, as copy_file_action does"""
+    found = index.register(source, os.path.getsize(source), destination)
+    if found is None:
+        with open(source, 'rb') as original, open(destination, 'wb') as copy:
+            copy.write(original.read())
+        index.copied(destination)
+    return found
+
+
+@pytest.fixture
+def index(tmp_path):
+    return HashIndex(str(tmp_path / 'hashes.json'))
+
+
+def test_partial_hash_reads_only_the_ends(tmp_path):
+    ends = b'a' * Block
+    first = write(tmp_path / 'first', ends + b'x' * Block + ends)
+    second = write(tmp_path / 'second', ends + b'y' * Block + ends)
+    size = os.path.getsize(first)
+    assert partial_hash(first, size) == partial_hash(second, size)
+    assert full_hash(first) != full_hash(second)
+
+    small = write(tmp_path / 'small', b'x' * 100)
+    other = write(tmp_path / 'other', b'y' * 100)
+    assert partial_hash(small, 100) != partial_hash(other, 100)
+
+
+def test_files_of_unique_size_are_never_read(tmp_path, index):
+    for length in (10, 20, 30):
+        source = write(tmp_path / 'src' / str(length), b'x' * length)
+        assert imported(index, source, str(tmp_path / 'dst-{}'.format(length))) is None
+    assert len(index) == 3
+    assert (index.hashed_partial, index.hashed_full) == (0, 0)
+
+
+def test_duplicate_found_by_content(tmp_path, index):
+    first = write(tmp_path / 'src' / 'IMG_0001.JPG', b'picture' * 10)
+    other = write(tmp_path / 'src' / 'IMG_0002.JPG', b'PICTURE' * 10)
+    again = write(tmp_path / 'src' / 'copy of IMG_0001.JPG', b'picture' * 10)
+    destination = str(tmp_path / 'IMG_0001.JPG')
+
+    assert imported(index, first, destination) is None
+    assert imported(index, other, str(tmp_path / 'IMG_0002.JPG')) is None
+    assert imported(index, again, str(tmp_path / 'IMG_0003.JPG')) == destination
+    assert len(index) == 2
+    # Small files' partial hashes are their full hashes
+    assert index.hashed_full == 0
+
+
+def test_full_hash_only_for_colliding_partial_hashes(tmp_path, index):
+    ends = b'a' * Block
+    first = write(tmp_path / 'src' / 'first', ends + b'x' * Block + ends)
+    second = write(tmp_path / 'src' / 'second', ends + b'y' * Block + ends)
+    third = write(tmp_path / 'src' / 'third', ends + b'x' * Block + ends)
+
+    assert imported(index, first, str(tmp_path / 'first')) is None
+    assert imported(index, second, str(tmp_path / 'second')) is None
+    assert index.hashed_full == 2
+    assert imported(index, third, str(tmp_path / 'third')) == str(tmp_path / 'first')
+
+
+def test_hashes_kept_across_runs(tmp_path, index):
+    first = write(tmp_path / 'src' / 'IMG_0001.JPG', b'picture' * 10)
+    imported(index, first, str(tmp_path / 'IMG_0001.JPG'))
+    imported(index, write(tmp_path / 'src' / 'IMG_0002.JPG', b'PICTURE' * 10), str(tmp_path / 'IMG_0002.JPG'))
+    assert index.save()
+    assert not index.save()
+
+    reloaded = HashIndex(index.filepath)
+    assert len(reloaded) == 2
+    again = write(tmp_path / 'src' / 'IMG_0003.JPG', b'picture' * 10)
+    assert imported(reloaded, again, str(tmp_path / 'IMG_0003.JPG')) == str(tmp_path / 'IMG_0001.JPG')
+    # Only the new file was read; the indexed ones' hashes were kept
+    assert reloaded.hashed_partial == 1
+
+
+def test_destination_is_hashed_not_the_changed_source(tmp_path, index):
+    source = write(tmp_path / 'src' / 'IMG_0001.JPG', b'x' * 100)
+    destination = str(tmp_path / 'IMG_0001.JPG')
+    imported(index, source, destination)
+    write(tmp_path / 'src' / 'IMG_0001.JPG', b'y' * 100)
+
+    # Still a duplicate of what was imported, not of what the source became
+    original = write(tmp_path / 'elsewhere' / 'IMG_0001.JPG', b'x' * 100)
+    assert imported(index, original, str(tmp_path / 'IMG_0009.JPG')) == destination
+    changed = write(tmp_path / 'elsewhere' / 'IMG_0002.JPG', b'y' * 100)
+    assert imported(index, changed, str(tmp_path / 'IMG_0010.JPG')) is None
+
+
+def test_reimport_to_the_same_destination_drops_stale_hashes(tmp_path, index):
+    source = write(tmp_path / 'src' / 'IMG_0001.JPG', b'x' * 100)
+    destination = str(tmp_path / 'IMG_0001.JPG')
+    imported(index, source, destination)
+    # Hash it, as a comparison would
+    assert imported(index, write(tmp_path / 'src' / 'other', b'z' * 100), str(tmp_path / 'other')) is None
+
+    # Re-imported with other content of the same size
+    write(tmp_path / 'src' / 'IMG_0001.JPG', b'y' * 100)
+    assert index.register(source, 100, destination) == destination
+    with open(destination, 'wb') as copy:
+        copy.write(b'y' * 100)
+    index.copied(destination)
+
+    old_content = write(tmp_path / 'elsewhere' / 'IMG_0001.JPG', b'x' * 100)
+    assert imported(index, old_content, str(tmp_path / 'IMG_0002.JPG')) is None
+    new_content = write(tmp_path / 'elsewhere' / 'IMG_0003.JPG', b'y' * 100)
+    assert imported(index, new_content, str(tmp_path / 'IMG_0003.JPG')) == destination
+
+
+def test_destination_changed_in_size_is_reindexed(tmp_path, index):
+    destination = str(tmp_path / 'IMG_0001.JPG')
+    imported(index, write(tmp_path / 'src' / 'a', b'x' * 100), destination)
+    imported(index, write(tmp_path / 'src' / 'b', b'y' * 200), destination)
+    assert len(index) == 1
+    assert imported(index, write(tmp_path / 'src' / 'c', b'x' * 100), str(tmp_path / 'c')) is None
+
+
+def test_missing_destination_is_not_a_duplicate(tmp_path, index):
+    destination = str(tmp_path / 'IMG_0001.JPG')
+    imported(index, write(tmp_path / 'src' / 'a', b'x' * 100), destination)
+    os.remove(destination)
+    assert imported(index, write(tmp_path / 'src' / 'b', b'x' * 100), str(tmp_path / 'b')) is None
+
+
+@pytest.mark.parametrize('mode', dedup.Dedup_Modes)
+def test_import_files_deduplicates(tmp_path, mode):
+    (src, dst) = (tmp_path / 'src', tmp_path / 'dst')
+    write(src / 'card1' / 'IMG_0001.JPG', b'picture' * 1000)
+    write(src / 'card2' / 'DSCF0001.JPG', b'picture' * 1000)
+    write(src / 'card2' / 'DSCF0002.JPG', b'another' * 1000)
+    aperture.import_files(str(src), str(dst), '%(category)s', aperture.Category_Policies['unknown'],
+                          dedup_mode=mode)
+
+    copies = [os.path.join(directory, name) for directory, _, names in os.walk(dst)
+              for name in names if not name.startswith('.picman-')]
+    inodes = {os.stat(copy).st_ino for copy in copies}
+    if mode == 'hardlink':
+        assert (len(copies), len(inodes)) == (3, 2)
+    else:
+        assert (len(copies), len(inodes)) == (2, 2)
+    assert os.path.exists(os.path.join(str(dst), dedup.HASH_INDEX_FILENAME))
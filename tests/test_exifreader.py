@@ -0,0 +1,299 @@
+import io
+import math
+import struct
+
+import pytest
+
+import exifreader
+
+# Tag ids to the names read_tiff_tags returns them by
+Wanted = {tag: name for name, tag in exifreader.Tags.items()}
+
+Orders = pytest.mark.parametrize('order', ['<', '>'], ids=['II', 'MM'])
+
+
+def _encode(order, field_type, values):
+    """(count, bytes) of a field's values: a str, or a list of numbers or (numerator, denominator) pairs"""
+    if field_type == 2:
+        data = values.encode('utf-8') + b'\x00'
+        return (len(data), data)
+    (fmt, size) = exifreader._Field_Types[field_type]
+    flat = [part for value in values for part in (value if isinstance(value, tuple) else (value,))]
+    return (len(values), struct.pack(order + fmt * len(values), *flat))
+
+
+def build_tiff(order, ifd0, exif=()):
+    """
+    TIFF structure in byte order order holding IFD0 and, if given, an EXIF
+    sub-IFD. Entries are (tag, field type, values); values of four bytes or
+    less are stored inline, the rest after the IFDs.
+    """
+    ifd0 = list(ifd0)
+    if exif:
+        ifd0.append((exifreader.EXIF_IFD_POINTER, 4, [0]))
+    ifds = [ifd0] + ([list(exif)] if exif else [])
+
+    ifd_offsets = []
+    offset = 8
+    for entries in ifds:
+        ifd_offsets.append(offset)
+        offset += 2 + 12 * len(entries) + 4
+    if exif:
+        ifd0[-1] = (exifreader.EXIF_IFD_POINTER, 4, [ifd_offsets[1]])
+
+    tiff = bytearray((b'II' if order == '<' else b'MM') + struct.pack(order + 'HL', 42, 8))
+    data = bytearray()
+    for entries in ifds:
+        tiff += struct.pack(order + 'H', len(entries))
+        for tag, field_type, values in sorted(entries):
+            (count, encoded) = _encode(order, field_type, values)
+            if len(encoded) <= 4:
+                value = encoded.ljust(4, b'\x00')
+            else:
+                value = struct.pack(order + 'L', offset + len(data))
+                data += encoded
+            tiff += struct.pack(order + 'HHL', tag, field_type, count) + value
+        tiff += struct.pack(order + 'L', 0)
+    return bytes(tiff + data)
+
+
+def build_jpeg(tiff):
+    """A JPEG of a small image, with tiff as its EXIF segment after the JFIF one"""
+    from PIL import Image
+    stream = io.BytesIO()
+    Image.new('RGB', (16, 8), 'red').save(stream, 'JPEG')
+    jpeg = stream.getvalue()
+    (app0_length,) = struct.unpack_from('>H', jpeg, 4)
+    split = 4 + app0_length
+    segment = exifreader.EXIF_HEADER + tiff
+    return jpeg[:split] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + jpeg[split:]
+
+
+def build_raf(jpeg):
+    """A Fuji RAF holding jpeg as its preview, among filler standing in for the rest"""
+    offset = 148
+    header = exifreader.RAF_MAGIC.ljust(exifreader.RAF_JPEG_POINTER, b'0')
+    header += struct.pack('>II', offset, len(jpeg))
+    return header.ljust(offset, b'\x00') + jpeg + b'\x00' * 256
+
+
+def sample_tiff(order):
+    return build_tiff(order, [
+        (0x010F, 2, 'FUJIFILM'),
+        (0x0110, 2, 'X-T2'),
+    ], [
+        (0x829A, 5, [(1, 250)]),
+        (0x829D, 5, [(28, 10)]),
+        (0x8822, 3, [3]),
+        (0x8827, 3, [400]),
+        (0x9003, 2, '2021:05:01 10:20:30'),
+        (0x9204, 10, [(-1, 3)]),
+        (0x9207, 3, [5]),
+        (0x9209, 3, [16]),
+        (0x920A, 5, [(230, 10)]),
+        (0xA002, 4, [6000]),
+        (0xA003, 4, [4000]),
+        (0xA405, 3, [35]),
+        (0xA432, 5, [(23, 1), (23, 1), (2, 1), (2, 1)]),
+        (0xA434, 2, 'XF23mmF2 R WR'),
+    ])
+
+
+Sample_Values = {
+    'make': 'FUJIFILM',
+    'model': 'X-T2',
+    'exposure_time': 0.004,
+    'f_number': 2.8,
+    'exposure_program': 3,
+    'photographic_sensitivity': 400,
+    'datetime_original': '2021:05:01 10:20:30',
+    'exposure_bias_value': -1 / 3,
+    'metering_mode': 5,
+    'flash': 16,
+    'focal_length': 23.0,
+    'pixel_x_dimension': 6000,
+    'pixel_y_dimension': 4000,
+    'focal_length_in_35mm_film': 35,
+    'lens_specification': (23.0, 23.0, 2.0, 2.0),
+    'lens_model': 'XF23mmF2 R WR',
+}
+
+
+@Orders
+def test_byte_orders(order):
+    assert exifreader.read_tiff_tags(sample_tiff(order), Wanted) == Sample_Values
+
+
+@Orders
+def test_inline_and_offset_values(order):
+    tiff = build_tiff(order, [
+        (0x0001, 2, 'abc'),
+        (0x0002, 2, 'abcd'),
+        (0x0003, 3, [1, 2]),
+        (0x0004, 3, [1, 2, 3]),
+        (0x0005, 4, [70000]),
+        (0x0006, 4, [70000, 80000]),
+        (0x0007, 1, [1, 2, 3, 4]),
+        (0x0008, 1, [1, 2, 3, 4, 5]),
+        (0x0009, 8, [-2]),
+        (0x000A, 11, [0.5]),
+        (0x000B, 12, [0.25]),
+    ])
+    wanted = {tag: tag for tag in range(1, 12)}
+    assert exifreader.read_tiff_tags(tiff, wanted) == {
+        1: 'abc',
+        2: 'abcd',
+        3: (1, 2),
+        4: (1, 2, 3),
+        5: 70000,
+        6: (70000, 80000),
+        7: (1, 2, 3, 4),
+        8: (1, 2, 3, 4, 5),
+        9: -2,
+        10: 0.5,
+        11: 0.25,
+    }
+
+
+@Orders
+def test_unwanted_and_unknown_fields_are_skipped(order):
+    tiff = build_tiff(order, [(0x010F, 2, 'FUJIFILM'), (0x0110, 2, 'X-T2')])
+    assert exifreader.read_tiff_tags(tiff, {0x010F: 'make'}) == {'make': 'FUJIFILM'}
+
+    # An entry of a field type TIFF doesn't define is skipped
+    tiff = bytearray(tiff)
+    type_offset = 8 + 2 + 2
+    tiff[type_offset:type_offset + 2] = struct.pack(order + 'H', 99)
+    assert exifreader.read_tiff_tags(bytes(tiff), Wanted) == {'model': 'X-T2'}
+
+
+@Orders
+def test_rational_with_zero_denominator_is_nan(order):
+    tiff = build_tiff(order, [], [
+        (0x829A, 5, [(1, 0)]),
+        (0x9204, 10, [(0, 0)]),
+        (0xA432, 5, [(23, 1), (0, 0), (2, 1), (2, 1)]),
+    ])
+    values = exifreader.read_tiff_tags(tiff, Wanted)
+    assert math.isnan(values['exposure_time'])
+    assert math.isnan(values['exposure_bias_value'])
+    (low, high, wide, tele) = values['lens_specification']
+    assert (low, wide, tele) == (23.0, 2.0, 2.0) and math.isnan(high)
+
+
+@Orders
+def test_truncated_ifd_keeps_fields_before_it(order):
+    # Every value is inline, so the cut only loses the entries after it
+    tiff = build_tiff(order, [(0x010F, 2, 'Fuj')], [
+        (0x8822, 3, [3]),
+        (0x8827, 3, [400]),
+        (0x9207, 3, [5]),
+    ])
+    ifd0 = 8
+    exif_ifd = ifd0 + 2 + 2 * 12 + 4
+
+    # Cut partway through the EXIF IFD's third entry
+    values = exifreader.read_tiff_tags(tiff[:exif_ifd + 2 + 2 * 12 + 6], Wanted)
+    assert values == {'make': 'Fuj', 'exposure_program': 3, 'photographic_sensitivity': 400}
+
+    # Cut partway through IFD0's second entry, the EXIF IFD pointer
+    assert exifreader.read_tiff_tags(tiff[:ifd0 + 2 + 12 + 6], Wanted) == {'make': 'Fuj'}
+
+    # Cut partway through IFD0's entry count
+    assert exifreader.read_tiff_tags(tiff[:ifd0 + 1], Wanted) == {}
+
+
+@Orders
+def test_value_beyond_the_segment_is_skipped(order):
+    tiff = build_tiff(order, [(0x010F, 2, 'FUJIFILM'), (0x0110, 2, 'X-T2')])
+    # Both strings are stored after the IFD, make first; drop model's
+    values = exifreader.read_tiff_tags(tiff[:-len('X-T2') - 1], Wanted)
+    assert values == {'make': 'FUJIFILM'}
+
+
+def test_bad_header_raises():
+    with pytest.raises(exifreader.ExifReaderError):
+        exifreader.read_tiff_tags(b'XX\x00\x2a\x00\x00\x00\x08', Wanted)
+    with pytest.raises(exifreader.ExifReaderError):
+        exifreader.read_tiff_tags(b'II\x2b\x00\x08\x00\x00\x00', Wanted)
+
+
+@Orders
+def test_jpeg(tmp_path, order):
+    path = tmp_path / 'DSCF0001.JPG'
+    path.write_bytes(build_jpeg(sample_tiff(order)))
+    assert exifreader.read_exif(str(path), Wanted) == Sample_Values
+
+
+def test_jpeg_without_exif(tmp_path):
+    from PIL import Image
+    path = tmp_path / 'plain.jpg'
+    Image.new('RGB', (16, 8)).save(path, 'JPEG')
+    assert exifreader.read_exif(str(path), Wanted) is None
+
+
+def test_not_an_image(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'Not an image at all')
+    assert exifreader.read_exif(str(path), Wanted) is None
+    assert exifreader.read_embedded_preview(str(path)) is None
+
+
+@Orders
+def test_raf_embedded_jpeg(tmp_path, order):
+    jpeg = build_jpeg(sample_tiff(order))
+    path = tmp_path / 'DSCF0001.RAF'
+    path.write_bytes(build_raf(jpeg))
+    assert exifreader.read_exif(str(path), Wanted) == Sample_Values
+    assert exifreader.read_embedded_preview(str(path)) == jpeg
+
+
+@Orders
+def test_matches_exif_package(tmp_path, order):
+    exif = pytest.importorskip('exif')
+    data = build_jpeg(sample_tiff(order))
+    path = tmp_path / 'DSCF0001.JPG'
+    path.write_bytes(data)
+
+    values = exifreader.read_exif(str(path), Wanted)
+    previous = exif.Image(data)
+    compared = 0
+    for name in exifreader.Tags:
+        try:
+            expected = getattr(previous, name)
+        except AttributeError:
+            assert name not in values
+            continue
+        if name == 'flash':
+            assert bool(values[name] & 1) == expected.flash_fired
+        else:
+            # The exif package returns enumerations for coded fields
+            assert values[name] == pytest.approx(getattr(expected, 'value', expected))
+        compared += 1
+    assert compared == len(Sample_Values)
+
+
+def test_matches_exif_package_on_pillow_output(tmp_path):
+    exif = pytest.importorskip('exif')
+    from PIL import Image, TiffImagePlugin
+    rational = TiffImagePlugin.IFDRational
+
+    written = Image.Exif()
+    written[0x010F] = 'FUJIFILM'
+    written[0x0110] = 'X-T2'
+    written[0x0131] = 'Digital Camera X-T2 Ver4.30'
+    sub_ifd = written.get_ifd(exifreader.EXIF_IFD_POINTER)
+    sub_ifd[0x829A] = rational(1, 1000)
+    sub_ifd[0x829D] = rational(56, 10)
+    sub_ifd[0x8827] = 3200
+    sub_ifd[0x9003] = '2019:12:24 18:05:59'
+    sub_ifd[0x920A] = rational(560, 10)
+    sub_ifd[0xA434] = 'XF56mmF1.2 R'
+    path = tmp_path / 'pillow.jpg'
+    Image.new('RGB', (32, 24), 'blue').save(path, 'JPEG', exif=written)
+
+    values = exifreader.read_exif(str(path), Wanted)
+    previous = exif.Image(path.read_bytes())
+    for name in ('make', 'model', 'software', 'exposure_time', 'f_number', 'photographic_sensitivity',
+                 'datetime_original', 'focal_length', 'lens_model'):
+        assert values[name] == pytest.approx(getattr(previous, name))
@@ -0,0 +1,129 @@
+import json
+import os
+
+import pytest
+
+from importers import aperture, manifest
+from importers.manifest import ScanManifest
+
+
+@pytest.fixture
+def picture(tmp_path):
+    path = tmp_path / 'src' / 'IMG_0001.JPG'
+    path.parent.mkdir()
+    path.write_bytes(b'x' * 100)
+    return str(path)
+
+
+def test_recorded_file_is_current_until_changed(tmp_path, picture):
+    scan = ScanManifest(str(tmp_path / 'manifest.json'))
+    assert not scan.is_current(picture, os.stat(picture))
+
+    scan.stage(picture, os.stat(picture))
+    scan.record(picture, '/library/IMG_0001.JPG')
+    assert scan.is_current(picture, os.stat(picture))
+    assert scan.destination(picture) == '/library/IMG_0001.JPG'
+
+    with open(picture, 'ab') as appended:
+        appended.write(b'y')
+    assert not scan.is_current(picture, os.stat(picture))
+
+    # Same size, different modification time
+    stat = os.stat(picture)
+    os.utime(picture, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    scan.stage(picture, stat)
+    scan.record(picture, '/library/IMG_0001.JPG')
+    assert not scan.is_current(picture, os.stat(picture))
+
+
+def test_staged_but_unrecorded_file_is_retried(tmp_path, picture):
+    path = str(tmp_path / 'manifest.json')
+    scan = ScanManifest(path)
+    scan.stage(picture, os.stat(picture))
+    # The import failed, so record was never called
+    assert not scan.dirty
+    assert not scan.save()
+    assert not os.path.exists(path)
+    assert not ScanManifest(path).is_current(picture, os.stat(picture))
+
+
+def test_recording_without_staging_does_nothing(tmp_path, picture):
+    scan = ScanManifest(str(tmp_path / 'manifest.json'))
+    scan.record(picture, '/library/IMG_0001.JPG')
+    assert picture not in scan
+    assert not scan.dirty
+
+
+def test_saves_only_changes_and_reloads(tmp_path, picture):
+    path = str(tmp_path / 'manifest.json')
+    scan = ScanManifest(path)
+    scan.stage(picture, os.stat(picture))
+    scan.record(picture, '/library/IMG_0001.JPG')
+    assert scan.dirty
+    assert scan.save()
+    assert not scan.dirty
+    assert not scan.save()
+
+    reloaded = ScanManifest(path)
+    assert len(reloaded) == 1
+    assert reloaded.is_current(picture, os.stat(picture))
+    assert reloaded.destination(picture) == '/library/IMG_0001.JPG'
+    assert not reloaded.dirty
+
+
+def test_prune_drops_files_not_seen(tmp_path, picture):
+    path = str(tmp_path / 'manifest.json')
+    scan = ScanManifest(path)
+    gone = str(tmp_path / 'src' / 'IMG_0002.JPG')
+    with open(gone, 'wb') as deleted:
+        deleted.write(b'z')
+    for source in (picture, gone):
+        scan.stage(source, os.stat(source))
+        scan.record(source, source + '.copy')
+    scan.save()
+
+    reloaded = ScanManifest(path)
+    reloaded.is_current(picture, os.stat(picture))
+    assert reloaded.save(prune=True)
+    assert picture in ScanManifest(path)
+    assert gone not in ScanManifest(path)
+
+
+@pytest.mark.parametrize('content', ['{"version": 1, "entries": {', '{"version": 99, "entries": {}}', ''])
+def test_unreadable_manifest_starts_afresh(tmp_path, content):
+    path = tmp_path / 'manifest.json'
+    path.write_text(content)
+    assert len(ScanManifest(str(path))) == 0
+
+
+def test_dump_json_mapping_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, 'SAVE_CHUNK_ENTRIES', 3)
+    path = str(tmp_path / 'data.json')
+    for count in (0, 1, 3, 7):
+        data = {'version': 1, 'entries': {'/src/{}'.format(i): [i, i * 2, 'dest "{}"'.format(i)] for i in range(count)}}
+        manifest.dump_json_mapping(path, data, 'entries')
+        with open(path) as written:
+            assert json.load(written) == data
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_reimport_skips_unchanged_files(tmp_path):
+    (src, dst) = (tmp_path / 'src', tmp_path / 'dst')
+    for index in range(4):
+        (src / 'roll').mkdir(parents=True, exist_ok=True)
+        (src / 'roll' / 'IMG_{:04d}.JPG'.format(index)).write_bytes(bytes([index]) * 50)
+    policy = aperture.Category_Policies['unknown']
+
+    first = aperture.import_files(str(src), str(dst), '%(category)s', policy)
+    assert (first.files, first.unchanged) == (4, 0)
+
+    second = aperture.import_files(str(src), str(dst), '%(category)s', policy)
+    assert second.unchanged == 4
+
+    (src / 'roll' / 'IMG_0002.JPG').write_bytes(b'changed')
+    third = aperture.import_files(str(src), str(dst), '%(category)s', policy)
+    assert third.unchanged == 3
+    scan = ScanManifest(os.path.join(str(dst), manifest.MANIFEST_FILENAME))
+    changed = str(src / 'roll' / 'IMG_0002.JPG')
+    with open(scan.destination(changed), 'rb') as copied:
+        assert copied.read() == b'changed'
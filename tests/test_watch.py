@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+
+import pytest
+
+from importers import watch
+from importers.aperture import Category_Policies
+
+
+def test_debouncer_holds_paths_until_settled(tmp_path):
+    path = tmp_path / 'IMG_0001.JPG'
+    path.write_bytes(b'x' * 10)
+    debouncer = watch.Debouncer(settle=1.0)
+    assert debouncer.wait_time(0.0) is None
+
+    debouncer.touch(str(path), now=10.0)
+    assert len(debouncer) == 1
+    assert debouncer.wait_time(now=10.25) == 0.75
+    assert debouncer.ready(now=10.5) == []
+
+    # Touched again while settling, it waits a whole settle period more
+    debouncer.touch(str(path), now=10.75)
+    assert debouncer.ready(now=11.5) == []
+    [(ready, stat)] = debouncer.ready(now=11.75)
+    assert ready == str(path)
+    assert stat.st_size == 10
+    assert len(debouncer) == 0
+    assert debouncer.ready(now=20.0) == []
+
+
+def test_debouncer_finish_hands_on_without_settling(tmp_path):
+    (first, second) = (tmp_path / 'a.JPG', tmp_path / 'b.JPG')
+    first.write_bytes(b'a')
+    second.write_bytes(b'b')
+    debouncer = watch.Debouncer(settle=1.0)
+    debouncer.touch(str(first), now=10.0)
+    debouncer.touch(str(second), now=10.0)
+
+    debouncer.finish(str(first), now=10.1)
+    assert debouncer.wait_time(now=10.1) == 0.0
+    assert [path for path, stat in debouncer.ready(now=10.1)] == [str(first)]
+    assert [path for path, stat in debouncer.ready(now=11.0)] == [str(second)]
+
+
+def test_debouncer_drops_paths_gone_while_settling(tmp_path):
+    path = tmp_path / 'IMG_0001.JPG.tmp'
+    path.write_bytes(b'x')
+    debouncer = watch.Debouncer(settle=0.5)
+    debouncer.touch(str(path), now=0.0)
+    path.unlink()
+    assert debouncer.ready(now=1.0) == []
+    assert len(debouncer) == 0
+
+
+@pytest.fixture
+def inotify(tmp_path):
+    try:
+        watcher = watch.InotifyWatcher(str(tmp_path))
+    except (OSError, AttributeError) as e:
+        pytest.skip('inotify unavailable: {}'.format(e))
+    yield watcher
+    watcher.close()
+
+
+def poll_until(watcher, predicate, timeout=5.0):
+    (finished, unsettled) = ([], [])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not predicate(finished, unsettled):
+        (more_finished, more_unsettled) = watcher.poll(0.1)
+        finished += more_finished
+        unsettled += more_unsettled
+    return (finished, unsettled)
+
+
+def test_inotify_reports_files_once_closed(tmp_path, inotify):
+    path = str(tmp_path / 'IMG_0001.JPG')
+    with open(path, 'wb') as picture:
+        picture.write(b'x' * 1000)
+        picture.flush()
+        # Written but still open, so not reported
+        assert poll_until(inotify, lambda finished, unsettled: finished, timeout=0.5) == ([], [])
+        picture.write(b'x' * 1000)
+    assert poll_until(inotify, lambda finished, unsettled: finished) == ([path], [])
+
+
+def test_inotify_reports_files_moved_in(tmp_path, inotify):
+    outside = tmp_path.parent / (tmp_path.name + '-outside.JPG')
+    outside.write_bytes(b'x')
+    path = str(tmp_path / 'IMG_0001.JPG')
+    os.rename(outside, path)
+    assert poll_until(inotify, lambda finished, unsettled: finished) == ([path], [])
+
+
+def test_inotify_reports_files_in_new_directories_as_unsettled(tmp_path, inotify):
+    staging = tmp_path.parent / (tmp_path.name + '-card')
+    staging.mkdir()
+    (staging / 'IMG_0001.JPG').write_bytes(b'x')
+    os.rename(staging, tmp_path / 'card')
+    (finished, unsettled) = poll_until(inotify, lambda finished, unsettled: unsettled)
+    assert (finished, unsettled) == ([], [str(tmp_path / 'card' / 'IMG_0001.JPG')])
+
+    # Files arriving afterwards are seen through the new directory's watch
+    path = str(tmp_path / 'card' / 'IMG_0002.JPG')
+    with open(path, 'wb') as picture:
+        picture.write(b'y')
+    assert poll_until(inotify, lambda finished, unsettled: finished) == ([path], [])
+
+
+def test_polling_reports_changes_as_unsettled(tmp_path):
+    watcher = watch.PollingWatcher(str(tmp_path), interval=0.05)
+    path = tmp_path / 'IMG_0001.JPG'
+    path.write_bytes(b'x')
+    assert poll_until(watcher, lambda finished, unsettled: unsettled) == ([], [str(path)])
+    watcher.close()
+
+
+def test_watch_imports_a_file_written_in_bursts_once(tmp_path):
+    (src, dst) = (tmp_path / 'src', tmp_path / 'dst')
+    src.mkdir()
+    imported = []
+    importer = watch.WatchImporter(str(src), str(dst), '%(category)s', Category_Policies['unknown'],
+                                   on_imported=imported.extend, polling=False)
+    runner = threading.Thread(target=importer.run, kwargs={'initial_scan': False}, daemon=True)
+    runner.start()
+    try:
+        time.sleep(0.2)
+        path = src / 'IMG_0001.JPG'
+        with open(path, 'wb') as picture:
+            picture.write(b'x' * 1000)
+            picture.flush()
+            # Longer than the settle time, which a file closed after
+            # writing doesn't wait for
+            time.sleep(watch.DEFAULT_SETTLE_SECONDS * 3)
+            picture.write(b'y' * 1000)
+
+        deadline = time.monotonic() + 5
+        while not imported and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # Long enough for a second import to show up
+        time.sleep(0.5)
+    finally:
+        importer.stop()
+        runner.join(5)
+
+    assert [source for source, destination, category in imported] == [str(path)]
+    destination = imported[0][1]
+    assert os.path.getsize(destination) == 2000
+    assert importer.imported == 1
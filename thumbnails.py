@@ -0,0 +1,106 @@
+from io import BytesIO
+import logging
+import os
+import threading
+
+import exifreader
+import instrumentation
+from importers.dedup import partial_hash
+
+logger = logging.getLogger(__name__)
+
+# Long-edge sizes, in pixels, at which thumbnails are generated and cached
+Thumbnail_Sizes = (128, 256, 512)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'picman', 'thumbnails')
+THUMBNAIL_QUALITY = 85
+
+
+def content_key(filepath, size=None):
+    """
+    Key identifying a file by its content rather than its path, so moved or
+    re-imported copies share their thumbnails
+    """
+    if size is None:
+        size = os.path.getsize(filepath)
+    return partial_hash(filepath, size)
+
+
+def load_preview(filepath, size):
+    """
+    Open filepath as a PIL image at least size pixels on its long edge where
+    the source allows, decoding as little as possible: from the embedded
+    preview when that is large enough, otherwise from the file itself with
+    JPEG draft mode scaling down while decoding
+    """
+    # Imported on first use, so importing this module doesn't load PIL
+    from PIL import Image
+
+    preview = exifreader.read_embedded_preview(filepath)
+    if preview is not None:
+        image = Image.open(BytesIO(preview))
+        if max(image.size) >= size:
+            image.draft('RGB', (size, size))
+            return image
+
+    image = Image.open(filepath)
+    image.draft('RGB', (size, size))
+    return image
+
+
+class ThumbnailCache(object):
+    """
+    On-disk cache of JPEG thumbnails at each of a few fixed sizes, keyed by
+    content_key and laid out as <directory>/<size>/<key[:2]>/<key>.jpg.
+
+    Requested sizes are rounded up to the next fixed size, and every fixed
+    size is generated from a single decode of the source.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, sizes=Thumbnail_Sizes):
+        self.directory = directory
+        self.sizes = tuple(sorted(sizes))
+        self.generated = 0
+
+    def fixed_size(self, size):
+        for fixed in self.sizes:
+            if fixed >= size:
+                return fixed
+        return self.sizes[-1]
+
+    def path_for(self, key, size):
+        return os.path.join(self.directory, str(size), key[:2], key + '.jpg')
+
+    def get(self, filepath, size):
+        """
+        Return the path of a thumbnail of filepath at least size pixels on
+        its long edge, generating the thumbnails if they aren't cached
+        """
+        size = self.fixed_size(size)
+        key = content_key(filepath)
+        path = self.path_for(key, size)
+        if not os.path.exists(path):
+            self.generate(filepath, key)
+        return path
+
+    def generate(self, filepath, key=None):
+        if key is None:
+            key = content_key(filepath)
+
+        from PIL import Image
+
+        with instrumentation.span('thumbnail.generate'):
+            image = load_preview(filepath, self.sizes[-1])
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            for size in reversed(self.sizes):
+                # Each size is reduced from the previous, larger one
+                image.thumbnail((size, size), Image.LANCZOS)
+                path = self.path_for(key, size)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+                image.save(temp_path, format='JPEG', quality=THUMBNAIL_QUALITY)
+                os.replace(temp_path, path)
+
+        self.generated += 1
+        logger.debug('Generated thumbnails of [%s] as [%s]', filepath, key)
+        return key